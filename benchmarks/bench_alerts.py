@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+#Exercise the AlertDispatcher against a local aiosmtpd server standing in for mailgun.
+#Simulates a motion storm across several sensors and reports how many emails and SMTP connections it took, compared with the old one-connection-per-event send_mail.
+#Also checks that the dispatcher reconnects after the server drops its connection.
+#Needs aiosmtpd (pip install aiosmtpd). Run from the repository root: python3 benchmarks/bench_alerts.py [events] [sensors]
+
+import datetime
+import os
+import sys
+from time import monotonic, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aiosmtpd.controller import Controller
+from watchful_alerts import AlertDispatcher
+
+#Handler that records the messages it receives. smtplib says EHLO once per connection, so counting EHLOs counts the client's connections (and not the probe connection aiosmtpd makes to itself on startup).
+class RecordingHandler:
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.connections += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 OK'
+
+def event(sensor, number):
+    return {
+        "sensor": sensor,
+        "timestamp": datetime.datetime.utcnow(),
+        "notes": "None",
+        "derivatives": {"thumb": b'\xff\xd8thumb' + bytes(number % 64), "preview": b'\xff\xd8preview'}
+    }
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    sensors = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname='127.0.0.1', port=8025)
+    controller.start()
+
+    dispatcher = AlertDispatcher('127.0.0.1', 8025, None, None, 'watchfulpi@watchfulpi.io', window=0.5, rate_limit=20, rate_period=60)
+    dispatcher.start()
+    started = monotonic()
+    for number in range(events):
+        dispatcher.submit('test@example.com', event('sensor' + str(number % sensors), number))
+    submitted = monotonic() - started
+    sleep(1.0)
+
+    #Kill the dispatcher's connection from the server side, then check the next alert still gets through.
+    controller.stop()
+    controller = Controller(handler, hostname='127.0.0.1', port=8025)
+    controller.start()
+    dispatcher.submit('test@example.com', event('sensor0', 0))
+    dispatcher.stop()
+    controller.stop()
+
+    stats = dispatcher.stats()
+    print("Alerts submitted:           %d from %d sensors in %.2f ms (%.1f us/alert on the caller)" % (events + 1, sensors, submitted * 1000, submitted / events * 1e6))
+    print("Emails sent:                %d (old send_mail: %d)" % (len(handler.messages), events + 1))
+    print("SMTP connections:           %d (old send_mail: %d)" % (handler.connections, events + 1))
+    print("Alerts coalesced:           %d" % stats["coalesced"])
+    print("Failed sends:               %d" % stats["failed"])
+    assert stats["failed"] == 0 and len(handler.messages) == stats["sent"]
+
+if __name__ == "__main__":
+    main()
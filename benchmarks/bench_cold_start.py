@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+
+#Benchmark of how long the hub and the web interface take to start: the time from launching them (with watchful_supervisor.py, as hub_quickstart.sh does) to the hub being ready
+#and the interface answering on port 5000. The hub is ready when its /metrics has the watchful_hub_startup_seconds sample, the same check the supervisor makes, which it only reports once it is reading the sensor streams. Repeated over several runs, with the page cache dropped before each one where that is allowed (run as root), so nothing is cached, as after a power cut.
+#Also times importing the hub and interface modules on their own, next to starting the interpreter and doing nothing.
+#Give the path of a checkout of an older version as 'repository' to measure that instead. A tree without watchful_supervisor.py is started as its hub_quickstart.sh did:
+#the hub and the interface launched at the same time. Importing its modules starts everything up, so their import times aren't measured. Older hubs don't report their start up time,
+#so for them the hub counts as ready once /metrics answers. They only served it after all their start up work apart from picking up the existing streams, which takes a few milliseconds.
+#Uses mongod if it is on the PATH, started at the same time as the hub and interface. Otherwise it uses mongomock, which a sitecustomize module swaps in for pymongo's MongoClient the first time pymongo is imported,
+#so processes that don't use MongoDB don't pay to import it. The hub runs its own redis-server on port 6379, so nothing else can be using that port, or 5000, 9111 and 27017.
+#Run from the repository root: python3 benchmarks/bench_cold_start.py [runs] [repository]
+
+import http.client
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+from time import monotonic, sleep
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+METRICS_PORT = 9111
+
+#The sample line the hub adds to its /metrics once it is ready (see watchful_supervisor.py).
+HUB_READY_SAMPLE = b'\nwatchful_hub_startup_seconds '
+
+ENV = '''mongoServerHost=127.0.0.1
+face_api_endpoint=http://127.0.0.1:9/face/v1.0/detect
+subscription_key=benchmark
+testEmail=bench@example.com
+smtpServer=127.0.0.1
+smtpPort=8026
+metricsPort={metrics_port}
+hubConsumerName=bench
+'''
+
+#Swaps mongomock in for pymongo's MongoClient once pymongo has been imported (and before the import statement that asked for it returns). mongomock itself is imported when the first client is made.
+SITECUSTOMIZE = '''
+import sys
+
+class MongomockFinder:
+    def find_spec(self, name, path, target=None):
+        if name != 'pymongo':
+            return None
+        sys.meta_path.remove(self)
+        import importlib.util
+        spec = importlib.util.find_spec('pymongo')
+        execModule = spec.loader.exec_module
+        def patched(module):
+            execModule(module)
+            module.MongoClient = MongoClient
+        spec.loader.exec_module = patched
+        return spec
+
+def MongoClient(*args, **kwargs):
+    import mongomock, mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+    return mongomock.MongoClient(*args, **kwargs)
+
+sys.meta_path.insert(0, MongomockFinder())
+'''
+
+def portOpen(port):
+    with socket.socket() as probe:
+        probe.settimeout(0.2)
+        return probe.connect_ex(('127.0.0.1', port)) == 0
+
+#True if a GET of 'path' on a local port answers 200 with a body that contains 'marker'.
+def answers(port, path, marker=b''):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status == 200 and marker in response.read()
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+#Write back dirty pages and drop the page cache, so the run reads the interpreter, libraries and sources from disk. Returns False if that isn't allowed.
+def dropCaches():
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as drop:
+            drop.write('3\n')
+        return True
+    except OSError:
+        return False
+
+def stop(process):
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(15)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+#Launch everything, wait until the hub and the interface are both ready, and return how long each took, in seconds from the launch.
+def coldStart(repository, workdir, environment, mongod, log):
+    processes = []
+    try:
+        started = monotonic()
+        if mongod:
+            processes.append(subprocess.Popen([mongod, '--dbpath', os.path.join(workdir, 'db'), '--port', '27017', '--bind_ip', '127.0.0.1'], stdout=subprocess.DEVNULL, start_new_session=True))
+        if os.path.exists(os.path.join(repository, 'watchful_supervisor.py')):
+            commands = [[sys.executable, os.path.join(repository, 'watchful_supervisor.py')]]
+            hub_marker = HUB_READY_SAMPLE
+        else:
+            commands = [[sys.executable, os.path.join(repository, 'watchful_hub.py')], [sys.executable, os.path.join(repository, 'watchful_interface.py')]]
+            hub_marker = b''
+        for command in commands:
+            processes.append(subprocess.Popen(command, cwd=workdir, env=environment, stdout=log, stderr=subprocess.STDOUT, start_new_session=True))
+        ready = {}
+        while len(ready) < 2:
+            now = monotonic()
+            if now - started > 120:
+                raise RuntimeError("Timed out waiting for the hub and interface to start (see " + log.name + ")")
+            if 'hub' not in ready and answers(METRICS_PORT, '/metrics', hub_marker):
+                ready['hub'] = now - started
+            if 'interface' not in ready and answers(5000, '/metrics'):
+                ready['interface'] = now - started
+            sleep(0.005)
+        return ready['hub'], ready['interface']
+    finally:
+        for process in reversed(processes):
+            stop(process)
+        deadline = monotonic() + 15
+        while (portOpen(6379) or portOpen(5000) or portOpen(METRICS_PORT)) and monotonic() < deadline:
+            sleep(0.05)
+
+#Time 'python3 -c <code>' in the work directory, best of 'repeat' runs (with a warm page cache).
+def timePython(code, workdir, environment, repeat=5):
+    best = None
+    for _ in range(repeat):
+        started = monotonic()
+        subprocess.run([sys.executable, '-c', code], cwd=workdir, env=environment, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = monotonic() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    repository = os.path.abspath(sys.argv[2] if len(sys.argv) > 2 else REPO)
+    for port in (6379, 5000, METRICS_PORT, 27017):
+        if portOpen(port):
+            sys.exit("Port " + str(port) + " is already in use")
+    mongod = shutil.which('mongod')
+    workdir = tempfile.mkdtemp(prefix='watchful-cold-start-')
+    with open(os.path.join(workdir, '.env'), 'w') as env:
+        env.write(ENV.format(metrics_port=METRICS_PORT))
+    environment = dict(os.environ, PYTHONPATH=repository)
+    if mongod:
+        os.makedirs(os.path.join(workdir, 'db'))
+    else:
+        site = os.path.join(workdir, 'site')
+        os.makedirs(site)
+        with open(os.path.join(site, 'sitecustomize.py'), 'w') as sitecustomize:
+            sitecustomize.write(SITECUSTOMIZE)
+        environment['PYTHONPATH'] = site + os.pathsep + repository
+    print("Repository: " + repository)
+    print("MongoDB: " + ("mongod, started with the hub and interface" if mongod else "mongomock"))
+
+    hub, interface, both = [], [], []
+    cold = True
+    with open(os.path.join(workdir, 'start.log'), 'w') as log:
+        for run in range(runs):
+            cold = dropCaches() and cold
+            hub_ready, interface_ready = coldStart(repository, workdir, environment, mongod, log)
+            hub.append(hub_ready)
+            interface.append(interface_ready)
+            both.append(max(hub_ready, interface_ready))
+            print("Run %d: hub ready in %.0f ms, interface ready in %.0f ms" % (run + 1, hub_ready * 1000, interface_ready * 1000))
+    print("Page cache: " + ("dropped before each run" if cold else "warm (dropping it needs root)"))
+    print("Hub ready:       median %.0f ms, max %.0f ms" % (median(hub) * 1000, max(hub) * 1000))
+    print("Interface ready: median %.0f ms, max %.0f ms" % (median(interface) * 1000, max(interface) * 1000))
+    print("Both ready:      median %.0f ms, max %.0f ms" % (median(both) * 1000, max(both) * 1000))
+
+    if os.path.exists(os.path.join(repository, 'watchful_supervisor.py')):
+        nothing = timePython('pass', workdir, environment)
+        print("Interpreter start:          %.0f ms" % (nothing * 1000))
+        for module in ('watchful_hub', 'watchful_interface'):
+            print("import %-19s %.0f ms" % (module + ':', timePython('import ' + module, workdir, environment) * 1000))
+    shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
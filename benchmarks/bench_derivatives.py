@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+#Benchmark of page weight and image decode ("render") cost for the events grid, before and after thumbnails.
+#Before: every event's full 640x480 JPEG was inlined into the page as a base64 data: URI and scaled down by the browser.
+#After: the page loads each event's 320x240 thumbnail from /api/event/<id>/image.
+#Also reports the cost of generating the derivatives at ingest, with and without PIL's draft-mode JPEG decoding.
+#Needs Pillow. Run from the repository root: python3 benchmarks/bench_derivatives.py [events per page]
+
+import base64
+import os
+import sys
+import timeit
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+#watchful_hub starts redis and connects to MongoDB at import time, so the derivative settings are mirrored here rather than imported.
+DERIVATIVE_SIZES = {
+    'preview': ((480, 360), 80),
+    'thumb': ((320, 240), 70)
+}
+
+#Build a synthetic camera frame: a blurred noise background with a few shapes, which compresses roughly like a real indoor scene.
+def syntheticFrame(seed):
+    im = Image.effect_noise((640, 480), 60).convert('RGB').filter(ImageFilter.GaussianBlur(2))
+    draw = ImageDraw.Draw(im)
+    for i in range(6):
+        x = (seed * 97 + i * 131) % 560
+        y = (seed * 53 + i * 71) % 400
+        draw.rectangle([x, y, x + 80, y + 60], fill=((seed * 40 + i * 30) % 256, 120, 200))
+    output = BytesIO()
+    im.save(output, format='jpeg', quality=85)
+    return output.getvalue()
+
+def derive(image, draft):
+    derivatives = {}
+    largest = max(size for size, quality in DERIVATIVE_SIZES.values())
+    with Image.open(BytesIO(image)) as im:
+        if draft:
+            im.draft('RGB', largest)
+        im = im.convert('RGB')
+        for name, (size, quality) in sorted(DERIVATIVE_SIZES.items(), key=lambda item: item[1][0], reverse=True):
+            im.thumbnail(size)
+            output = BytesIO()
+            im.save(output, format='jpeg', quality=quality, optimize=True)
+            derivatives[name] = output.getvalue()
+    return derivatives
+
+#What the browser has to do per grid cell: decode the JPEG and scale it to 320x240.
+def render(image):
+    with Image.open(BytesIO(image)) as im:
+        im.convert('RGB').resize((320, 240))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    frames = [syntheticFrame(i) for i in range(count)]
+    thumbs = [derive(frame, True)['thumb'] for frame in frames]
+
+    cell = '<div class="column"><img class="ui image" src="%s" alt="Event image" width="320" height="240"/><div>Time: 2024-01-01 00:00:00 UTC</div><div>Notes: None</div></div>'
+    before = sum(len(cell % ("data:image/jpg;base64," + base64.b64encode(frame).decode())) for frame in frames)
+    after_html = sum(len(cell % "/api/event/5f0c6e1f9d3b4a2c8e7f6a5c/image") for frame in frames)
+    after = after_html + sum(len(thumb) for thumb in thumbs)
+
+    render_before = min(timeit.repeat(lambda: [render(frame) for frame in frames], number=1, repeat=3)) * 1000
+    render_after = min(timeit.repeat(lambda: [render(thumb) for thumb in thumbs], number=1, repeat=3)) * 1000
+    derive_full = min(timeit.repeat(lambda: [derive(frame, False) for frame in frames], number=1, repeat=3)) / count * 1000
+    derive_draft = min(timeit.repeat(lambda: [derive(frame, True) for frame in frames], number=1, repeat=3)) / count * 1000
+
+    print("Events per page:            %d" % count)
+    print("Page weight before:         %.1f KB (single HTML document)" % (before / 1024))
+    print("Page weight after:          %.1f KB (%.1f KB HTML + %.1f KB thumbnails, cacheable)" % (after / 1024, after_html / 1024, (after - after_html) / 1024))
+    print("Image decode/scale before:  %.1f ms" % render_before)
+    print("Image decode/scale after:   %.1f ms" % render_after)
+    print("Derivatives per event:      %.2f ms full decode, %.2f ms draft decode" % (derive_full, derive_draft))
+
+if __name__ == "__main__":
+    main()
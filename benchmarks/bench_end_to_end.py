@@ -0,0 +1,352 @@
+#!/usr/bin/python3
+
+#End-to-end benchmark of the whole system on one Linux box: the real watchful_hub.py, found by and receiving events from N real watchful_sensor.py processes running on the mock hardware
+#(watchful_mock.py, with synthetic camera frames and the PIR sensor firing every 'motion interval' seconds), with local stand-ins for everything outside the box:
+#an aiosmtpd server for mailgun, a stub of the Azure Face API, and MongoDB -- a throwaway mongod if one is installed, otherwise mongomock inside the hub process.
+#For each combination of sensor count and motion interval it starts everything afresh, puts all the sensors in sensing mode, lets the system settle, then measures for a while:
+#events stored per second, the latency from a sensor recording an event (after its burst is captured) to the hub storing it, and the CPU use and memory of the hub (and its redis-server).
+#Latency is measured on the 'event' updates the hub publishes when it stores an event, against the event's timestamp, so it needs the sensors and hub on the same clock -- which they are here.
+#The hub runs its own redis-server on port 6379 (and mongod, if used, runs on 27017), so nothing else can be using those ports. Needs Pillow, aiosmtpd, redis-server on the PATH,
+#and mongod or mongomock (pip install mongomock). Linux only: CPU and memory are read from /proc.
+#Results are printed as a table and written as JSON (one object per run) for tracking regressions, e.g. by diffing against a previous results file.
+#Run from the repository root: python3 benchmarks/bench_end_to_end.py [sensor counts, e.g. 1,4,8] [motion intervals in seconds, e.g. 4,2] [seconds to measure] [results file]
+
+import datetime
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+
+import redis
+from aiosmtpd.controller import Controller
+
+METRICS_PORT = 9111
+SMTP_PORT = 8026
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+#Each mock motion lasts this long (MockMotionSensor's default), so a sensor fires once every (motion interval + MOTION_DURATION) seconds.
+MOTION_DURATION = 1.0
+
+#Runs the hub in-process after swapping pymongo's MongoClient for mongomock's, for when there is no mongod to run. Run with the hub's directory as its argument.
+MONGOMOCK_LAUNCHER = '''
+import os, runpy, sys
+import mongomock, mongomock.gridfs, pymongo
+mongomock.gridfs.enable_gridfs_integration()
+pymongo.MongoClient = mongomock.MongoClient
+sys.path.insert(0, sys.argv[1])
+sys.argv = [os.path.join(sys.argv[1], 'watchful_hub.py')]
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+#Stand-in for the Azure Face API detect endpoint: reads the posted image, waits a little as a round trip to Azure would, and finds no faces.
+class StubFaceApi(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.05
+    requests = 0
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        StubFaceApi.requests += 1
+        threading.Event().wait(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'[]')
+
+    def log_message(self, *args):
+        pass
+
+#Stand-in for mailgun that just counts the alert emails it receives.
+class CountingHandler:
+    def __init__(self):
+        self.messages = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages += 1
+        return '250 OK'
+
+def portOpen(port):
+    with socket.socket() as probe:
+        probe.settimeout(0.2)
+        return probe.connect_ex(('127.0.0.1', port)) == 0
+
+def waitFor(check, timeout, what):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if check():
+            return
+        sleep(0.2)
+    raise RuntimeError("Timed out waiting for " + what)
+
+#CPU seconds used so far by a process, and its current and peak resident memory in MB.
+def processCpu(pid):
+    with open('/proc/' + str(pid) + '/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def processMemory(pid):
+    memory = {}
+    with open('/proc/' + str(pid) + '/status') as status:
+        for line in status:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                memory[line.split(':')[0]] = int(line.split()[1]) / 1024
+    return memory.get('VmRSS', 0.0), memory.get('VmHWM', 0.0)
+
+def childPids(pid):
+    children = []
+    for task in os.listdir('/proc/' + str(pid) + '/task'):
+        with open('/proc/' + str(pid) + '/task/' + task + '/children') as listing:
+            children.extend(int(child) for child in listing.read().split())
+    return children
+
+#Read the hub's /metrics into a dict of 'name{labels}' -> value.
+def scrapeMetrics():
+    samples = {}
+    with urllib.request.urlopen('http://127.0.0.1:' + str(METRICS_PORT) + '/metrics', timeout=5) as response:
+        for line in response.read().decode().splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+    return samples
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+#Collect the hub's 'event' updates, noting when each one arrived and how long after the event was recorded.
+class EventListener:
+    def __init__(self, connection):
+        self.pubsub = connection.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe('watchful_updates')
+        self.events = []
+        self.thread = threading.Thread(target=self._listen, daemon=True)
+        self.thread.start()
+
+    def _listen(self):
+        try:
+            for message in self.pubsub.listen():
+                update = json.loads(message['data'])
+                if update.get('type') == 'event':
+                    recorded = datetime.datetime.fromisoformat(update['event']['timestamp'])
+                    self.events.append((monotonic(), (datetime.datetime.utcnow() - recorded).total_seconds()))
+        except (redis.ConnectionError, ValueError):
+            pass
+
+    def between(self, started, finished):
+        return [latency for arrived, latency in self.events if started <= arrived < finished]
+
+    def close(self):
+        self.pubsub.close()
+
+#Start the hub (and its redis-server) in a new session, so the whole lot can be stopped together.
+def startHub(workdir, mongod):
+    log = open(os.path.join(workdir, 'hub.log'), 'wb')
+    if mongod:
+        command = [sys.executable, os.path.join(REPO, 'watchful_hub.py')]
+    else:
+        command = [sys.executable, '-c', MONGOMOCK_LAUNCHER, REPO]
+    hub = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        waitFor(lambda: hub.poll() is None and portOpen(METRICS_PORT), 60, "the hub to start")
+    except RuntimeError:
+        stop(hub)
+        with open(os.path.join(workdir, 'hub.log'), 'rb') as output:
+            sys.stderr.write(output.read().decode(errors='replace')[-3000:])
+        raise
+    return hub
+
+def startSensors(workdir, count, interval):
+    environment = dict(os.environ, WATCHFUL_MOCK_HARDWARE='1', WATCHFUL_MOCK_SYNTHETIC='1', WATCHFUL_MOCK_MOTION_INTERVAL=str(interval), WATCHFUL_EVENT_COOLDOWN='0')
+    sensors = []
+    for number in range(count):
+        log = open(os.path.join(workdir, 'sensor' + str(number) + '.log'), 'wb')
+        sensors.append(subprocess.Popen([sys.executable, os.path.join(REPO, 'watchful_sensor.py')], cwd=REPO, env=environment, stdout=log, stderr=subprocess.STDOUT, start_new_session=True))
+    return sensors
+
+def stop(process):
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+def writeEnv(workdir, face_api):
+    settings = {
+        'mongoServerHost': '127.0.0.1',
+        'testEmail': 'bench@watchfulpi.io',
+        'smtpServer': '127.0.0.1',
+        'smtpPort': SMTP_PORT,
+        'alertWindow': 2,
+        'alertRateLimit': 1000000,
+        'detectionBackend': 'azure',
+        'face_api_endpoint': face_api,
+        'subscription_key': 'bench',
+        'discoveryInterval': 1,
+        'hubConsumerName': 'bench',
+        'metricsPort': METRICS_PORT,
+        'pipelineStatsInterval': 3600
+    }
+    with open(os.path.join(workdir, '.env'), 'w') as env:
+        for key, value in settings.items():
+            env.write(key + '=' + str(value) + '\n')
+
+#One run: start the hub and 'count' sensors, put them all in sensing mode, wait 'warmup' seconds, then measure for 'seconds'.
+def run(count, interval, seconds, warmup, mongod, face_api, mail):
+    workdir = tempfile.mkdtemp(prefix='watchful-bench-')
+    writeEnv(workdir, face_api)
+    database = None
+    hub = None
+    sensors = []
+    listener = None
+    try:
+        if mongod:
+            os.mkdir(os.path.join(workdir, 'db'))
+            database = subprocess.Popen([mongod, '--dbpath', os.path.join(workdir, 'db'), '--port', '27017', '--bind_ip', '127.0.0.1'], stdout=subprocess.DEVNULL, start_new_session=True)
+            waitFor(lambda: portOpen(27017), 30, "mongod to start")
+        hub = startHub(workdir, mongod)
+        connection = redis.StrictRedis(host='127.0.0.1', port=6379, db=0)
+        listener = EventListener(connection)
+        sensors = startSensors(workdir, count, interval)
+        waitFor(lambda: connection.hlen('sensors') >= count, 60, "the hub to discover " + str(count) + " sensors")
+        connection.publish('watchful_commands', 'all:1')
+        sleep(warmup)
+
+        servers = childPids(hub.pid)
+        before = scrapeMetrics()
+        hub_cpu = processCpu(hub.pid)
+        redis_cpu = sum(processCpu(pid) for pid in servers)
+        sensors_cpu = sum(processCpu(sensor.pid) for sensor in sensors)
+        mails = mail.messages
+        started = monotonic()
+        sleep(seconds)
+        finished = monotonic()
+        elapsed = finished - started
+        hub_cpu = processCpu(hub.pid) - hub_cpu
+        redis_cpu = sum(processCpu(pid) for pid in servers) - redis_cpu
+        sensors_cpu = sum(processCpu(sensor.pid) for sensor in sensors) - sensors_cpu
+        after = scrapeMetrics()
+        rss, peak_rss = processMemory(hub.pid)
+        backlog = sum(connection.xlen(key) for key in connection.scan_iter(match='events:*'))
+
+        latencies = listener.between(started, finished)
+        outcomes = {}
+        steps = {}
+        for name, value in after.items():
+            if name.startswith('watchful_events_total{'):
+                outcomes[name.split('"')[1]] = value - before.get(name, 0)
+            if name.startswith('watchful_hub_step_seconds_count{') and value > before.get(name, 0):
+                step = name.split('"')[1]
+                total = name.replace('_count{', '_sum{')
+                steps[step] = round((after[total] - before.get(total, 0)) / (value - before.get(name, 0)) * 1000, 3)
+        return {
+            "sensors": count,
+            "motion_interval": interval,
+            "offered_events_per_second": round(count / (interval + MOTION_DURATION), 3),
+            "seconds": round(elapsed, 1),
+            "events": len(latencies),
+            "events_per_second": round(len(latencies) / elapsed, 3),
+            "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+            "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+            "latency_max_ms": round(max(latencies) * 1000, 1) if latencies else None,
+            "hub_cpu_percent": round(hub_cpu / elapsed * 100, 1),
+            "hub_rss_mb": round(rss, 1),
+            "hub_peak_rss_mb": round(peak_rss, 1),
+            "redis_cpu_percent": round(redis_cpu / elapsed * 100, 1),
+            "sensors_cpu_percent": round(sensors_cpu / elapsed * 100, 1),
+            "backlog": backlog,
+            "alert_emails": mail.messages - mails,
+            "outcomes": outcomes,
+            "step_mean_ms": steps
+        }
+    finally:
+        if listener:
+            listener.close()
+        for process in sensors + [hub, database]:
+            if process:
+                stop(process)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    counts = [int(count) for count in (sys.argv[1] if len(sys.argv) > 1 else '1,4').split(',')]
+    intervals = [float(interval) for interval in (sys.argv[2] if len(sys.argv) > 2 else '4,1').split(',')]
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 30
+    output = sys.argv[4] if len(sys.argv) > 4 else 'bench_end_to_end.json'
+
+    mongod = shutil.which('mongod')
+    if not mongod:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("Needs mongod on the PATH or mongomock installed")
+    for port in [6379, METRICS_PORT] + ([27017] if mongod else []):
+        if portOpen(port):
+            sys.exit("Port " + str(port) + " is already in use -- the benchmark runs its own servers there")
+
+    face_server = ThreadingHTTPServer(('127.0.0.1', 0), StubFaceApi)
+    face_server.daemon_threads = True
+    threading.Thread(target=face_server.serve_forever, daemon=True).start()
+    face_api = 'http://127.0.0.1:' + str(face_server.server_address[1]) + '/face/v1.0/detect'
+    mail = CountingHandler()
+    smtp = Controller(mail, hostname='127.0.0.1', port=SMTP_PORT)
+    smtp.start()
+
+    results = []
+    print("MongoDB: " + (mongod or "mongomock") + ", " + str(os.cpu_count()) + " CPUs")
+    print("Sensors  Interval  Offered/s  Stored/s  p50 ms  p99 ms  Hub CPU%  Hub RSS MB  Redis CPU%  Sensors CPU%  Backlog")
+    try:
+        for count in counts:
+            for interval in intervals:
+                #Long enough for every sensor to have started its camera and fired at least once, so the measurement starts in the steady state.
+                warmup = interval + MOTION_DURATION + 5
+                result = run(count, interval, seconds, warmup, mongod, face_api, mail)
+                results.append(result)
+                print("%7d  %8.1f  %9.2f  %8.2f  %6s  %6s  %8.1f  %10.1f  %10.1f  %12.1f  %7d" % (
+                    count, interval, result["offered_events_per_second"], result["events_per_second"], result["latency_p50_ms"], result["latency_p99_ms"],
+                    result["hub_cpu_percent"], result["hub_rss_mb"], result["redis_cpu_percent"], result["sensors_cpu_percent"], result["backlog"]))
+    finally:
+        smtp.stop()
+        face_server.shutdown()
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    with open(output, 'w') as results_file:
+        json.dump({
+            "benchmark": "end_to_end",
+            "time": datetime.datetime.utcnow().isoformat(),
+            "commit": commit,
+            "machine": {"cpus": os.cpu_count(), "platform": platform.platform(), "python": platform.python_version()},
+            "mongodb": "mongod" if mongod else "mongomock",
+            "seconds": seconds,
+            "face_api_latency_ms": StubFaceApi.latency * 1000,
+            "results": results
+        }, results_file, indent=2)
+    print("Results written to " + output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+
+#Benchmark of the face detection backends against a local stub of the Azure Face API, so it runs without an Azure subscription or internet access.
+#Compares the old path (a fresh requests.post per event, no timeout, response.json() re-parsed for every field) with AzureFaceDetector (pooled Session, single parse),
+#measures the detection cache on a run of near-identical frames, and times the OpenCV Haar backend if opencv-python is installed.
+#Needs Pillow and requests. Run from the repository root: python3 benchmarks/bench_face_detection.py [events] [stub latency ms]
+
+import json
+import os
+import socket
+import sys
+import threading
+import timeit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import requests
+from watchful_detection import AzureFaceDetector, HaarFaceDetector, DetectionCache, imageHash, annotate, describe
+
+#A single face, so the old single-face-only path does the same annotation work as the new one.
+STUB_RESPONSE = json.dumps([
+    {"faceId": "a", "faceRectangle": {"top": 100, "left": 120, "width": 80, "height": 80}, "faceAttributes": {"age": 34.0, "gender": "male"}}
+]).encode()
+
+#Stand-in for the Azure Face API detect endpoint: reads the posted image, waits for the configured latency and returns a fixed one-face response.
+class StubFaceApi(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    #Send small writes straight away, as Azure would, rather than letting Nagle's algorithm hold the body back behind the headers on a kept-alive connection.
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        if self.latency:
+            threading.Event().wait(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(STUB_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(STUB_RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+#The detection path as it was in watchful_hub.azureFaceDetection.
+def legacyDetect(endpoint, image):
+    headers = {'Ocp-Apim-Subscription-Key': 'key', 'Content-Type': 'application/octet-stream'}
+    params = {'detectionModel': 'detection_01', 'returnFaceId': 'true', 'returnFaceAttributes': 'age,gender'}
+    response = requests.post(endpoint, params=params, headers=headers, data=image)
+    if len(response.json()) == 1:
+        top = response.json()[0].get("faceRectangle").get("top")
+        left = response.json()[0].get("faceRectangle").get("left")
+        bottom = response.json()[0].get("faceRectangle").get("top") + response.json()[0].get("faceRectangle").get("height")
+        right = response.json()[0].get("faceRectangle").get("left") + response.json()[0].get("faceRectangle").get("width")
+        returned_image = BytesIO()
+        with Image.open(BytesIO(image)) as im:
+            draw = ImageDraw.Draw(im)
+            draw.line([left, top, right, top, left, top, left, bottom, left, bottom, right, bottom, right, bottom, right, top], fill=(0, 223, 0), width=3)
+            im.save(returned_image, format="jpeg")
+        return returned_image.getvalue(), "Subject appears to be a " + str(int(response.json()[0].get("faceAttributes").get("age"))) + " year old " + response.json()[0].get("faceAttributes").get("gender") + "."
+    return image, "None"
+
+def newDetect(detector, image):
+    faces = detector.detect(image)
+    return annotate(image, faces), describe(faces)
+
+#A static scene with a face-coloured blob in it, optionally with a little sensor noise so consecutive frames are near-identical rather than identical.
+SCENE = Image.effect_noise((640, 480), 40).convert('RGB').filter(ImageFilter.GaussianBlur(8))
+ImageDraw.Draw(SCENE).ellipse([200, 120, 440, 400], fill=(200, 170, 150))
+
+def frame(noise):
+    im = SCENE
+    if noise:
+        im = Image.blend(im, Image.effect_noise((640, 480), 20).convert('RGB'), 0.05)
+    output = BytesIO()
+    im.save(output, format='jpeg', quality=85)
+    return output.getvalue()
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    StubFaceApi.latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 20.0) / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubFaceApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = 'http://127.0.0.1:' + str(server.server_address[1]) + '/face/v1.0/detect'
+    image = frame(False)
+
+    legacy = min(timeit.repeat(lambda: legacyDetect(endpoint, image), number=events, repeat=3)) / events * 1000
+    detector = AzureFaceDetector(endpoint, 'key', timeout=5)
+    pooled = min(timeit.repeat(lambda: newDetect(detector, image), number=events, repeat=3)) / events * 1000
+    detector.close()
+    print("Stub latency:               %.0f ms" % (StubFaceApi.latency * 1000))
+    print("Legacy requests.post:       %.2f ms/event" % legacy)
+    print("AzureFaceDetector:          %.2f ms/event" % pooled)
+
+    #A burst of near-identical frames from one sensor: only the first one should reach the backend.
+    cache = DetectionCache()
+    burst = [frame(True) for i in range(10)]
+    calls = 0
+    for item in burst:
+        image_hash = imageHash(item)
+        if cache.lookup('sensor', image_hash) is None:
+            calls += 1
+            cache.store('sensor', image_hash, [])
+    hash_cost = min(timeit.repeat(lambda: imageHash(image), number=events, repeat=3)) / events * 1000
+    print("Cache on 10-frame burst:    %d backend call(s), %d hit(s), %.2f ms/hash" % (calls, cache.hits, hash_cost))
+
+    try:
+        import cv2
+    except ImportError:
+        print("Haar backend:               skipped (opencv-python not installed)")
+    else:
+        haar = HaarFaceDetector(workers=2)
+        haar.detect(image)
+        local = min(timeit.repeat(lambda: haar.detect(image), number=events, repeat=3)) / events * 1000
+        haar.close()
+        print("HaarFaceDetector:           %.2f ms/event" % local)
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
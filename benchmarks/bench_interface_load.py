@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+#Load test for the web interface's sensor state API (the dashboard's hot path): hammers GET /api/sensor/all and GET /api/sensor/<id> from several client threads and reports requests/sec and latency.
+#Registers 'sensors' fake sensors in the hub's Redis first (in the same layout the hub and sensors use: the 'sensors' hash plus a mode key per sensor) and removes them again afterwards,
+#so the interface has a realistic number of sensors to report on. The interface must already be running, e.g. python3 watchful_interface.py.
+#Run from the repository root: python3 benchmarks/bench_interface_load.py [url] [sensors] [threads] [seconds]
+
+import http.client
+import json
+import sys
+import threading
+from time import monotonic
+from urllib.parse import urlsplit
+
+import redis
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+#Each client thread keeps one HTTP connection open and sends requests back to back until 'deadline', recording each request's latency.
+def client(address, path, deadline, latencies, errors):
+    connection = http.client.HTTPConnection(address.hostname, address.port or 80, timeout=10)
+    while monotonic() < deadline:
+        started = monotonic()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+            json.loads(body)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            errors.append(str(e))
+            connection.close()
+            continue
+        latencies.append(monotonic() - started)
+    connection.close()
+
+def load(address, path, threads, seconds):
+    latencies = []
+    errors = []
+    deadline = monotonic() + seconds
+    workers = [threading.Thread(target=client, args=(address, path, deadline, latencies, errors)) for _ in range(threads)]
+    started = monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = monotonic() - started
+    print("%-28s %8.0f req/s   p50 %6.2f ms   p99 %6.2f ms   errors %d" % (path, len(latencies) / elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, len(errors)))
+
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 else 'http://127.0.0.1:5000'
+    sensors = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    seconds = float(sys.argv[4]) if len(sys.argv) > 4 else 5.0
+    address = urlsplit(url)
+
+    #Fake sensor ids are 24 hex characters, like the ObjectIds real sensors use.
+    sensor_ids = ['be4c' + format(number, '020x') for number in range(sensors)]
+    connection = redis.StrictRedis(host=address.hostname, port=6379, db=0)
+    transaction = connection.pipeline()
+    transaction.hset('sensors', mapping={sensor_id: '10.0.' + str(number // 250) + '.' + str(number % 250 + 1) for number, sensor_id in enumerate(sensor_ids)})
+    for sensor_id in sensor_ids:
+        transaction.set(sensor_id, 0, ex=300)
+    transaction.execute()
+    try:
+        print("%d sensors, %d client threads, %.0f seconds per endpoint" % (sensors, threads, seconds))
+        load(address, '/api/sensor/all', threads, seconds)
+        load(address, '/api/sensor/' + sensor_ids[0], threads, seconds)
+    finally:
+        transaction = connection.pipeline()
+        transaction.hdel('sensors', *sensor_ids)
+        transaction.delete(*sensor_ids)
+        transaction.execute()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+#Benchmark of the cost of the hub's metrics on the ingest path.
+#Reports the cost of each kind of measurement, then runs events through the four pipeline stages, doing the CPU-bound part of ingest (decode, image hash, derivatives)
+#and taking the same measurements the hub takes per event, once with metrics recording and once with recording switched off, and compares the time per event.
+#The stages run one after another in a single thread, since thread scheduling noise would otherwise swamp the difference.
+#Needs Pillow. Run from the repository root: python3 benchmarks/bench_metrics_overhead.py [events]
+
+import datetime
+import os
+import sys
+import timeit
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image
+import watchful_metrics
+from watchful_metrics import Registry
+from watchful_pipeline import QUEUE_WAIT_SECONDS, STAGE_SECONDS
+from watchful_events import encodeEvent, decodeEvent
+from watchful_detection import imageHash
+
+MOCK_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static', 'stream404.jpg')
+
+registry = Registry()
+STEP_SECONDS = registry.histogram('bench_step_seconds', 'Step time', ['step'])
+EVENTS = registry.counter('bench_events_total', 'Events', ['outcome'])
+
+def decode(data):
+    with STEP_SECONDS.time('decode'):
+        event = decodeEvent(data)
+    EVENTS.inc('received')
+    return event
+
+def analyse(event):
+    with STEP_SECONDS.time('detection'):
+        event['hash'] = imageHash(event['captured_image'])
+    return event
+
+def derive(event):
+    with Image.open(BytesIO(event['captured_image'])) as im:
+        im.draft('RGB', (480, 360))
+        im = im.convert('RGB')
+        derivatives = {}
+        for name, size in (('preview', (480, 360)), ('thumb', (320, 240))):
+            im.thumbnail(size)
+            output = BytesIO()
+            im.save(output, format='jpeg', quality=75)
+            derivatives[name] = output.getvalue()
+    event['derivatives'] = derivatives
+    return event
+
+def store(event):
+    with STEP_SECONDS.time('images'):
+        pass
+    with STEP_SECONDS.time('insert'):
+        pass
+    EVENTS.inc('stored')
+    STEP_SECONDS.observe(0.001, 'latency')
+    return event
+
+STAGES = [("decode", decode), ("analysis", analyse), ("derivatives", derive), ("persistence", store)]
+
+#Run one event through every stage, recording the queue wait and processing time for each stage as Stage does.
+def ingest(message):
+    item = message
+    for name, handler in STAGES:
+        QUEUE_WAIT_SECONDS.observe(0.0, name)
+        with STAGE_SECONDS.time(name):
+            item = handler(item)
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    with open(MOCK_IMAGE_PATH, 'rb') as image:
+        image = image.read()
+    message = encodeEvent({'_id': '0' * 24, 'sensor': '1' * 24, 'timestamp': datetime.datetime.utcnow(), 'captured_image': image})
+
+    histogram = registry.histogram('bench_seconds', 'Micro benchmark', ['step'])
+    counter = registry.counter('bench_total', 'Micro benchmark', ['outcome'])
+    def timed():
+        with histogram.time('decode'):
+            pass
+    calls = 200000
+    print("Histogram.observe():           %.2f us" % (timeit.timeit(lambda: histogram.observe(0.01, 'decode'), number=calls) / calls * 1e6))
+    print("Histogram.time() block:        %.2f us" % (timeit.timeit(timed, number=calls) / calls * 1e6))
+    print("Counter.inc():                 %.2f us" % (timeit.timeit(lambda: counter.inc('stored'), number=calls) / calls * 1e6))
+    per_call = timeit.timeit(timed, number=calls) / calls
+
+    #Alternate runs with and without recording so drift in the machine's speed affects both equally, and take the fastest run of each.
+    recording = (watchful_metrics.Histogram.observe, watchful_metrics.Counter.inc)
+    instrumented = []
+    plain = []
+    for attempt in range(5):
+        watchful_metrics.Histogram.observe, watchful_metrics.Counter.inc = recording
+        instrumented.append(timeit.timeit(lambda: ingest(message), number=events) / events)
+        watchful_metrics.Histogram.observe = lambda self, value, *labelvalues: None
+        watchful_metrics.Counter.inc = lambda self, *labelvalues, amount=1: None
+        plain.append(timeit.timeit(lambda: ingest(message), number=events) / events)
+    watchful_metrics.Histogram.observe, watchful_metrics.Counter.inc = recording
+    plain = min(plain)
+    instrumented = min(instrumented)
+    print("Ingest, metrics off:           %.3f ms/event" % (plain * 1000))
+    print("Ingest, metrics on:            %.3f ms/event" % (instrumented * 1000))
+    print("Measured overhead:             %.2f%%" % ((instrumented - plain) / plain * 100))
+
+    #The hub takes 16 measurements per event: queue wait and processing time for each of the 4 stages, 6 steps, the event latency and 2 counters.
+    print("Estimated overhead:            %.1f us/event, %.2f%%" % (16 * per_call * 1e6, 16 * per_call / plain * 100))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+#Benchmark of the sensor's motion gate (watchful_motion.py) on a labelled synthetic set of PIR triggers.
+#Each sample is a scene seen by the camera for a few seconds (the frames the gate learns its background from), followed by the frames after a trigger.
+#Triggers that should reach the hub: a person walking through the scene, near or far. Triggers that shouldn't: nothing moving at all (heat from a radiator, sunlight), a slow change in the light, a pet.
+#Every frame has fresh sensor noise, like a real camera. Reports the score range and pass rate for each kind of trigger at a few thresholds, and what the gate costs per frame
+#(every captured frame is folded into the background, at 4 frames per second) compared with the CPU budget of a sensor.
+#Needs NumPy and Pillow. Run from the repository root: python3 benchmarks/bench_motion_gate.py [samples per kind] [seed]
+
+import os
+import sys
+import timeit
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy
+from PIL import Image
+from watchful_motion import MotionGate
+
+WIDTH, HEIGHT = 640, 480
+BACKGROUND_FRAMES = 16
+TRIGGER_FRAMES = 4
+FRAMERATE = 4
+THRESHOLDS = [0.005, 0.01, 0.02, 0.05]
+
+#The kinds of trigger in the set, and whether each one should be let through.
+KINDS = [("person", True), ("person far", True), ("nothing", False), ("light", False), ("pet", False)]
+
+#A room: a brightness gradient, some furniture and smooth texture.
+def scene(random):
+    y, x = numpy.mgrid[0:HEIGHT, 0:WIDTH]
+    angle = random.uniform(0, numpy.pi)
+    image = 60 + 100 * ((x * numpy.cos(angle) + y * numpy.sin(angle)) / (WIDTH + HEIGHT) + 0.5)
+    for _ in range(random.randint(3, 8)):
+        left, top = random.randint(0, WIDTH - 80), random.randint(0, HEIGHT - 80)
+        image[top:top + random.randint(40, 200), left:left + random.randint(40, 250)] = random.uniform(20, 230)
+    texture = numpy.asarray(Image.fromarray(random.normal(0, 30, (HEIGHT // 8, WIDTH // 8)).astype(numpy.float32), 'F').resize((WIDTH, HEIGHT), Image.BICUBIC))
+    return image + texture
+
+def jpeg(pixels):
+    output = BytesIO()
+    Image.fromarray(numpy.clip(pixels, 0, 255).astype(numpy.uint8), 'L').convert('RGB').save(output, format='jpeg', quality=85)
+    return output.getvalue()
+
+#An object of the given size moving across the scene, in a colour that stands out from what is behind it.
+def moving(random, frames, width, height):
+    left = random.randint(0, WIDTH - width)
+    top = random.randint(0, HEIGHT - height)
+    step = random.choice([-1, 1]) * width // 6
+    for number, frame in enumerate(frames):
+        x = min(max(0, left + number * step), WIDTH - width)
+        behind = frame[top:top + height, x:x + width].mean()
+        frame[top:top + height, x:x + width] = (behind + 90) % 256 if behind < 128 else behind - 90
+
+#Build one sample: the background frames and the frames after the trigger, as JPEGs.
+def sample(random, kind):
+    room = scene(random)
+    noise = lambda: random.normal(0, 4, (HEIGHT, WIDTH))
+    background = [jpeg(room + noise()) for _ in range(BACKGROUND_FRAMES)]
+    after = [room + noise() for _ in range(TRIGGER_FRAMES)]
+    if kind == "person":
+        moving(random, after, random.randint(WIDTH // 8, WIDTH // 5), random.randint(HEIGHT // 2, HEIGHT * 3 // 4))
+    elif kind == "person far":
+        moving(random, after, random.randint(WIDTH // 14, WIDTH // 10), random.randint(HEIGHT // 4, HEIGHT // 3))
+    elif kind == "light":
+        drift = random.uniform(4, 10) * random.choice([-1, 1])
+        after = [frame + drift * (number + 1) / TRIGGER_FRAMES for number, frame in enumerate(after)]
+    elif kind == "pet":
+        moving(random, after, random.randint(WIDTH // 20, WIDTH // 14), random.randint(HEIGHT // 20, HEIGHT // 14))
+    return background, [jpeg(frame) for frame in after]
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    random = numpy.random.RandomState(int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+
+    scores = {kind: [] for kind, wanted in KINDS}
+    update_times = []
+    score_times = []
+    frames = None
+    for kind, wanted in KINDS:
+        for _ in range(samples):
+            background, after = sample(random, kind)
+            gate = MotionGate()
+            for frame in background:
+                update_times.append(timeit.timeit(lambda: gate.update(frame), number=1))
+            score_times.append(timeit.timeit(lambda: scores[kind].append(gate.score(after)), number=1))
+            frames = background
+
+    print("%-12s %-8s %-15s" % ("Trigger", "Wanted", "Score range") + "".join("  pass@%-5s" % threshold for threshold in THRESHOLDS))
+    errors = {threshold: 0 for threshold in THRESHOLDS}
+    for kind, wanted in KINDS:
+        passed = []
+        for threshold in THRESHOLDS:
+            count = sum(score >= threshold for score in scores[kind])
+            errors[threshold] += samples - count if wanted else count
+            passed.append(count)
+        print("%-12s %-8s %.4f-%.4f  " % (kind, "yes" if wanted else "no", min(scores[kind]), max(scores[kind])) + "".join("  %6d/%-3d" % (count, samples) for count in passed))
+    total = samples * len(KINDS)
+    print("Accuracy:                             " + "".join("  %9.1f%%" % ((total - errors[threshold]) / total * 100) for threshold in THRESHOLDS))
+    print("Default threshold: %.3f" % MotionGate().threshold)
+
+    #The gate's cost is mostly decoding: compare with decoding each frame at full size before shrinking it.
+    update = sorted(update_times)[len(update_times) // 2]
+    score = sorted(score_times)[len(score_times) // 2]
+    full = min(timeit.repeat(lambda: Image.open(BytesIO(frames[0])).convert('L').resize((80, 60), Image.BILINEAR), number=20, repeat=3)) / 20
+    print("update() per frame:       %.2f ms (median)" % (update * 1000))
+    print("score() per trigger:      %.2f ms for %d frames (median)" % (score * 1000, TRIGGER_FRAMES))
+    print("Full-size decode + shrink %.2f ms per frame, for comparison" % (full * 1000))
+    share = update * FRAMERATE * 100
+    print("CPU at %d fps:             %.2f%% of one core on this machine; stays under a 5%% budget on a CPU up to %.0fx slower" % (FRAMERATE, share, 5 / share))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+#Benchmark of the retention job (watchful_retention.py) on a database of events spread over the last 400 days, as the hub stores them: the original image, preview and thumbnail and a burst of frames in GridFS.
+#Two sensors use the default policy (full images for 30 days, thumbnails for a year, then archive) and one deletes instead of archiving.
+#Runs one retention pass and reports the storage used before and after, the bytes reclaimed by the job's own count, the size of the archive, and how long the pass and its longest batch took
+#(the longest batch is the longest the job can hold up anything else). Checks that compacted events still have an image to show and that the archive can be read back.
+#Then switches an archiving sensor to delete with a shorter 'thumbnail_days' and checks that a second pass deletes its events that are past it, although they were compacted without an expiry date.
+#Needs Pillow. Uses mongomock unless a MongoDB host is given, in which case it uses (and empties) the watchfulpi_bench database there.
+#Run from the repository root: python3 benchmarks/bench_retention.py [events] [mongodb host]
+
+import datetime
+import glob
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+from io import BytesIO
+from time import monotonic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bson import ObjectId, json_util
+from bson import encode as encodeBson
+from PIL import Image
+from watchful_storage import imageStore, saveImage, loadImage, createIndexes, IMAGE_BUCKET
+from watchful_retention import RetentionJob, RetentionPolicy, setSensorPolicy
+from watchful_mock import syntheticFrames
+
+SENSORS = ['5e4503' + format(number, '018x') for number in range(3)]
+DAYS = 400
+BURST = 8
+
+def derivative(image, size):
+    with Image.open(BytesIO(image)) as im:
+        im.thumbnail(size)
+        output = BytesIO()
+        im.convert('RGB').save(output, format='jpeg', quality=75)
+        return output.getvalue()
+
+#Bytes used by the events and their images (document sizes plus image lengths, which is what compaction and archiving take away; MongoDB's own overheads come on top).
+def storageUsed(db):
+    documents = sum(len(encodeBson(event)) for event in db.security_events.find())
+    images = sum(file['length'] for file in db[IMAGE_BUCKET + '.files'].find({}, {'length': 1}))
+    return documents, images
+
+def tiers(db):
+    full = db.security_events.count_documents({"retention": None})
+    thumbnail = db.security_events.count_documents({"retention": "thumbnail"})
+    return full, thumbnail
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    if len(sys.argv) > 2:
+        from pymongo import MongoClient
+        client = MongoClient(sys.argv[2], 27017)
+        client.drop_database('watchfulpi_bench')
+    else:
+        import mongomock
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+        client = mongomock.MongoClient()
+    print("MongoDB: " + ("mongod at " + sys.argv[2] if len(sys.argv) > 2 else "mongomock (timings are only meaningful against a real mongod)"))
+    db = client.watchfulpi_bench
+    createIndexes(db.security_events)
+    fs = imageStore(db)
+    archive = tempfile.mkdtemp(prefix='watchful-archive-')
+
+    frames = syntheticFrames()[:BURST]
+    preview = derivative(frames[0], (480, 360))
+    thumb = derivative(frames[0], (320, 240))
+    now = datetime.datetime.utcnow()
+    started = monotonic()
+    for number in range(events):
+        event_id = str(ObjectId())
+        timestamp = now - datetime.timedelta(days=DAYS * number / events)
+        saveImage(fs, event_id, frames[0])
+        saveImage(fs, event_id, preview, size='preview')
+        saveImage(fs, event_id, thumb, size='thumb')
+        for frame in range(1, BURST):
+            saveImage(fs, event_id, frames[frame], size='frame' + str(frame))
+        db.security_events.insert_one({"_id": event_id, "sensor": SENSORS[number % len(SENSORS)], "timestamp": timestamp, "notes": "None", "burst_frames": BURST, "key_frame": 0, "image_size": len(frames[0])})
+    print("Stored %d events over %d days in %.1f s" % (events, DAYS, monotonic() - started))
+
+    setSensorPolicy(db, SENSORS[2], RetentionPolicy(30, 365, 'delete'))
+    documents, images = storageUsed(db)
+    print("Before: %d events with full images, %d with thumbnails; %.1f MB of documents, %.1f MB of images" % (tiers(db) + (documents / 1e6, images / 1e6)))
+
+    job = RetentionJob(db, RetentionPolicy(), archive_directory=archive, batch_size=100, pause=0)
+    started = monotonic()
+    result = job.runPass(now)
+    elapsed = monotonic() - started
+    after_documents, after_images = storageUsed(db)
+    print("After:  %d events with full images, %d with thumbnails; %.1f MB of documents, %.1f MB of images" % (tiers(db) + (after_documents / 1e6, after_images / 1e6)))
+    print("Pass:   %d events reduced to thumbnails, %d archived, %d deleted, %d set to expire in %.2f s; longest batch %.0f ms" % (result["compacted"], result["archived"], result["deleted"], job.expiring, elapsed, job.longest_batch * 1000))
+    measured = documents + images - after_documents - after_images
+    print("Reclaimed: %.1f MB (job's count) vs %.1f MB (measured)" % (result["bytes_reclaimed"] / 1e6, measured / 1e6))
+
+    archives = glob.glob(os.path.join(archive, '*', '*.jsonl.gz'))
+    archived = []
+    for path in archives:
+        with gzip.open(path, 'rt') as lines:
+            archived.extend(json_util.loads(line) for line in lines)
+    print("Archive: %d files, %.2f MB, %d events read back" % (len(archives), sum(os.path.getsize(path) for path in archives) / 1e6, len(archived)))
+
+    compacted = db.security_events.find_one({"retention": "thumbnail"})
+    image, image_id = loadImage(fs, db.security_events, compacted['_id'], 'original')
+    assert image and image_id.endswith('.thumb')
+    assert len(archived) == result["archived"] and all(event.get('thumbnail') for event in archived)
+    assert abs(measured - result["bytes_reclaimed"]) < 0.01 * measured
+
+    setSensorPolicy(db, SENSORS[0], RetentionPolicy(30, 180, 'delete'))
+    cutoff = now - datetime.timedelta(days=180)
+    past = db.security_events.count_documents({"sensor": SENSORS[0], "retention": "thumbnail", "timestamp": {"$lt": cutoff}})
+    result = job.runPass(now)
+    print("Switched a sensor from archive to delete after 180 days: %d of its events past that, %d deleted" % (past, result["deleted"]))
+    assert past and result["deleted"] == past
+    assert db.security_events.count_documents({"sensor": SENSORS[0], "timestamp": {"$lt": cutoff}}) == 0
+    shutil.rmtree(archive)
+
+if __name__ == "__main__":
+    main()
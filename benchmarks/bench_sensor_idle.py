@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+#Benchmark of the load an idle sensor puts on the hub's Redis, and of motion-to-publish latency, using the mock PIR sensor and camera from watchful_mock.py.
+#The mock camera doubles as a synthetic frame source for the warm camera, so the published event carries a burst of frames from around the trigger (publishing waits for the post-trigger frames).
+#Compares the old polling main loop (get_message() and set() on every pass) with the event-driven sensor in watchful_sensor.py.
+#Starts its own redis-server on a spare port, so redis-server must be on the PATH. Run from the repository root: python3 benchmarks/bench_sensor_idle.py [seconds]
+
+import os
+import subprocess
+import sys
+import threading
+from time import monotonic, sleep
+
+os.environ['WATCHFUL_MOCK_HARDWARE'] = '1'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import redis
+import watchful_sensor
+from watchful_events import decodeEvent
+from watchful_streams import streamKey
+
+PORT = 6391
+
+def commandsProcessed(connection):
+    return int(connection.info('stats')['total_commands_processed'])
+
+#Measure Redis commands per second while 'target' runs in a background thread for 'seconds'. The INFO calls used to measure are subtracted.
+def opsPerSecond(connection, target, seconds):
+    threading.Thread(target=target, daemon=True).start()
+    sleep(0.5)
+    before = commandsProcessed(connection)
+    sleep(seconds)
+    after = commandsProcessed(connection)
+    return (after - before - 1) / seconds
+
+#The old sensor main loop, minus the motion check: poll for a command, then write the mode, as fast as possible.
+def legacyLoop(stop):
+    connection = redis.StrictRedis(host='127.0.0.1', port=PORT, db=0)
+    pubsub = connection.pubsub()
+    pubsub.subscribe('watchful_commands')
+    while not stop.is_set():
+        pubsub.get_message()
+        connection.set('legacy-sensor', 0)
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    server = subprocess.Popen(['redis-server', '--port', str(PORT), '--save', ''], stdout=subprocess.DEVNULL)
+    try:
+        connection = redis.StrictRedis(host='127.0.0.1', port=PORT, db=0)
+        for attempt in range(50):
+            try:
+                connection.ping()
+                break
+            except redis.ConnectionError:
+                sleep(0.1)
+
+        stop = threading.Event()
+        legacy = opsPerSecond(connection, lambda: legacyLoop(stop), seconds)
+        stop.set()
+        sleep(0.5)
+
+        watchful_sensor.connectToHub('127.0.0.1', PORT)
+        event_driven = opsPerSecond(connection, watchful_sensor.run, seconds)
+        print("Idle Redis ops/sec, polling loop:     %.0f" % legacy)
+        print("Idle Redis ops/sec, event-driven:     %.2f" % event_driven)
+
+        #Put the sensor into sensing mode, then time how long it takes from the PIR callback firing to the event arriving on the sensor's event stream.
+        connection.publish('watchful_commands', watchful_sensor.sensorId + ':1')
+        sleep(watchful_sensor.preTriggerFrames / watchful_sensor.burstFramerate + 0.5)
+        watchful_sensor.pirSensor.trigger(duration=0.1)
+        started = monotonic()
+        response = connection.xread({streamKey(watchful_sensor.sensorId): '0'}, count=1, block=5000)
+        print("Motion to published burst:            %.1f ms" % ((monotonic() - started) * 1000))
+        entry_id, fields = response[0][1][0]
+        event = decodeEvent(fields[b'event'])
+        print("Frames in burst:                      %d (key frame %d)" % (len(event.get('burst', [event['captured_image']])), event.get('key_frame', 0)))
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
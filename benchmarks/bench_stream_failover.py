@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+#Failure-injection test for event delivery over Redis Streams (watchful_streams.py), against a real local redis-server.
+#Injects the failures that lost events with pubsub -- the hub not running when sensors publish, and hub processes dying between reading an event and storing it --
+#plus an event that can never be processed, and checks that every event is still stored exactly once (duplicates are delivered, but storing is idempotent, as it is in the hub).
+#Also spreads events across two concurrent hub workers. Starts its own redis-server on a spare port, so redis-server must be on the PATH.
+#Run from the repository root: python3 benchmarks/bench_stream_failover.py [events]
+
+import os
+import subprocess
+import sys
+import threading
+from time import monotonic, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import redis
+from watchful_streams import EventConsumer, publishEvent
+
+PORT = 6392
+SENSORS = ['5e4503' + format(number, '018x') for number in range(4)]
+
+#Stands in for the hub's persistence stage: storing an event is idempotent, and the event is only acknowledged once it is stored.
+class Store:
+    def __init__(self):
+        self.stored = set()
+        self.deliveries = 0
+        self.lock = threading.Lock()
+
+    def process(self, consumer, entries, ack=True):
+        for stream, entry_id, data in entries:
+            with self.lock:
+                self.deliveries += 1
+                self.stored.add(data)
+            if ack:
+                consumer.ack(stream, entry_id)
+
+def publish(connection, first, count):
+    for number in range(first, first + count):
+        publishEvent(connection, SENSORS[number % len(SENSORS)], b'event-' + str(number).encode(), maxlen=10000)
+    return count
+
+#Read until nothing arrives for a whole read, processing everything.
+def drain(consumer, store):
+    while True:
+        entries = consumer.read()
+        if not entries:
+            return
+        store.process(consumer, entries)
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    server = subprocess.Popen(['redis-server', '--port', str(PORT), '--save', ''], stdout=subprocess.DEVNULL)
+    try:
+        connection = redis.StrictRedis(host='127.0.0.1', port=PORT, db=0)
+        for attempt in range(50):
+            try:
+                connection.ping()
+                break
+            except redis.ConnectionError:
+                sleep(0.1)
+        store = Store()
+        published = 0
+
+        #1. The hub isn't running when the sensors publish. With pubsub nobody would have received these.
+        receivers = connection.publish(SENSORS[0], b'event')
+        published += publish(connection, published, events // 4)
+        hub = EventConsumer(connection, 'hub', block=0.2)
+        hub.watch(hub.existingStreams())
+        drain(hub, store)
+        print("Published with no hub running:     %d (pubsub receivers: %d), stored %d" % (events // 4, receivers, len(store.stored)))
+
+        #2. The hub dies after reading a batch but before storing most of it, then restarts under the same name and re-reads its own pending events.
+        published += publish(connection, published, events // 4)
+        entries = hub.read()
+        store.process(hub, entries[:len(entries) // 4])
+        hub = EventConsumer(connection, 'hub', block=0.2)
+        hub.watch(SENSORS)
+        drain(hub, store)
+        print("Hub killed mid-batch, restarted:   %d read but not stored before the crash, stored %d" % (len(entries) - len(entries) // 4, len(store.stored)))
+
+        #3. A worker dies holding events (after storing some of them without acknowledging) and never comes back; another process claims them once they have been idle long enough.
+        published += publish(connection, published, events // 4)
+        worker = EventConsumer(connection, 'worker-1', block=0.2)
+        worker.watch(SENSORS)
+        entries = worker.read()
+        store.process(worker, entries[:len(entries) // 2], ack=False)
+        hub = EventConsumer(connection, 'hub', block=0.2, claim_idle=0.5)
+        hub.watch(SENSORS)
+        sleep(0.6)
+        started = monotonic()
+        claimed = hub.reclaim()
+        elapsed = monotonic() - started
+        store.process(hub, claimed)
+        drain(hub, store)
+        print("Worker killed, events claimed:     %d claimed in %.1f ms, stored %d" % (len(claimed), elapsed * 1000, len(store.stored)))
+
+        #4. An event that makes processing fail every time: it is retried, then dropped after max_deliveries rather than being retried forever.
+        publishEvent(connection, SENSORS[0], b'poison')
+        hub = EventConsumer(connection, 'hub', block=0.2, claim_idle=0.1, max_deliveries=3)
+        hub.watch(SENSORS)
+        attempts = len(hub.read())
+        while hub.dropped == 0:
+            sleep(0.15)
+            attempts += len(hub.reclaim())
+        print("Unprocessable event:               %d deliveries, then dropped" % attempts)
+
+        #5. Two workers read concurrently, sharing the events between them.
+        workers = [EventConsumer(connection, 'worker-' + str(number), block=0.2) for number in (2, 3)]
+        stores = [Store(), Store()]
+        for worker in workers:
+            worker.watch(SENSORS)
+        threads = [threading.Thread(target=drain, args=(worker, worker_store)) for worker, worker_store in zip(workers, stores)]
+        for thread in threads:
+            thread.start()
+        published += publish(connection, published, events - published)
+        for thread in threads:
+            thread.join()
+        for worker_store in stores:
+            store.stored |= worker_store.stored
+            store.deliveries += worker_store.deliveries
+        overlap = len(stores[0].stored & stores[1].stored)
+        print("Two workers:                       %d and %d events, %d delivered to both" % (len(stores[0].stored), len(stores[1].stored), overlap))
+
+        lost = published - len(store.stored)
+        left = sum(connection.xlen('events:' + sensor) for sensor in SENSORS)
+        print("Total:                             %d published, %d stored, %d lost, %d redelivered, %d left in the streams" % (published, len(store.stored), lost, store.deliveries - len(store.stored), left))
+        assert lost == 0 and left == 0 and b'poison' not in store.stored
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
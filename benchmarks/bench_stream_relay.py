@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+
+#Benchmark of the hub's video relay (watchful_relay.py) against a local fake of mjpg_streamer, which serves synthetic frames as an MJPEG stream at a fixed frame rate and counts its connections.
+#First measures the MJPEG parser on its own. Then compares N viewers connecting straight to the "sensor" (as browsers did before the relay) with N viewers watching through one StreamRelay,
+#one of which is slow and can only take a few frames a second: the sensor's connections and upload, the frames each fast viewer gets, and what the slow viewer gets and skips.
+#Finally checks that the relay's connection to the sensor is closed once the last viewer has gone.
+#Needs Pillow. Run from the repository root: python3 benchmarks/bench_stream_relay.py [viewers] [seconds] [frames per second]
+
+import os
+import socket
+import sys
+import threading
+import timeit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from watchful_mock import syntheticFrames
+from watchful_relay import StreamRelays, mjpegFrames
+
+BOUNDARY = b'boundarydonotcross'
+FRAMES = syntheticFrames()
+
+def part(frame):
+    return b'--' + BOUNDARY + b'\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(frame)).encode() + b'\r\n\r\n' + frame + b'\r\n'
+
+#Stands in for mjpg_streamer: an HTTP/1.0 multipart/x-mixed-replace response with a new frame every 1/framerate seconds, until the client goes away.
+class FakeMjpegStreamer(BaseHTTPRequestHandler):
+    framerate = 15
+    connections = 0
+    open_connections = 0
+    bytes_sent = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            FakeMjpegStreamer.connections += 1
+            FakeMjpegStreamer.open_connections += 1
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace;boundary=' + BOUNDARY.decode())
+            self.end_headers()
+            number = 0
+            started = monotonic()
+            while True:
+                data = part(FRAMES[number % len(FRAMES)])
+                self.wfile.write(data)
+                with self.lock:
+                    FakeMjpegStreamer.bytes_sent += len(data)
+                number += 1
+                sleep(max(0.0, started + number / self.framerate - monotonic()))
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                FakeMjpegStreamer.open_connections -= 1
+
+    def log_message(self, *args):
+        pass
+
+#A viewer connecting straight to the sensor, reading frames as fast as they come for 'seconds'.
+def directViewer(port, seconds, counts):
+    connection = socket.create_connection(('127.0.0.1', port))
+    connection.sendall(b'GET /?action=stream HTTP/1.0\r\n\r\n')
+    response = b''
+    while b'\r\n\r\n' not in response:
+        response += connection.recv(4096)
+    body = response.split(b'\r\n\r\n', 1)[1]
+    deadline = monotonic() + seconds
+    frames = 0
+    for frame in mjpegFrames(connection.recv_into, BOUNDARY, body):
+        frames += 1
+        if monotonic() >= deadline:
+            break
+    connection.close()
+    counts.append(frames)
+
+#A viewer watching through the relay, taking a frame at most every 'delay' seconds.
+def relayViewer(relays, url, seconds, delay, counts):
+    relay = relays.join('sensor', url)
+    deadline = monotonic() + seconds
+    frames = 0
+    skipped = []
+    try:
+        for frame in relay.frames(skipped=skipped.append):
+            frames += 1
+            if monotonic() >= deadline:
+                break
+            if delay:
+                sleep(delay)
+    finally:
+        relays.leave('sensor', relay)
+    counts.append((frames, sum(skipped)))
+
+def run(threads):
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def main():
+    viewers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    FakeMjpegStreamer.framerate = float(sys.argv[3]) if len(sys.argv) > 3 else 15
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeMjpegStreamer)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    url = 'http://127.0.0.1:' + str(port) + '/?action=stream'
+
+    stream = b''.join(part(frame) for frame in FRAMES)
+    def parse():
+        position = [0]
+        def readinto(buffer):
+            count = min(len(buffer), len(stream) - position[0])
+            buffer[:count] = stream[position[0]:position[0] + count]
+            position[0] += count
+            return count
+        return sum(1 for frame in mjpegFrames(readinto, BOUNDARY))
+    per_frame = timeit.timeit(parse, number=20) / (20 * len(FRAMES))
+    print("Parser: %.1f us per %d KB frame (%.0f MB/s)" % (per_frame * 1e6, len(stream) / len(FRAMES) / 1024, len(stream) / len(FRAMES) / per_frame / 1e6))
+
+    counts = []
+    run([threading.Thread(target=directViewer, args=(port, seconds, counts)) for _ in range(viewers)])
+    print("Direct: %d viewers, %d connections to the sensor, %.1f MB uploaded by the sensor, %.1f frames/s per viewer" % (viewers, FakeMjpegStreamer.connections, FakeMjpegStreamer.bytes_sent / 1e6, sum(counts) / len(counts) / seconds))
+    sleep(0.5)
+
+    FakeMjpegStreamer.connections = 0
+    FakeMjpegStreamer.bytes_sent = 0
+    relays = StreamRelays()
+    counts = []
+    slow = []
+    threads = [threading.Thread(target=relayViewer, args=(relays, url, seconds, 0, counts)) for _ in range(viewers - 1)]
+    threads.append(threading.Thread(target=relayViewer, args=(relays, url, seconds, 0.25, slow)))
+    run(threads)
+    fast = [frames for frames, skipped in counts]
+    print("Relay:  %d viewers, %d connections to the sensor, %.1f MB uploaded by the sensor, %.1f frames/s per fast viewer (min %.1f)" % (viewers, FakeMjpegStreamer.connections, FakeMjpegStreamer.bytes_sent / 1e6, sum(fast) / len(fast) / seconds, min(fast) / seconds))
+    print("        slow viewer: %.1f frames/s, %d frames skipped" % (slow[0][0] / seconds, slow[0][1]))
+
+    started = monotonic()
+    while FakeMjpegStreamer.open_connections and monotonic() - started < 5:
+        sleep(0.01)
+    print("Upstream closed %.0f ms after the last viewer left, %d relays left" % ((monotonic() - started) * 1000, relays.stats()["upstreams"]))
+    assert FakeMjpegStreamer.connections == 1 and FakeMjpegStreamer.open_connections == 0
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+#Micro-benchmark comparing the legacy event format (str() of the event dict with a base64 image, parsed with ast.literal_eval) against the binary wire format in watchful_events.py.
+#Reports encode/decode latency and bytes on the wire for a range of image sizes. Run from the repository root: python3 benchmarks/bench_wire_format.py
+
+import ast
+import base64
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from watchful_events import encodeEvent, decodeEvent
+
+SENSOR_ID = '5f0c6e1f9d3b4a2c8e7f6a5b'
+EVENT_ID = '5f0c6e1f9d3b4a2c8e7f6a5c'
+
+def legacyEncode(image):
+    return str({"_id": EVENT_ID, "sensor": SENSOR_ID, "timestamp": str(datetime.datetime.utcnow()), "captured_image": base64.b64encode(image)}).encode()
+
+def legacyDecode(data):
+    event = ast.literal_eval(data.decode('UTF-8'))
+    base64.b64decode(event['captured_image'])
+    return event
+
+def binaryEncode(image):
+    return encodeEvent({"_id": EVENT_ID, "sensor": SENSOR_ID, "timestamp": datetime.datetime.utcnow(), "captured_image": image})
+
+def measure(function, argument, repeat):
+    return min(timeit.repeat(lambda: function(argument), number=repeat, repeat=5)) / repeat * 1000
+
+def main():
+    print("%-10s %-8s %12s %12s %12s" % ("image", "format", "wire bytes", "encode ms", "decode ms"))
+    for size in (50_000, 150_000, 400_000):
+        #JPEG data is effectively incompressible, so random bytes are a fair stand-in for a captured frame.
+        image = os.urandom(size)
+        repeat = max(5, 2_000_000 // size)
+        legacy = legacyEncode(image)
+        binary = binaryEncode(image)
+        assert decodeEvent(legacy)['captured_image'] == image
+        assert decodeEvent(binary)['captured_image'] == image
+        print("%-10s %-8s %12d %12.3f %12.3f" % (str(size // 1000) + "KB", "legacy", len(legacy), measure(legacyEncode, image, repeat), measure(legacyDecode, legacy, repeat)))
+        print("%-10s %-8s %12d %12.3f %12.3f" % (str(size // 1000) + "KB", "binary", len(binary), measure(binaryEncode, image, repeat), measure(decodeEvent, binary, repeat)))
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,5 @@
 #!/bin/bash
 
-# Start the hub program in background mode
-./watchful_hub.py &
-
-#Wait 20 seconds (the maximum amount of time discovery could take with current settings)
-sleep 20
-
-#Start the Flask web interface/API app
-./watchful_interface.py
\ No newline at end of file
+#Start the hub program and the Flask web interface/API app together. The supervisor starts both at once, logs how long each took to be ready, and restarts either one if it exits.
+#Neither waits a fixed time for the other: each one probes Redis and MongoDB until they answer.
+exec ./watchful_supervisor.py
@@ -1,80 +1,190 @@
-//Send a request to the hub API to get a JSON object with all sensors, iterate through the sensors and for each one, populate a div element with the sensor information and controls, and append it to the dashboard page
-function getSensors() {
-    let xhr = new XMLHttpRequest();
-    xhr.open("GET", "/api/sensor/all", false);
-    xhr.send();
-    var jsonObject = JSON.parse(xhr.responseText);
-    var sensors = jsonObject.sensors
-    var outerdiv = document.getElementById('outer');
+//Text shown for each sensor mode
+var modeNames = {"0": "Standby", "1": "Sensing", "2": "Streaming"};
+
+function modeName(mode) {
+    return modeNames[mode] || 'Not available';
+}
+
+//Send a request to the hub API to get a JSON object with all sensors, iterate through the sensors and for each one, populate a div element with the sensor information and controls, and add it to the dashboard page
+//Sensors already on the page are updated in place, and sensors that have gone are removed. Called when the dashboard loads, and again whenever the update stream asks for a resync.
+async function getSensors() {
+    let response = await fetch("/api/sensor/all");
+    let jsonObject = await response.json();
+    let sensors = jsonObject.sensors || {};
+    for (var div of document.querySelectorAll('.sensor'))
+    {
+        if (!(div.dataset.sensor in sensors)) {div.remove()}
+    }
     for (var sensor of Object.keys(sensors))
-    {   
-        if (sensors[sensor]["mode"] == 0) {var status_ = 'Standby'}
-        else if (sensors[sensor]["mode"] == 1) {var status_ = 'Sensing'}
-        else if (sensors[sensor]["mode"] == 2) {var status_ = 'Streaming'}
-        else {let status = 'Not available'}
-        var innerdiv = document.createElement("div")
-        innerdiv.className = "ui stacked segment"
-        innerdiv.innerHTML = 
-        '<h1>' + sensor + '</h1><p>IP: ' + sensors[sensor]["ip"] + '<br>Status: ' + status_ +
-        '</p><a href="/' + sensor + '/eventsview" class="ui icon button"><i class ="icon folder"></i></a>' +
-        '<a href="/' + sensor + '/streamview" class="ui icon button"><i class ="icon camera"></i></a>' +
-        '<button class="ui right floated button" onclick=standby("' + sensor + '")>Standby</button>' +
-        '<button class="ui right floated button" onclick=sense("' + sensor + '")>Sense</button>' +
-        '<button class="ui right floated button" onclick=stream("' + sensor + '")>Stream</button>'
-        outerdiv.appendChild(innerdiv)
+    {
+        showSensor(sensor, sensors[sensor]["ip"], sensors[sensor]["mode"]);
+    }
+}
+
+//Add a sensor's segment to the dashboard, or update it if it is already there (mode is null when only the IP address is known)
+function showSensor(sensor, ip, mode) {
+    var innerdiv = document.getElementById('sensor-' + sensor)
+    if (innerdiv) {
+        innerdiv.querySelector('.ip').textContent = ip
+        if (mode !== null) {innerdiv.querySelector('.status').textContent = modeName(mode)}
+        return
+    }
+    innerdiv = document.createElement("div")
+    innerdiv.id = 'sensor-' + sensor
+    innerdiv.dataset.sensor = sensor
+    innerdiv.className = "ui stacked segment sensor"
+    innerdiv.innerHTML =
+    '<h1>' + sensor + '</h1><p>IP: <span class="ip"></span><br>Status: <span class="status"></span>' +
+    '</p><a href="/' + sensor + '/eventsview" class="ui icon button"><i class ="icon folder"></i></a>' +
+    '<a href="/' + sensor + '/streamview" class="ui icon button"><i class ="icon camera"></i></a>' +
+    '<button class="ui right floated button" onclick=standby("' + sensor + '")>Standby</button>' +
+    '<button class="ui right floated button" onclick=sense("' + sensor + '")>Sense</button>' +
+    '<button class="ui right floated button" onclick=stream("' + sensor + '")>Stream</button>' +
+    '<span class="latest"></span>'
+    innerdiv.querySelector('.ip').textContent = ip
+    innerdiv.querySelector('.status').textContent = modeName(mode)
+    document.getElementById('outer').appendChild(innerdiv)
+    latestEvent(sensor)
+}
+
+//Update the status shown for a sensor, if it is on the page
+function showMode(sensor, mode) {
+    var innerdiv = document.getElementById('sensor-' + sensor)
+    if (innerdiv) {innerdiv.querySelector('.status').textContent = modeName(mode)}
+}
+
+//Show an event's thumbnail as the latest event in its sensor's dashboard segment
+function showLatest(event) {
+    var innerdiv = document.getElementById('sensor-' + event.sensor)
+    if (!innerdiv) {return}
+    var latest = document.createElement("a")
+    latest.href = "/" + event.sensor + "/eventsview"
+    latest.innerHTML = '<img class="ui small image" alt="Latest event"/>'
+    latest.querySelector('img').src = event.image
+    latest.querySelector('img').title = 'Latest event: ' + event.timestamp.replace('T', ' ') + ' UTC'
+    innerdiv.querySelector('.latest').replaceChildren(latest)
+}
+
+//Fetch the most recent event for a sensor from the hub API and add its thumbnail to the sensor's dashboard segment
+async function latestEvent(sensor) {
+    let response = await fetch("/api/sensor/" + sensor + "/events?limit=1");
+    let page = await response.json();
+    if (page.events.length > 0) {showLatest(page.events[0])}
+}
+
+//How long to wait before opening the update stream again when the interface has turned it away (it asks for 30 seconds in its Retry-After header)
+var streamRetryDelay = 30000;
+
+//Open the update stream from the hub API and keep the dashboard up to date from it: sensor modes, sensors coming and going, and the latest event for each sensor
+//The browser reconnects by itself if the stream drops; the state is reloaded when it does, in case anything was missed.
+//If the interface turns the stream away because it has too many open already, the browser gives up on it, so the page tries again in a while (and reloads the state then).
+function watchSensors() {
+    let updates = new EventSource("/api/stream");
+    let reconnecting = false;
+    updates.addEventListener('mode', message => {
+        let update = JSON.parse(message.data);
+        showMode(update.sensor, update.mode);
+    });
+    updates.addEventListener('sensor', message => {
+        let update = JSON.parse(message.data);
+        showSensor(update.sensor, update.ip, null);
+    });
+    updates.addEventListener('lost', message => {
+        let div = document.getElementById('sensor-' + JSON.parse(message.data).sensor);
+        if (div) {div.remove()}
+    });
+    updates.addEventListener('event', message => showLatest(JSON.parse(message.data).event));
+    updates.addEventListener('resync', () => getSensors());
+    updates.onerror = () => {
+        reconnecting = true;
+        if (updates.readyState == EventSource.CLOSED) {setTimeout(() => {getSensors(); watchSensors()}, streamRetryDelay)}
+    };
+    updates.onopen = () => {if (reconnecting) {reconnecting = false; getSensors()}};
+}
+
+//Send a request to the hub API to change the mode of a single sensor (or all sensors, if sensor is 'all') and show the result without reloading the page
+async function setMode(sensor, mode) {
+    let response = await fetch("/api/sensor/" + sensor + "?mode=" + mode, {method: "POST"});
+    let jsonObject = await response.json();
+    console.log(jsonObject);
+    let sensors = sensor == 'all' ? (jsonObject.sensors || {}) : jsonObject;
+    for (var id of Object.keys(sensors))
+    {
+        showMode(id, sensors[id]["mode"]);
     }
 }
 
 //Send a request to the hub API to put a single sensor in standby mode
 function standby(sensor) {
-    let xhr = new XMLHttpRequest();
-    xhr.open("POST", "/api/sensor/" + sensor + "?mode=0", false);
-    xhr.send();
-    console.log(xhr.responseText);
-    location.reload();
+    setMode(sensor, 0);
 }
 
 //Send a request to the hub API to put a single sensor in sense mode
 function sense(sensor) {
-    let xhr = new XMLHttpRequest();
-    xhr.open("POST", "/api/sensor/" + sensor + "?mode=1", false);
-    xhr.send();
-    console.log(xhr.responseText);
-    location.reload();
+    setMode(sensor, 1);
 }
 
 //Send a request to the hub API to put a single sensor in streaming mode
 function stream(sensor) {
-    let xhr = new XMLHttpRequest();
-    xhr.open("POST", "/api/sensor/" + sensor + "?mode=2", false);
-    xhr.send();
-    console.log(xhr.responseText);
-    location.reload();
+    setMode(sensor, 2);
 }
 
 //Send a request to the hub API to put a all sensors in standby mode
 function allStandby() {
-    let xhr = new XMLHttpRequest();
-    xhr.open("POST", "/api/sensor/all?mode=0", false);
-    xhr.send();
-    console.log(xhr.responseText);
-    location.reload();
+    setMode('all', 0);
 }
 
 //Send a request to the hub API to put a all sensors in sense mode
 function allSense() {
-    let xhr = new XMLHttpRequest();
-    xhr.open("POST", "/api/sensor/all?mode=1", false);
-    xhr.send();
-    console.log(xhr.responseText);
-    location.reload();
+    setMode('all', 1);
 }
 
 //Send a request to the hub API to put a all sensors in streaming mode
 function allStream() {
-    let xhr = new XMLHttpRequest();
-    xhr.open("POST", "/api/sensor/all?mode=2", false);
-    xhr.send();
-    console.log(xhr.responseText);
-    location.reload();
-}
\ No newline at end of file
+    setMode('all', 2);
+}
+
+//Cursor for the next page of events (null until the first page is loaded, and again once there are no more pages)
+var eventsCursor = null;
+
+//Build the events grid column for an event
+function eventColumn(event) {
+    var column = document.createElement("div")
+    column.className = "column"
+    column.innerHTML =
+    '<a><img class="ui image" alt="Event image" width="320" height="240" loading="lazy"/></a>' +
+    '<div>Time: <span class="timestamp"></span> UTC</div>' +
+    '<div>Notes: <span class="notes"></span></div>'
+    column.querySelector('a').href = event.original
+    column.querySelector('img').src = event.image
+    column.querySelector('.timestamp').textContent = event.timestamp.replace('T', ' ')
+    column.querySelector('.notes').textContent = event.notes
+    return column
+}
+
+//Fetch the next page of events for a sensor from the hub API and append them to the events grid. Hides the 'Load more' button when there are no more events.
+async function loadEvents(sensor) {
+    var url = "/api/sensor/" + sensor + "/events";
+    if (eventsCursor) {url += "?cursor=" + encodeURIComponent(eventsCursor)}
+    let response = await fetch(url);
+    let page = await response.json();
+    var grid = document.getElementById('events');
+    for (var event of page.events)
+    {
+        grid.appendChild(eventColumn(event))
+    }
+    eventsCursor = page.next;
+    document.getElementById('more').style.display = eventsCursor ? '' : 'none';
+}
+
+//Open the update stream from the hub API and add new events for a sensor to the top of the events grid as they are stored (trying again in a while if the stream was turned away, as above)
+function watchEvents(sensor) {
+    let updates = new EventSource("/api/stream");
+    updates.onerror = () => {
+        if (updates.readyState == EventSource.CLOSED) {setTimeout(() => watchEvents(sensor), streamRetryDelay)}
+    };
+    updates.addEventListener('event', message => {
+        let event = JSON.parse(message.data).event;
+        if (event.sensor == sensor) {document.getElementById('events').prepend(eventColumn(event))}
+    });
+}
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+
+import logging
+import queue
+import threading
+from time import monotonic
+from watchful_metrics import REGISTRY
+
+#Sentinel placed on the dispatcher's queue to tell it to flush and exit.
+_STOP = object()
+
+#How long each email takes to send, including reconnecting if the connection had dropped.
+SEND_SECONDS = REGISTRY.histogram('watchful_alert_send_seconds', 'Time to send one alert email over SMTP')
+
+#Define the AlertDispatcher class, which sends email alerts from its own thread so SMTP never holds up event ingest.
+#It keeps one authenticated SMTP connection open and reuses it for every email, reconnecting if the server drops it.
+#Alerts for the same sensor and recipient that arrive within 'window' seconds of each other are coalesced into one digest email with a thumbnail per event,
+#and each recipient gets at most 'rate_limit' emails per 'rate_period' seconds -- while a recipient is over the limit their alerts keep collecting into the next digest instead of being dropped.
+class AlertDispatcher:
+    def __init__(self, host, port, user, password, sender, window=30.0, rate_limit=10, rate_period=3600.0, starttls=False, timeout=30.0):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.sender = sender
+        self.window = window
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.starttls = starttls
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.pending = {}
+        self.buckets = {}
+        self.connection = None
+        self.thread = None
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+        self.thread.start()
+
+    #Stop the dispatcher, sending any alerts still waiting for their window to close.
+    def stop(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    #Queue an alert for an event. Returns immediately; the email goes out when the sensor's window closes.
+    def submit(self, recipient, event):
+        self.queue.put((recipient, {
+            "sensor": event['sensor'],
+            "timestamp": event['timestamp'],
+            "notes": event['notes'],
+            "thumb": event['derivatives']['thumb'],
+            "preview": event['derivatives']['preview']
+        }))
+
+    def stats(self):
+        return {"sent": self.sent, "failed": self.failed, "coalesced": self.coalesced, "pending": sum(len(digest["events"]) for digest in self.pending.values())}
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.pending:
+                timeout = max(0.0, min(digest["deadline"] for digest in self.pending.values()) - monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._flush(force=True)
+                self._disconnect()
+                break
+            if item:
+                recipient, alert = item
+                key = (recipient, alert["sensor"])
+                if key in self.pending:
+                    self.pending[key]["events"].append(alert)
+                    self.coalesced += 1
+                else:
+                    self.pending[key] = {"deadline": monotonic() + self.window, "events": [alert]}
+            self._flush()
+
+    #Send every digest whose window has closed. A digest for a recipient who is over their rate limit is pushed back until they have allowance again.
+    def _flush(self, force=False):
+        now = monotonic()
+        for key, digest in list(self.pending.items()):
+            if digest["deadline"] > now and not force:
+                continue
+            recipient, sensor = key
+            wait = self._takeToken(recipient, now)
+            if wait > 0 and not force:
+                digest["deadline"] = now + wait
+                continue
+            del self.pending[key]
+            self._send(recipient, self._buildMessage(recipient, sensor, digest["events"]))
+
+    #Token bucket per recipient: 'rate_limit' tokens, refilled evenly over 'rate_period' seconds. Returns 0 if a token was taken, otherwise how long until one is available.
+    def _takeToken(self, recipient, now):
+        tokens, updated = self.buckets.get(recipient, (float(self.rate_limit), now))
+        tokens = min(float(self.rate_limit), tokens + (now - updated) * self.rate_limit / self.rate_period)
+        if tokens >= 1:
+            self.buckets[recipient] = (tokens - 1, now)
+            return 0
+        self.buckets[recipient] = (tokens, now)
+        return (1 - tokens) * self.rate_period / self.rate_limit
+
+    #A single event gets the same email as before, with the preview image attached. Several events get a digest listing each one, with its thumbnail attached.
+    def _buildMessage(self, recipient, sensor, events):
+        from email.mime.text import MIMEText
+        from email.mime.image import MIMEImage
+        from email.mime.multipart import MIMEMultipart
+        msg = MIMEMultipart()
+        if len(events) == 1:
+            event = events[0]
+            msg['Subject'] = 'An alert from watchful Pi'
+            msg.attach(MIMEText("Hi, this alert fired at " + str(event['timestamp']) + "\n\nNotes: " + event['notes']))
+            attachments = [("image.jpg", event['preview'])]
+        else:
+            msg['Subject'] = str(len(events)) + ' alerts from watchful Pi sensor ' + sensor
+            lines = ["Hi, sensor " + sensor + " fired " + str(len(events)) + " alerts:", ""]
+            attachments = []
+            for number, event in enumerate(events, start=1):
+                lines.append(str(number) + ". " + str(event['timestamp']) + " -- Notes: " + event['notes'])
+                attachments.append(("event" + str(number) + ".jpg", event['thumb']))
+            msg.attach(MIMEText("\n".join(lines)))
+        for filename, image in attachments:
+            msgImage = MIMEImage(image, 'jpeg')
+            msgImage['Content-Disposition'] = 'attachment; filename="' + filename + '"'
+            msg.attach(msgImage)
+        msg['From'] = self.sender
+        msg['To'] = recipient
+        return msg
+
+    #smtplib and the email package are only imported when the first alert is sent, so they don't add to the hub's start up time.
+    def _connect(self):
+        import smtplib
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            connection.starttls()
+        if self.user:
+            connection.login(self.user, self.password)
+        self.connection = connection
+
+    def _disconnect(self):
+        import smtplib
+        if self.connection:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+    #Send a message over the persistent connection. If the connection has gone stale (the server closed it while idle, say), reconnect and try once more.
+    def _send(self, recipient, msg):
+        import smtplib
+        with SEND_SECONDS.time():
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self._connect()
+                    self.connection.sendmail(self.sender, recipient, msg.as_string())
+                    self.sent += 1
+                    return
+                except (smtplib.SMTPException, OSError):
+                    self.connection = None
+                    if attempt == 1:
+                        logging.exception("Failed to send alert email to " + recipient)
+            self.failed += 1
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+import json
+import logging
+import queue
+import threading
+import redis
+from time import sleep
+
+#Define the Client class, which holds the updates waiting to be sent to one connected browser.
+#The queue is bounded so a slow or stalled browser can't make the interface buffer updates without limit. If it fills up, further updates are dropped
+#and the client is marked 'lagging'; the next thing it is sent is a 'resync' event telling it to reload its state from the API.
+class Client:
+    def __init__(self, maxsize):
+        self.updates = queue.Queue(maxsize=maxsize)
+        self.lagging = False
+
+    def offer(self, update):
+        if self.lagging:
+            return
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            self.lagging = True
+
+    #Return the next update formatted as a server-sent event, or None if nothing arrived within 'timeout' seconds.
+    def next(self, timeout):
+        if self.lagging and self.updates.empty():
+            self.lagging = False
+            return formatEvent('resync', {})
+        try:
+            return self.updates.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+def formatEvent(event_type, data):
+    return "event: " + event_type + "\ndata: " + json.dumps(data) + "\n\n"
+
+#Define the UpdateBroadcaster class, which relays updates published on a Redis channel to every connected browser.
+#However many browsers are connected, there is a single Redis subscription and a single thread reading it; each update is formatted once and offered to every client's queue.
+#Updates on the channel are JSON objects with a 'type' field ('mode', 'event', 'sensor' or 'lost'). 'handler', if given, is called with each update from the broadcaster's thread
+#and returns the update to send to browsers (or None to drop it), so the interface can invalidate caches or add to an update before it goes out.
+class UpdateBroadcaster:
+    def __init__(self, connection, channel, handler=None, client_queue_size=64):
+        self.connection = connection
+        self.channel = channel
+        self.handler = handler
+        self.client_queue_size = client_queue_size
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    #Register a new browser and return its Client. The Redis subscription is only started once the first browser connects.
+    def subscribe(self):
+        client = Client(self.client_queue_size)
+        with self.lock:
+            self.clients.add(client)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._listen, name="broadcaster", daemon=True)
+                self.thread.start()
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def stats(self):
+        with self.lock:
+            return {"clients": len(self.clients), "lagging": sum(1 for client in self.clients if client.lagging)}
+
+    def broadcast(self, event_type, data):
+        update = formatEvent(event_type, data)
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.offer(update)
+
+    #Read the channel for as long as the interface runs. If the connection to Redis drops, reconnect and tell every browser to resync, since updates may have been missed in the meantime.
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self._relay(message['data'])
+            except redis.ConnectionError:
+                logging.info("Lost the Redis subscription to " + self.channel + ", reconnecting")
+                sleep(1)
+                self.broadcast('resync', {})
+
+    def _relay(self, data):
+        try:
+            update = json.loads(data)
+            if self.handler:
+                update = self.handler(update)
+            if update is not None:
+                self.broadcast(update['type'], update)
+        except Exception:
+            logging.exception("Could not relay update " + repr(data))
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+import collections
+import logging
+import threading
+from io import BytesIO
+
+#Define the FrameBuffer class: a fixed-size, in-memory ring buffer of the most recent JPEG frames from the camera.
+#'count' is the total number of frames ever added, so callers can tell which frames arrived after a given moment.
+class FrameBuffer:
+    def __init__(self, size):
+        self.frames = collections.deque(maxlen=size)
+        self.condition = threading.Condition()
+        self.count = 0
+
+    def append(self, frame):
+        with self.condition:
+            self.frames.append(frame)
+            self.count += 1
+            self.condition.notify_all()
+
+    #Return a burst of frames around "now": up to 'pre' frames already in the buffer, followed by the next 'post' frames (waiting up to 'timeout' seconds for them).
+    #Also returns the index of the key frame -- the first frame captured after the trigger, or the latest one before it if no new frame arrived in time.
+    def burst(self, pre, post, timeout):
+        with self.condition:
+            trigger = self.count
+            before = list(self.frames)[-pre:] if pre else []
+            self.condition.wait_for(lambda: self.count >= trigger + post, timeout)
+            arrived = min(self.count - trigger, len(self.frames))
+            after = list(self.frames)[len(self.frames) - arrived:][:post] if arrived else []
+        frames = before + after
+        if not frames:
+            return [], None
+        return frames, len(before) if after else len(before) - 1
+
+#Define the PiCameraSource class, which keeps a camera open and yields a continuous stream of JPEG frames from its video port.
+#'camera_class' is PiCamera on a Raspberry Pi, or MockCamera from watchful_mock.py for a synthetic frame source anywhere else.
+class PiCameraSource:
+    def __init__(self, camera_class, resolution=(640, 480), framerate=4):
+        self.camera = camera_class(resolution=resolution, framerate=framerate)
+
+    def frames(self):
+        stream = BytesIO()
+        for _ in self.camera.capture_continuous(stream, format='jpeg', use_video_port=True):
+            yield stream.getvalue()
+            stream.seek(0)
+            stream.truncate()
+
+    def close(self):
+        self.camera.close()
+
+#Define the WarmCamera class, which keeps the camera open while the sensor is sensing and continuously feeds its frames into a FrameBuffer, so that when motion is detected
+#the frames from just before and just after the trigger are already there -- no waiting for the camera to start up and settle its exposure.
+#'source_factory' is called to open a frame source (anything with frames() and close()) each time the camera is started. If 'on_frame' is given, it is called with each frame after it is buffered (from the capture thread).
+class WarmCamera:
+    def __init__(self, source_factory, buffer_size=16, on_frame=None):
+        self.source_factory = source_factory
+        self.on_frame = on_frame
+        self.buffer = FrameBuffer(buffer_size)
+        self.source = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.stopping.clear()
+            self.source = self.source_factory()
+            self.thread = threading.Thread(target=self._capture, name="camera", daemon=True)
+            self.thread.start()
+
+    #Stop capturing and close the camera (e.g. so mjpg_streamer can use it).
+    def stop(self):
+        with self.lock:
+            if not self.thread:
+                return
+            self.stopping.set()
+            self.thread.join()
+            self.source.close()
+            self.thread = None
+            self.source = None
+
+    def burst(self, pre, post, timeout=5.0):
+        return self.buffer.burst(pre, post, timeout)
+
+    def _capture(self):
+        try:
+            for frame in self.source.frames():
+                if self.stopping.is_set():
+                    break
+                self.buffer.append(frame)
+                if self.on_frame:
+                    self.on_frame(frame)
+        except Exception:
+            logging.exception("Camera capture stopped")
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from time import monotonic
+
+#Pillow is imported by the functions that use it rather than at the top, so it doesn't add to the hub's start up time.
+
+#Face detection backends used by the hub. Every backend has a detect() method that takes raw JPEG bytes and returns a list of detected faces.
+#Each face is a dict with 'left', 'top', 'width' and 'height' (the face rectangle in pixels) and, if the backend can guess them, 'age' and 'gender'.
+
+class Detector:
+    def detect(self, image):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+#Backend that sends images to Azure Face API. A single requests.Session is reused for every call so the TLS connection to Azure stays open between events,
+#every request has a timeout so a hung call can't stall the pipeline, and the JSON response is parsed once.
+class AzureFaceDetector(Detector):
+    def __init__(self, endpoint, subscription_key, timeout=10.0, pool_size=4):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.headers.update({
+            'Ocp-Apim-Subscription-Key': subscription_key,
+            'Content-Type': 'application/octet-stream'
+        })
+        self.params = {
+            'detectionModel': 'detection_01',
+            'returnFaceId': 'true',
+            'returnFaceAttributes': 'age,gender'
+        }
+
+    def detect(self, image):
+        response = self.session.post(self.endpoint, params=self.params, data=image, timeout=self.timeout)
+        response.raise_for_status()
+        faces = []
+        for face in response.json():
+            rectangle = face.get("faceRectangle", {})
+            attributes = face.get("faceAttributes") or {}
+            faces.append({
+                "left": rectangle.get("left", 0),
+                "top": rectangle.get("top", 0),
+                "width": rectangle.get("width", 0),
+                "height": rectangle.get("height", 0),
+                "age": attributes.get("age"),
+                "gender": attributes.get("gender")
+            })
+        return faces
+
+    def close(self):
+        self.session.close()
+
+#The Haar cascade is loaded once per worker process and kept for the life of the process.
+_cascade = None
+
+#Runs in a worker process: decode the image at reduced scale, run OpenCV's frontal face Haar cascade on it, and return face rectangles scaled back to the full image.
+def _haarDetect(image, min_size):
+    global _cascade
+    import cv2
+    import numpy
+    from PIL import Image
+    if _cascade is None:
+        _cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    with Image.open(BytesIO(image)) as im:
+        width = im.size[0]
+        im.draft('L', (im.size[0] // 2, im.size[1] // 2))
+        gray = numpy.asarray(im.convert('L'))
+    scale = width / gray.shape[1]
+    rectangles = _cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(int(min_size / scale), int(min_size / scale)))
+    return [{
+        "left": int(x * scale),
+        "top": int(y * scale),
+        "width": int(w * scale),
+        "height": int(h * scale),
+        "age": None,
+        "gender": None
+    } for (x, y, w, h) in rectangles]
+
+#Offline backend that runs OpenCV Haar cascade face detection on the hub itself, in a pool of worker processes so detection uses every core and doesn't hold the GIL in the hub process.
+#No internet round trip, but it can't guess age or gender.
+#The workers are started by a fork server rather than forked from the hub itself: by the time the pool starts, the hub is running its pipeline, discovery, retention, metrics and alert threads,
+#and a child forked from a multi-threaded process can deadlock on a lock one of those threads held at the time of the fork.
+class HaarFaceDetector(Detector):
+    def __init__(self, workers=2, min_size=40):
+        self.min_size = min_size
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+
+    def detect(self, image):
+        return self.pool.submit(_haarDetect, image, self.min_size).result()
+
+    def close(self):
+        self.pool.shutdown()
+
+#Return the detector backend selected in the config ('detectionBackend' is 'azure', the default, or 'haar').
+def createDetector(config):
+    backend = config.get('detectionBackend', 'azure')
+    if backend == 'azure':
+        return AzureFaceDetector(config['face_api_endpoint'], config['subscription_key'], timeout=float(config.get('detectionTimeout', 10)))
+    if backend == 'haar':
+        return HaarFaceDetector(workers=int(config.get('detectionWorkers', 2)))
+    raise ValueError("Unknown detection backend " + backend)
+
+#Compute a 64-bit difference hash (dHash) of an image: shrink it to 9x8 grayscale and record whether each pixel is brighter than its right-hand neighbour.
+#Near-identical frames get hashes that differ in only a few bits, which is what the detection cache uses to spot them.
+def imageHash(image):
+    from PIL import Image
+    with Image.open(BytesIO(image)) as im:
+        im.draft('L', (64, 64))
+        pixels = list(im.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = (value << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return value
+
+#Cache of the last detection result for each sensor. A sensor that fires repeatedly at an unchanged scene produces near-identical frames,
+#so if a new frame's hash is within 'max_distance' bits of the previous one (and the previous result isn't older than 'max_age' seconds), the previous result is reused instead of running detection again.
+class DetectionCache:
+    def __init__(self, max_distance=4, max_age=30.0):
+        self.max_distance = max_distance
+        self.max_age = max_age
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, sensor, image_hash):
+        with self.lock:
+            entry = self.entries.get(sensor)
+            if entry and monotonic() - entry[2] <= self.max_age and bin(entry[0] ^ image_hash).count('1') <= self.max_distance:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def store(self, sensor, image_hash, faces):
+        with self.lock:
+            self.entries[sensor] = (image_hash, faces, monotonic())
+
+#Draw a rectangle around every detected face and return the new JPEG bytes.
+def annotate(image, faces):
+    from PIL import Image, ImageDraw
+    returned_image = BytesIO()
+    with Image.open(BytesIO(image)) as im:
+        draw = ImageDraw.Draw(im)
+        for face in faces:
+            left, top = face["left"], face["top"]
+            right, bottom = left + face["width"], top + face["height"]
+            draw.rectangle([left, top, right, bottom], outline=(0, 223, 0), width=3)
+        im.save(returned_image, format="jpeg")
+    return returned_image.getvalue()
+
+#Build the notes string for an event from the detected faces, e.g. "Subject appears to be a 34 year old male.", or "None" if there were no faces.
+def describe(faces):
+    if not faces:
+        return "None"
+    descriptions = []
+    for face in faces:
+        if face.get("age") is not None and face.get("gender"):
+            descriptions.append("a " + str(int(face["age"])) + " year old " + face["gender"])
+    if len(faces) == 1:
+        if descriptions:
+            return "Subject appears to be " + descriptions[0] + "."
+        return "1 face detected."
+    notes = str(len(faces)) + " faces detected."
+    if descriptions:
+        notes += " Subjects appear to be " + ", ".join(descriptions) + "."
+    return notes
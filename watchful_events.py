@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+import ast
+import base64
+import datetime
+import struct
+
+#Wire format used by sensors to publish security events to the hub. Every message starts with a fixed-size header followed by the raw JPEG bytes (no base64).
+#Version 1 (single image):
+#  magic (4 bytes, b'WPEV') | version (1 byte) | sensor id (12 bytes) | event id (12 bytes) | timestamp (8 bytes, microseconds since the Unix epoch, UTC) | image length (4 bytes) | image
+#Version 2 (a burst of frames around the trigger):
+#  magic | version | sensor id | event id | timestamp | frame count (1 byte) | key frame index (1 byte), then for each frame: frame length (4 bytes) | frame
+#Version 3 (a burst scored by the sensor's motion gate, see watchful_motion.py):
+#  as version 2, with motion score (4 bytes, float) | flags (1 byte) after the key frame index. Flag bit 0 marks the event as low priority (its score was below the sensor's threshold).
+#All integers are big-endian. Sensor and event ids are ObjectIds, so they are sent as their 12 raw bytes rather than 24 hex characters.
+#Events without a motion score are still sent as version 2, so sensors without the gate work with hubs that predate version 3.
+MAGIC = b'WPEV'
+VERSION = 3
+HEADER_V1 = struct.Struct('>4sB12s12sqI')
+HEADER_V2 = struct.Struct('>4sB12s12sqBB')
+HEADER_V3 = struct.Struct('>4sB12s12sqBBfB')
+FLAG_LOW_PRIORITY = 1
+FRAME_LENGTH = struct.Struct('>I')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#Encode an event dict (as built by SecurityEvent on the sensor) into a single bytes message ready to publish.
+#If the event has a 'burst' of frames, they are all sent and 'key_frame' says which one is the event's main image; otherwise 'captured_image' is sent as a burst of one.
+#A 'motion_score' (and 'low_priority') from the sensor's motion gate is sent in a version 3 header.
+def encodeEvent(event):
+    timestamp = event['timestamp']
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    micros = (timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+    frames = event.get('burst') or [event['captured_image']]
+    header = (bytes.fromhex(event['sensor']), bytes.fromhex(event['_id']), micros, len(frames), event.get('key_frame', 0))
+    if event.get('motion_score') is not None:
+        parts = [HEADER_V3.pack(MAGIC, 3, *header, event['motion_score'], FLAG_LOW_PRIORITY if event.get('low_priority') else 0)]
+    else:
+        parts = [HEADER_V2.pack(MAGIC, 2, *header)]
+    for frame in frames:
+        parts.append(FRAME_LENGTH.pack(len(frame)))
+        parts.append(frame)
+    return b''.join(parts)
+
+#Decode a message received from a sensor into an event dict with 'captured_image' as raw JPEG bytes and 'timestamp' as a (naive, UTC) datetime.
+#Bursts also get 'burst' (every frame, in order) and 'key_frame' (the index of 'captured_image' in the burst). Version 3 events also get 'motion_score', and 'low_priority' if it is set.
+#Messages that don't start with the magic bytes are treated as the legacy format (a str() of the event dict with a base64 image), so older sensors keep working during rollout.
+#A malformed message raises ValueError (or SyntaxError, for legacy text that isn't a Python literal), whatever is wrong with it, so the hub can tell it apart from a failure of its own and drop it.
+def decodeEvent(data):
+    try:
+        return _decodeEvent(data)
+    except (struct.error, KeyError, IndexError, TypeError, AttributeError) as e:
+        raise ValueError("Malformed event message: " + repr(e)) from e
+
+def _decodeEvent(data):
+    if data[:len(MAGIC)] != MAGIC:
+        return decodeLegacyEvent(data)
+    version = data[len(MAGIC)]
+    if version == 1:
+        magic, version, sensor, event_id, micros, length = HEADER_V1.unpack_from(data)
+        frames = [readBytes(data, HEADER_V1.size, length)]
+        key_frame = 0
+    elif version in (2, 3):
+        if version == 2:
+            magic, version, sensor, event_id, micros, count, key_frame = HEADER_V2.unpack_from(data)
+            offset = HEADER_V2.size
+        else:
+            magic, version, sensor, event_id, micros, count, key_frame, motion_score, flags = HEADER_V3.unpack_from(data)
+            offset = HEADER_V3.size
+        frames = []
+        for i in range(count):
+            length, = FRAME_LENGTH.unpack_from(data, offset)
+            offset += FRAME_LENGTH.size
+            frames.append(readBytes(data, offset, length))
+            offset += length
+        if key_frame >= count:
+            raise ValueError("Key frame " + str(key_frame) + " is outside a burst of " + str(count) + " frames")
+    else:
+        raise ValueError("Unsupported event format version " + str(version))
+    event = {
+        "_id": event_id.hex(),
+        "sensor": sensor.hex(),
+        "timestamp": EPOCH + datetime.timedelta(microseconds=micros),
+        "captured_image": frames[key_frame]
+    }
+    if len(frames) > 1:
+        event['burst'] = frames
+        event['key_frame'] = key_frame
+    if version == 3:
+        event['motion_score'] = round(motion_score, 4)
+        if flags & FLAG_LOW_PRIORITY:
+            event['low_priority'] = True
+    return event
+
+def readBytes(data, offset, length):
+    value = bytes(data[offset:offset + length])
+    if len(value) != length:
+        raise ValueError("Truncated event message: expected " + str(length) + " image bytes, got " + str(len(value)))
+    return value
+
+#Decode the legacy format. Need to use ast.literal_eval to parse the message and return a Python dict.
+def decodeLegacyEvent(data):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode('UTF-8')
+    event = ast.literal_eval(data)
+    event['timestamp'] = datetime.datetime.fromisoformat(event['timestamp'])
+    event['captured_image'] = base64.b64decode(event['captured_image'])
+    return event
@@ -1,23 +1,26 @@
 #!/usr/bin/python3
 
 import logging
+import signal
 import socket
+import sys
+import json
 import redis
 import subprocess
-import json
-import ast
-import requests
-import base64
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
-from PIL import Image, ImageDraw
+import threading
 from io import BytesIO
-from subprocess import DEVNULL
 from dotenv import dotenv_values
-from pymongo import MongoClient
-from time import sleep
+from pymongo.errors import DuplicateKeyError
+from time import sleep, monotonic, time
+from watchful_pipeline import Pipeline, Stage
+from watchful_events import decodeEvent
+from watchful_storage import imageStore, saveImage, createIndexes, migrateTimestamps
+from watchful_detection import createDetector, DetectionCache, imageHash, annotate, describe
+from watchful_alerts import AlertDispatcher
+from watchful_streams import EventConsumer, entryTime
+from watchful_metrics import REGISTRY, SamplingProfiler, profileOnSignal, serveMetrics
+from watchful_retention import RetentionJob, defaultPolicy
+from watchful_startup import waitForRedis, connectMongo
 
 #Load config/environmental variables from .env file.
 config = dotenv_values('.env')
@@ -25,20 +28,86 @@ config = dotenv_values('.env')
 #Enable informational logging.
 logging.basicConfig(level=logging.INFO)
 
-#Open the redis server as a subprocess (uses exec rather than running directly, so that this Popen object can be closed cleanly).
-redis_server_process = subprocess.Popen('exec redis-server --save "" --protected-mode no', shell=True)
+#'python3 watchful_hub.py worker [name]' runs an extra hub worker process: it shares the work of processing events with the hub (on this or another machine), but doesn't run Redis or discover sensors.
+workerMode = len(sys.argv) > 1 and sys.argv[1] == 'worker'
+
+#Importing this module has no side effects: Redis is started and MongoDB connected to by startup(), which main() calls. Until then the objects that need them are None.
+redis_server_process = None
+client = None
+db = None
+event_collection = None
+image_store = None
+detector = None
+retention_job = None
+
+#How long startup() waits for Redis and MongoDB to answer before giving up.
+startupTimeout = float(config.get('startupTimeout', 120))
+
+#The connection to the redis server (on this machine, unless a worker is pointed at the hub with redisHost). Creating it doesn't connect; startup() waits for the server to answer.
+redis_connection = redis.StrictRedis(host=config.get('redisHost', '127.0.0.1'), port=6379, db=0)
+
+#Events are read from the sensors' Redis streams as a named consumer in the hub's consumer group. The name must stay the same across restarts, so a restarted process picks up the events it had read but not stored.
+consumerName = sys.argv[2] if workerMode and len(sys.argv) > 2 else config.get('hubConsumerName', socket.gethostname()) + ('-worker' if workerMode else '')
+event_consumer = EventConsumer(redis_connection, consumerName, claim_idle=float(config.get('streamClaimIdle', 300)), max_deliveries=int(config.get('streamMaxDeliveries', 3)))
+streamRefreshInterval = 2.0
+
+#Metrics, served on /metrics by a small web server on metricsPort (workerMetricsPort for a worker process). Together with the pipeline's per-stage timings these show where the time goes for each event.
+#'receive' is how long an event waited in its stream before the hub read it, and the event latency runs from the event being added to its stream to it being stored. Both use the entry id's timestamp, which comes from Redis's clock.
+STEP_SECONDS = REGISTRY.histogram('watchful_hub_step_seconds', 'Time taken by each step of ingesting an event', ['step'])
+EVENT_LATENCY_SECONDS = REGISTRY.histogram('watchful_event_latency_seconds', 'Time from an event being added to its sensor stream to it being stored')
+EVENTS = REGISTRY.counter('watchful_events_total', 'Events read from the sensor streams, by what happened to them', ['outcome'])
+metricsPort = int(config.get('workerMetricsPort', 9102) if workerMode else config.get('metricsPort', 9101))
+
+#A sampling profiler that can be switched on and off in the running hub with 'kill -USR2 <pid>'. While it runs, /profile shows what it has seen so far; when it is switched off, the profile is written to profileOutput.
+profiler = SamplingProfiler(interval=float(config.get('profilerInterval', 0.01)))
+
+#The per-sensor cache of recent face detection results.
+detection_cache = DetectionCache(max_distance=int(config.get('detectionCacheDistance', 4)), max_age=float(config.get('detectionCacheSeconds', 30)))
 
-#Give redis a moment to start (this prevents issues with discovered sensors attempting to connect too early).
-sleep(1)
+#Email alerts are sent using mailgun by a dispatcher thread that keeps its SMTP connection open between alerts, coalesces bursts from one sensor into a digest and rate limits each recipient.
+#The SMTP server can be overridden in the .env file (e.g. to point at a local test server). Nothing is connected to until the first alert is sent.
+alert_dispatcher = AlertDispatcher(
+    config.get('smtpServer', 'smtp.mailgun.org'),
+    int(config.get('smtpPort', 587)),
+    config.get('smtpUser'),
+    config.get('smtpPassword'),
+    "watchfulpi@watchfulpi.io",
+    window=float(config.get('alertWindow', 30)),
+    rate_limit=int(config.get('alertRateLimit', 10)),
+    rate_period=float(config.get('alertRatePeriod', 3600))
+)
 
-#Initialise the connection to the local redis server and open a pubsub interface for messaging.
-redis_connection = redis.StrictRedis(host='127.0.0.1', port=6379, db=0)
-redis_pubsub = redis_connection.pubsub()
+#Start Redis and connect to MongoDB, then set up everything that needs them. Rather than sleeping for a fixed time, both servers are probed until they answer (see watchful_startup.py),
+#and redis-server starts up while the hub connects to MongoDB and sets up the face detection backend, so the waits overlap.
+def startup():
+    global redis_server_process, client, db, event_collection, image_store, detector, retention_job
 
-#Connect to mongodb database where security events received from sensors will be stored.
-client = MongoClient(config["mongoServerHost"], 27017)
-db = client.watchfulpi
-event_collection = db.security_events
+    #Open the redis server as a subprocess (uses exec rather than running directly, so that this Popen object can be closed cleanly).
+    if not workerMode:
+        redis_server_process = subprocess.Popen('exec redis-server --save "" --protected-mode no', shell=True)
+
+    #Connect to mongodb database where security events received from sensors will be stored.
+    client = connectMongo(config["mongoServerHost"], 27017, timeout=startupTimeout)
+    db = client.watchfulpi
+    event_collection = db.security_events
+    image_store = imageStore(db)
+    createIndexes(event_collection)
+
+    #Face detection backend.
+    detector = createDetector(config)
+
+    #Retention of stored events (see watchful_retention.py): after retentionFullDays events are reduced to a thumbnail, and after retentionThumbnailDays they are archived or deleted (retentionAction).
+    #Sensors can have their own policy, set through the web interface's API. Only the main hub runs the job, in batches of retentionBatchSize events every retentionInterval seconds; 'retention=off' turns it off.
+    retention_job = RetentionJob(
+        db,
+        defaultPolicy(config),
+        archive_directory=config.get('retentionArchiveDirectory', 'archive'),
+        batch_size=int(config.get('retentionBatchSize', 100)),
+        interval=float(config.get('retentionInterval', 3600))
+    )
+
+    #Wait for redis to answer (this prevents issues with discovered sensors attempting to connect too early).
+    waitForRedis(redis_connection, timeout=startupTimeout)
 
 #SSDP M-SEARCH request, to be sent over HTTPU for device discovery (adapted from week 7 lab 2)
 msg = \
@@ -53,146 +122,264 @@ msg = \
 SSDP_MCAST_IP = '239.255.255.250'
 SSDP_PORT = 5007
 
-#The hub will send out 10 discovery requests to the multicast group (in a future version, this might run continuously/asynchronously). On execution, the hub will be in 'discoverable' mode, and will change mode after 10 requests.
-maxDiscoveryRequests = 10
-discovering = True
-
-#Function to send mail alerts using mailgun. This is adapted from week 9 lab 2. Uses BytesIO to read the image from an in-memory stream rather than a file on storage.
-def send_mail(from_, to, subject, text, image):
-    smtpServer = "smtp.mailgun.org"
-    smtpUser = config['smtpUser']
-    smtpPassword = config['smtpPassword']
-    port = 587
-
-    with BytesIO(base64.b64decode(image)) as stream:
-        stream.seek(0)
-        msgImage = MIMEImage(stream.read())
-    
-    msg = MIMEMultipart()
-    msg.attach(MIMEText(text))
-    msgImage['Content-Disposition'] = 'attachment; filename="image.jpg"'
-    msg.attach(msgImage)
-    msg['Subject'] = subject
-
-    s = smtplib.SMTP(smtpServer, port)
-    s.login(smtpUser, smtpPassword)
-    s.sendmail(from_, to, msg.as_string())
-    s.quit()
-
-
-#Function to send SSDP M-SEARCH requests and receive responses. Returns a dict of discovered sensors (key will be the sensor id, value will be its IP address).
-#Adapted from Week 7 lab 2. Some changes were needed as the lab example worked in a Packet Tracer simulation, not on a real device. 
-#Need to use a try/except block to catch exceptions when reading from the socket times out (i.e. when there's no response from a sensor device).
-def discover():
-    global discovering
+#Discovery runs continuously in the background: every 'discoveryInterval' seconds the hub sends an M-SEARCH request and collects every reply that arrives within the MX window.
+#Sensors that haven't replied for 'sensorExpiry' seconds are treated as gone.
+discoveryInterval = float(config.get('discoveryInterval', 10))
+discoveryWindow = 2.0
+sensorExpiry = float(config.get('sensorExpiry', 60))
+
+#Sensors currently known to the hub: sensor id -> {"ip": ..., "last_seen": ...}. Only the discovery thread touches this.
+known_sensors = {}
+
+#Function to send one SSDP M-SEARCH request and collect every response that arrives within the discovery window. Returns a dict of sensors that responded (key will be the sensor id, value will be its IP address).
+#Adapted from Week 7 lab 2. Some changes were needed as the lab example worked in a Packet Tracer simulation, not on a real device.
+#Keeps reading until the window closes, so several sensors answering the same request are all picked up.
+def discover(ssdpSocket):
     discovered_sensors = {}
-    ssdpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    ssdpSocket.settimeout(2)
-    count = 0 
-    while discovering:
-        ssdpSocket.sendto(msg.encode(), (SSDP_MCAST_IP, SSDP_PORT))
+    ssdpSocket.sendto(msg.encode(), (SSDP_MCAST_IP, SSDP_PORT))
+    deadline = monotonic() + discoveryWindow
+    while True:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            break
+        ssdpSocket.settimeout(remaining)
         try:
             message, address = ssdpSocket.recvfrom(512)
-            discovered_sensors[message.decode()] = str(address[0])
-            logging.info("Found a sensor")
-        except:
-            logging.info("Socket timed out (no response message)")
-        finally:
-            count += 1
-            if count == maxDiscoveryRequests:
-                discovering = False
-                if len(discovered_sensors) == 0:
-                    logging.info("No sensors discovered. Exiting.")
-                    exit()
+        except socket.timeout:
+            break
+        discovered_sensors[message.decode()] = str(address[0])
     return discovered_sensors
 
-#Function that takes a dict object of sensor devices (as returned by discover()) and subscribes to their channels on the Redis message broker.
-#This is how the hub will receive security events from the sensors.
-def subscribeToSensors(sensors):
-    global subscription
-    if len(sensors) > 0:
-        for key in sensors:
-            #logging.info("subscribing to " + str(key))
-            redis_pubsub.subscribe(str(key))
-            message = redis_pubsub.get_message()
-            logging.info("Subscribed: " + str(message))
-    else:
-        logging.info("No sensors discovered")
-
-#Function to send images to Azure Face API for analysis. Returns an updated image and notes, or original image and "None" notes if no face detected.
-#In its current implementation this is a proof-of-concept that will work for one face. In later versions we can add support for multiple faces.
-def azureFaceDetection(image):
-    headers = {
-    'Ocp-Apim-Subscription-Key': config['subscription_key'],
-    'Content-Type': 'application/octet-stream'
-    }
-    params = {
-    'detectionModel': 'detection_01',
-    'returnFaceId': 'true',
-    'returnFaceAttributes': 'age,gender'
-    }
-
-    #Send a POST request with the headers specifying the Azure subscription key and Content-Type we will use to send the image, and params specifying what data we want to get back.
-    #The JSON response from the Azure Face API is stored in the 'response' variable.
-    response = requests.post(config['face_api_endpoint'], params=params, headers=headers, data=base64.b64decode(image))
-    
-    #If exactly one face is detected by Azure Face API
-    if len(response.json()) == 1:
-        logging.info("A face was detected by Azure Face API:" + str(response.json()))
-
-        #Get the coordinates of the rectangle around the face detected    
-        top = response.json()[0].get("faceRectangle").get("top")
-        left = response.json()[0].get("faceRectangle").get("left")
-        bottom = response.json()[0].get("faceRectangle").get("top") + response.json()[0].get("faceRectangle").get("height")
-        right = response.json()[0].get("faceRectangle").get("left") + response.json()[0].get("faceRectangle").get("width")
-        
-        #We can use those coordinates together with the PIL module to draw a rectangle on our image, write the new image to an in-memory stream, re-encode it to base64 and return it.
-        #We also return a string with the age and gender of the detected face, as guessed by Azure.
-        returned_image = BytesIO()
-        with Image.open(BytesIO(base64.b64decode(image))) as im:
-            draw = ImageDraw.Draw(im)
-            draw.line([left,top,right,top,left,top,left,bottom,left,bottom,right,bottom,right,bottom,right,top], fill=(0,223,0), width=3)
-            im.save(returned_image, format="jpeg")
-            returned_image.seek(0)
-        return base64.b64encode(returned_image.read()),"Subject appears to be a " + str(int(response.json()[0].get("faceAttributes").get("age"))) + " year old "  + response.json()[0].get("faceAttributes").get("gender") + "."
-    
-    #If zero or multiple faces are returned, for now we return the original image with "None" for the notes.
-    else:
+#Function to update the known sensors with the results of a discovery round. Sensors that have expired are forgotten,
+#and the sensors are stored in the Redis hash 'sensors' (sensor id -> ip) -- this is where the web interface can access them from. Only the fields that changed are written,
+#and each change is also published on the 'watchful_updates' channel so open dashboards can update without polling.
+def updateSensors(discovered_sensors):
+    now = monotonic()
+    updated = {}
+    lost = []
+    for sensor_id, ip in discovered_sensors.items():
+        known = known_sensors.get(sensor_id)
+        if known is None:
+            logging.info("Found a sensor: " + sensor_id + " at " + ip)
+            updated[sensor_id] = ip
+        elif known["ip"] != ip:
+            logging.info("Sensor " + sensor_id + " moved to " + ip)
+            updated[sensor_id] = ip
+        known_sensors[sensor_id] = {"ip": ip, "last_seen": now}
+    for sensor_id, known in list(known_sensors.items()):
+        if now - known["last_seen"] > sensorExpiry:
+            logging.info("Lost sensor " + sensor_id + " (not seen for " + str(int(now - known["last_seen"])) + " seconds)")
+            del known_sensors[sensor_id]
+            lost.append(sensor_id)
+    if updated or lost:
+        transaction = redis_connection.pipeline()
+        if updated:
+            transaction.hset('sensors', mapping=updated)
+        if lost:
+            transaction.hdel('sensors', *lost)
+        for sensor_id, ip in updated.items():
+            transaction.publish('watchful_updates', json.dumps({"type": "sensor", "sensor": sensor_id, "ip": ip}))
+        for sensor_id in lost:
+            transaction.publish('watchful_updates', json.dumps({"type": "lost", "sensor": sensor_id}))
+        transaction.execute()
+
+#Background thread that keeps discovering sensors for as long as the hub runs, so sensors that boot late or reboot are picked up without restarting the hub.
+def discoveryLoop():
+    ssdpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    while True:
+        started = monotonic()
+        try:
+            updateSensors(discover(ssdpSocket))
+        except Exception:
+            logging.exception("Discovery round failed")
+        sleep(max(0.0, discoveryInterval - (monotonic() - started)))
+
+#Derivative images generated for every event at ingest, as (maximum size, JPEG quality). 'thumb' matches the 320x240 cells of the events grid, 'preview' is what gets attached to email alerts.
+DERIVATIVE_SIZES = {
+    'preview': ((480, 360), 80),
+    'thumb': ((320, 240), 70)
+}
+
+#Function to generate the derivative images for an event from its (raw JPEG) image. Returns a dict mapping the derivative name to its JPEG bytes.
+#Image.draft() asks the JPEG decoder to decode at a reduced scale (1/2, 1/4 or 1/8) that is still at least as big as the largest derivative, so we don't pay to decode every pixel of the full image.
+def createDerivatives(image):
+    from PIL import Image
+    derivatives = {}
+    largest = max(size for size, quality in DERIVATIVE_SIZES.values())
+    with Image.open(BytesIO(image)) as im:
+        im.draft('RGB', largest)
+        im = im.convert('RGB')
+        for name, (size, quality) in sorted(DERIVATIVE_SIZES.items(), key=lambda item: item[1][0], reverse=True):
+            im.thumbnail(size)
+            output = BytesIO()
+            im.save(output, format="jpeg", quality=quality, optimize=True)
+            derivatives[name] = output.getvalue()
+    return derivatives
+
+#Function to run face detection on an image (raw JPEG bytes) from a sensor. Returns an updated image with every detected face outlined and notes describing them, or the original image and "None" notes if no face was detected.
+#The detection backend (Azure Face API or local OpenCV) is chosen in the .env file. Near-identical consecutive frames from the same sensor reuse the previous result rather than being sent for detection again.
+def faceDetection(sensor, image):
+    image_hash = imageHash(image)
+    faces = detection_cache.lookup(sensor, image_hash)
+    if faces is None:
+        try:
+            with STEP_SECONDS.time('detection'):
+                faces = detector.detect(image)
+        except Exception:
+            logging.exception("Face detection failed for an event from sensor " + sensor)
+            return image, "Face detection unavailable."
+        detection_cache.store(sensor, image_hash, faces)
+    if not faces:
         return image, "None"
+    logging.info(str(len(faces)) + " face(s) detected: " + str(faces))
+    return annotate(image, faces), describe(faces)
+
+#Pipeline stage handlers. Each one takes the event from the previous stage and returns it for the next, so the slow parts (face detection, MongoDB, SMTP) run concurrently in their own worker pools rather than one after another in the main loop.
+
+#Decode the event read from the sensor's stream and call faceDetection() to do the image analysis. The event remembers where it was read from, so it can be acknowledged once it has been stored.
+#A message that can't be decoded never will be, so it is acknowledged (and so dropped) straight away.
+def analyseEvent(entry):
+    stream, entry_id, data = entry
+    try:
+        with STEP_SECONDS.time('decode'):
+            event = decodeEvent(data)
+    except (ValueError, SyntaxError):
+        logging.exception("Dropping an undecodable event from " + stream)
+        event_consumer.ack(stream, entry_id)
+        EVENTS.inc('undecodable')
+        return None
+    event['delivery'] = (stream, entry_id)
+    logging.info("Logging a security event from sensor " + event['sensor'])
+    if event.get('low_priority'):
+        #The sensor's motion gate saw too little change for this to be worth a Face API call (or an email, see alertEvent).
+        EVENTS.inc('low_priority')
+        event['notes'] = "Not checked (low motion score: " + str(event['motion_score']) + ")"
+        return event
+    event['captured_image'], event['notes'] = faceDetection(event['sensor'], event['captured_image'])
+    return event
 
-#Main loop, first runs in 'discovery' mode, then once subscribed to the messaging channels for the discovered sensors, waits for events, sends images to Azure for facial analysis, sends an email alert, and logs the event to mongoDB.
+#Generate the thumbnail and preview images once, here at ingest, so the interface never has to resize anything.
+def deriveEvent(event):
+    event['derivatives'] = createDerivatives(event['captured_image'])
+    return event
+
+#Log the event in mongoDB. The image, its derivatives and any other frames from a burst go into GridFS under the event id and the event document only holds the metadata.
+#Events can be delivered more than once (e.g. after a hub process dies between storing an event and acknowledging it), so storing is idempotent: images that already exist are left alone,
+#and an event whose document already exists is acknowledged without being stored, announced or alerted on again. The event is only acknowledged once it is stored.
+def persistEvent(event):
+    burst = event.get('burst', [])
+    with STEP_SECONDS.time('images'):
+        saveImage(image_store, event['_id'], event['captured_image'])
+        for size, image in event['derivatives'].items():
+            saveImage(image_store, event['_id'], image, size=size)
+        for number, frame in enumerate(burst):
+            if number != event['key_frame']:
+                saveImage(image_store, event['_id'], frame, size='frame' + str(number))
+    document = {key: value for key, value in event.items() if key not in ('captured_image', 'derivatives', 'burst', 'delivery')}
+    if burst:
+        document['burst_frames'] = len(burst)
+    document['image_size'] = len(event['captured_image'])
+    try:
+        with STEP_SECONDS.time('insert'):
+            event_collection.insert_one(document)
+    except DuplicateKeyError:
+        logging.info("Event " + str(document['_id']) + " was already stored")
+        event_consumer.ack(*event['delivery'])
+        EVENTS.inc('duplicate')
+        return None
+    event_consumer.ack(*event['delivery'])
+    EVENTS.inc('stored')
+    EVENT_LATENCY_SECONDS.observe(time() - entryTime(event['delivery'][1]))
+    redis_connection.publish('watchful_updates', json.dumps({"type": "event", "event": {
+        "_id": document['_id'],
+        "sensor": document['sensor'],
+        "timestamp": document['timestamp'].isoformat(),
+        "notes": document.get('notes'),
+        "burst_frames": document.get('burst_frames', 0)
+    }}))
+    return event
+
+#Send an email alert. For this protoype the alert goes to a test email predefined in an environmental variable, but this will be user updateable in future.
+#The alert is handed to the dispatcher, which sends it off the hot path. Low priority events (see analyseEvent) don't send an alert.
+def alertEvent(event):
+    if event.get('low_priority'):
+        return
+    with STEP_SECONDS.time('alert'):
+        alert_dispatcher.submit(config['testEmail'], event)
+
+#Build the event pipeline. Worker counts and the size of each stage's queue can be set in the .env file.
+def createPipeline():
+    queueSize = int(config.get('pipelineQueueSize', 32))
+    return Pipeline([
+        Stage("analysis", analyseEvent, workers=config.get('analysisWorkers', 2), maxsize=queueSize),
+        Stage("derivatives", deriveEvent, workers=config.get('derivativeWorkers', 1), maxsize=queueSize),
+        Stage("persistence", persistEvent, workers=config.get('persistenceWorkers', 1), maxsize=queueSize),
+        Stage("alerting", alertEvent, workers=1, maxsize=queueSize)
+    ])
+
+#Export the counts the hub's components already keep as metrics. They are read when /metrics is requested, so they cost nothing on the ingest path.
+def registerMetrics(pipeline):
+    pipeline.registerMetrics()
+    REGISTRY.countedBy('watchful_detection_cache_total', 'Face detection cache lookups, by result', lambda: {('hit',): detection_cache.hits, ('miss',): detection_cache.misses}, ['result'])
+    REGISTRY.countedBy('watchful_stream_entries_total', 'Stream entries handled by this consumer, by what happened to them', lambda: {(key,): value for key, value in event_consumer.stats().items() if key not in ('streams', 'removed')}, ['outcome'])
+    REGISTRY.gauge('watchful_streams', 'Sensor event streams being read by this consumer', lambda: event_consumer.stats()['streams'])
+    REGISTRY.countedBy('watchful_streams_removed_total', 'Empty event streams of sensors that have gone, removed from Redis', lambda: event_consumer.stats()['removed'])
+    REGISTRY.countedBy('watchful_alerts_total', 'Alert emails, by result', lambda: {(key,): value for key, value in alert_dispatcher.stats().items() if key != 'pending'}, ['result'])
+    REGISTRY.gauge('watchful_alerts_pending', 'Alerts waiting to be sent in a digest', lambda: alert_dispatcher.stats()['pending'])
+    #Only reported once the hub is reading the sensor streams, so it also tells whoever is watching (e.g. watchful_supervisor.py) that the hub is ready.
+    REGISTRY.gauge('watchful_hub_startup_seconds', 'Time from the hub starting up to it reading the sensor streams', lambda: {(): startup_seconds} if startup_seconds is not None else {})
+    try:
+        serveMetrics(metricsPort, profiler=profiler)
+    except OSError:
+        logging.exception("Could not serve metrics on port " + str(metricsPort))
+    profileOnSignal(profiler, signal.SIGUSR2, config.get('profileOutput', 'hub_profile.txt'))
+
+#Time taken by the last start up, once the hub is ready.
+startup_seconds = None
+
+#Convert the timestamps of events stored by older versions of the hub. Runs in the background, as on a large database it can take a while and the hub doesn't need it done to store new events.
+def migrate():
+    logging.info("Converted " + str(migrateTimestamps(event_collection)) + " legacy event timestamps")
+
+#Main loop. Calls startup(), then starts the discovery thread, then reads events from the sensors' streams and hands them to the pipeline, which runs face detection on the images, generates thumbnails, logs the event to mongoDB, and sends an email alert.
+#Startup doesn't wait for discovery -- the streams of newly found sensors are picked up every streamRefreshInterval seconds, and any events they published in the meantime are waiting in their streams.
+#Streams left over from before a restart are read straight away, so events that arrived while the hub was down are processed. Worker processes skip discovery and read the streams of the sensors the hub has found.
 def main():
+    global startup_seconds
+    started = monotonic()
+    startup()
+    alert_dispatcher.start()
+    pipeline = createPipeline()
+    pipeline.start()
+    pipeline.reportStats(float(config.get('pipelineStatsInterval', 60)))
+    registerMetrics(pipeline)
+    if not workerMode:
+        redis_connection.delete('sensors')
+        threading.Thread(target=discoveryLoop, name="discovery", daemon=True).start()
+        threading.Thread(target=migrate, name="migration", daemon=True).start()
+        if config.get('retention', 'on') != 'off':
+            retention_job.start()
+    event_consumer.watch(event_consumer.existingStreams())
+    refreshed = monotonic()
+    startup_seconds = refreshed - started
+    logging.info("Hub ready in " + str(int(startup_seconds * 1000)) + " ms")
     while True:
-        if discovering:
-            logging.info("Discovering")
-            sensors = discover()
-            logging.info("Subscribing")
-            subscribeToSensors(sensors)
-
-            #The dict with the discovered sensors is stored in a Redis with the key 'sensors' -- this is where the web interface can access it from.
-            redis_connection.set('sensors', json.dumps(sensors))
-        else:
-            message = redis_pubsub.get_message()
-            if message:
-
-                #Sometimes the subscribtion confirmation comes in late from Redis for some reason -- continue from the start of the next iteration if this happens
-                if isinstance(message['data'], int):
-                    logging.info("Looks like we got a delayed subscription confirmation message" + str(message))
-                    continue
-                
-                #Need to use ast.literal_eval to parse the message and return a Python dict
-                event = ast.literal_eval(message['data'].decode('UTF-8'))
-                logging.info("Logging a security event from sensor " + event['sensor'])
-
-                #call azureFaceDetection() to do the image analysis
-                event['captured_image'], event['notes'] = azureFaceDetection(event['captured_image'])
-
-                #Log the event in mongoDB
-                event_collection.insert_one(event)
-
-                #Send an email alert. For this protoype the alert goes to a test email predefined in an environmental variable, but this will be user updateable in future.
-                alert_message = "Hi, this alert fired at " + event['timestamp'] + "\n\nNotes: " + event['notes'] 
-                send_mail("watchfulpi@watchfulpi.io", config['testEmail'], 'An alert from watchful Pi', alert_message, event['captured_image'])
+        #Pick up newly found sensors, stop reading (and remove) the empty streams of sensors that have gone, and take over events that a hub process read but never acknowledged (e.g. because it died).
+        #Sensors get a new id each time they boot, so without the pruning every sensor restart would leave a stream behind that is read forever.
+        if monotonic() - refreshed >= streamRefreshInterval:
+            sensor_ids = [sensor_id.decode('UTF-8') for sensor_id in redis_connection.hkeys('sensors')]
+            event_consumer.watch(sensor_ids)
+            event_consumer.prune(sensor_ids)
+            for entry in event_consumer.reclaim():
+                pipeline.put(entry)
+            refreshed = monotonic()
+
+        #Block waiting for the next events (the timeout bounds how long a new sensor waits to be picked up), so the hub sits idle rather than spinning while nothing is happening.
+        #If the pipeline is full, put() blocks until there is room, which leaves any further events waiting in the streams.
+        for entry in event_consumer.read():
+            EVENTS.inc('received')
+            STEP_SECONDS.observe(time() - entryTime(entry[1]), 'receive')
+            pipeline.put(entry)
 
 if __name__ == "__main__":
     main()
@@ -2,11 +2,20 @@
 
 import logging
 import redis
-import json
+import signal
+import datetime
+import threading
+from io import BytesIO
+from time import monotonic, perf_counter
 from dotenv import dotenv_values
-from flask import Flask, request, render_template
+from flask import Flask, Response, request, render_template, send_file, abort, jsonify, g
 from flask_cors import CORS
-from pymongo import MongoClient
+from watchful_storage import imageStore, loadImage, createIndexes, queryEvents, IMAGE_SIZES
+from watchful_retention import RetentionPolicy, defaultPolicy, sensorPolicy, setSensorPolicy, clearSensorPolicy
+from watchful_broadcast import UpdateBroadcaster
+from watchful_relay import StreamRelays
+from watchful_metrics import REGISTRY, CONTENT_TYPE, SamplingProfiler, profileOnSignal
+from watchful_startup import waitForRedis, connectMongo
 
 #load config from .env file
 config = dotenv_values(".env")
@@ -14,18 +23,134 @@ config = dotenv_values(".env")
 #enable informational logging
 logging.basicConfig(level=logging.INFO)
 
-#connect to redis
+#connect to redis (creating the client doesn't connect; startup() waits for the server to answer)
 redis_connection = redis.StrictRedis(host='127.0.0.1', port=6379, db=0)
 
-#connect to database
-client = MongoClient(config["mongoServerHost"], 27017)
-db = client.watchfulpi
-event_collection = db.security_events
+#the database is connected to by startup(), so importing this module has no side effects
+client = None
+db = None
+event_collection = None
+image_store = None
+
+#Connect to the database and wait for Redis, probing both until they answer rather than assuming they are up (after a power cut the hub is starting Redis at the same time).
+def startup():
+    global client, db, event_collection, image_store
+    timeout = float(config.get('startupTimeout', 120))
+    client = connectMongo(config["mongoServerHost"], 27017, timeout=timeout)
+    db = client.watchfulpi
+    event_collection = db.security_events
+    image_store = imageStore(db)
+    createIndexes(event_collection)
+    waitForRedis(redis_connection, timeout=timeout)
+
+#Page size limits for the paginated events API
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
 
 #create Flask app and allow cross-origin resource sharing
 app = Flask(__name__)
 CORS(app)
 
+#Every request is timed and counted by endpoint (the name of the view function, e.g. allSensors), and the metrics are served on /metrics.
+REQUEST_SECONDS = REGISTRY.histogram('watchful_interface_request_seconds', 'Time taken to handle a request to the web interface', ['endpoint'])
+REQUESTS = REGISTRY.counter('watchful_interface_requests_total', 'Requests to the web interface', ['endpoint', 'status'])
+SENSOR_CACHE = REGISTRY.counter('watchful_interface_sensor_cache_total', 'Reads of the sensor state, by whether they were served from the cache', ['result'])
+
+#A sampling profiler that can be switched on and off in the running interface with 'kill -USR2 <pid>'. When it is switched off, the profile is written to profileOutput.
+profiler = SamplingProfiler(interval=float(config.get('profilerInterval', 0.01)))
+
+@app.before_request
+def startTimer():
+    g.started = perf_counter()
+
+@app.after_request
+def recordRequest(response):
+    endpoint = request.endpoint or 'unknown'
+    if 'started' in g:
+        REQUEST_SECONDS.observe(perf_counter() - g.started, endpoint)
+    REQUESTS.inc(endpoint, response.status_code)
+    return response
+
+#The sensor state (every sensor's ip and mode) is cached in-process for a short time, since the dashboard asks for it on every page load and button press.
+#The cache is dropped whenever a mode change is requested, so the next read goes back to Redis.
+SENSOR_CACHE_TTL = float(config.get("sensorCacheTTL", 1.0))
+sensor_cache = {"sensors": None, "expires": 0.0}
+sensor_cache_lock = threading.Lock()
+
+#The hub discovers sensors in the background and stores them in the Redis hash 'sensors' (sensor id -> ip) as they are found, and each sensor keeps its mode under its own id,
+#so there may not be any sensors (or a sensor may not have reported its mode yet) when a page is requested.
+#Reading the state takes two round trips however many sensors there are: HGETALL for the registry, then a single MGET for all of the modes.
+def loadSensors():
+    registry = redis_connection.hgetall('sensors')
+    sensor_ids = sorted(sensor_id.decode('UTF-8') for sensor_id in registry)
+    modes = redis_connection.mget(sensor_ids) if sensor_ids else []
+    sensors = {}
+    for sensor_id, mode in zip(sensor_ids, modes):
+        sensors[sensor_id] = {"ip": registry[sensor_id.encode('UTF-8')].decode('UTF-8'), "mode": mode.decode('UTF-8') if mode is not None else "unknown"}
+    return sensors
+
+#Return a dict of sensor id -> {"ip": ..., "mode": ...}, from the cache if it is fresh enough. Callers must not modify it.
+def getSensors():
+    with sensor_cache_lock:
+        if sensor_cache["sensors"] is not None and monotonic() < sensor_cache["expires"]:
+            SENSOR_CACHE.inc('hit')
+            return sensor_cache["sensors"]
+    SENSOR_CACHE.inc('miss')
+    sensors = loadSensors()
+    with sensor_cache_lock:
+        sensor_cache["sensors"] = sensors
+        sensor_cache["expires"] = monotonic() + SENSOR_CACHE_TTL
+    return sensors
+
+def invalidateSensors():
+    with sensor_cache_lock:
+        sensor_cache["sensors"] = None
+
+#Updates for the browser (mode changes from sensors, and sensors and new events from the hub) are published on the 'watchful_updates' channel.
+#Sensor state changes also make the cached sensor state stale, and new events get the same shape as in the events API.
+def relayUpdate(update):
+    if update['type'] in ('mode', 'sensor', 'lost'):
+        invalidateSensors()
+    elif update['type'] == 'event':
+        update = {"type": "event", "event": eventSummary(update['event'])}
+    return update
+
+#Waitress serves each request on one of a fixed number of threads (interfaceThreads), and the update stream and the video relay hold their thread for as long as the browser stays connected.
+#So that they can't take every thread and leave nothing to answer the rest of the API (mode changes, /metrics), at most streamClientLimit of them are open at once; the limit defaults to
+#all but four of the threads. A browser that would go over the limit gets a 503 and is asked to try again later.
+INTERFACE_THREADS = int(config.get("interfaceThreads", 16))
+STREAM_CLIENT_LIMIT = max(1, min(int(config.get("streamClientLimit", INTERFACE_THREADS - 4)), INTERFACE_THREADS - 1))
+STREAM_RETRY_AFTER = 30
+stream_slots = threading.BoundedSemaphore(STREAM_CLIENT_LIMIT)
+STREAMS_REFUSED = REGISTRY.counter('watchful_interface_streams_refused_total', 'Update and video streams refused because streamClientLimit were already open', ['endpoint'])
+
+#Take one of the long-lived stream slots for a request, or return a 503 response if they are all in use. The slot is handed back by releaseStream(),
+#which each streaming endpoint registers with call_on_close, as the WSGI server calls that when the connection ends even if the response was never sent.
+def takeStream():
+    if stream_slots.acquire(blocking=False):
+        return None
+    STREAMS_REFUSED.inc(request.endpoint)
+    return jsonify({"error": "Too many open streams, try again later"}), 503, {"Retry-After": str(STREAM_RETRY_AFTER)}
+
+def releaseStream():
+    stream_slots.release()
+
+STREAM_KEEPALIVE = 15.0
+broadcaster = UpdateBroadcaster(redis_connection, 'watchful_updates', handler=relayUpdate, client_queue_size=int(config.get("streamQueueSize", 64)))
+REGISTRY.gauge('watchful_interface_stream_clients', 'Browsers connected to the update stream', lambda: {('connected',): broadcaster.stats()['clients'], ('lagging',): broadcaster.stats()['lagging']}, ['state'])
+
+#Live video from the sensors is relayed through the hub (see watchful_relay.py): one connection to each sensor's mjpg_streamer, however many browsers are watching.
+#sensorStreamUrl is where a sensor's stream is, with {ip} standing for the sensor's IP address.
+SENSOR_STREAM_URL = config.get("sensorStreamUrl", "http://{ip}:8080/?action=stream")
+stream_relays = StreamRelays(timeout=float(config.get("sensorStreamTimeout", 10)))
+REGISTRY.gauge('watchful_interface_video_relays', 'Sensor video streams being relayed, and browsers watching them', lambda: {(key,): value for key, value in stream_relays.stats().items() if key in ('upstreams', 'viewers')}, ['state'])
+REGISTRY.countedBy('watchful_interface_video_frames_total', 'Video frames relayed to browsers, and frames skipped for browsers that fell behind', lambda: {(key,): value for key, value in stream_relays.stats().items() if key in ('sent', 'skipped')}, ['result'])
+
+#Prometheus metrics for the interface
+@app.route("/metrics",methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 #Render the index/landing page
 @app.route("/",methods=['GET'])
 def index():
@@ -38,74 +163,188 @@ def dashboard():
     logging.info("rendering dashboard.html")
     return render_template("dashboard.html")
 
-#Render the events view page for <sensor> (uses the sensor id to pull the results from the correct sensor from MongoDB)
+#Render the events view page for <sensor>. The page itself is just a shell -- client-side javascript pages through the events for the sensor using /api/sensor/<sensor_id>/events
 @app.route("/<sensor>/eventsview",methods=['GET'])
 def eventsView(sensor):
     logging.info("rendering eventsview.html")
-    return render_template("eventsview.html", sensor=sensor, events = event_collection.find({"sensor": sensor}))
+    return render_template("eventsview.html", sensor=sensor)
 
-#Render the streamview page for <sensor> (uses the sensor id to pull the sensor's IP address from Redis, which is then passed into the html template)
+#Render the streamview page for <sensor>. The page shows the sensor's video through the hub's relay (/api/sensor/<sensor_id>/stream).
 @app.route("/<sensor>/streamview",methods=['GET'])
 def streamView(sensor):
     logging.info("rendering streamview.html")
-    return render_template("streamview.html", sensor=sensor, ip=json.loads(redis_connection.get('sensors'))[sensor])
+    if sensor not in getSensors():
+        abort(404)
+    return render_template("streamview.html", sensor=sensor)
+
+#API endpoint to return the captured image for an event as a JPEG. The 'size' query parameter picks the thumbnail (default), preview or original image.
+#For events with a burst of frames, the 'frame' query parameter picks a frame from the burst instead (frames are only stored at full size).
+#Images never change once stored, so the image id doubles as the ETag and browsers can cache them indefinitely.
+#send_file with conditional=True answers If-None-Match with 304 Not Modified and supports Range requests for partial content.
+@app.route("/api/event/<event_id>/image",methods=['GET'])
+def eventImage(event_id):
+    size = request.args.get('size', 'thumb')
+    frame = request.args.get('frame')
+    if frame is not None:
+        if not frame.isdigit() or int(frame) > 255:
+            abort(400)
+        size = 'frame' + str(int(frame))
+    elif size not in IMAGE_SIZES:
+        abort(400)
+    image, image_id = loadImage(image_store, event_collection, event_id, size)
+    if image is None:
+        abort(404)
+    response = send_file(BytesIO(image), mimetype='image/jpeg', etag=image_id, conditional=True, max_age=31536000)
+    response.cache_control.immutable = True
+    return response
+
+#Parse an ISO 8601 timestamp from a query parameter into a naive UTC datetime (the form timestamps are stored in), or None if the parameter wasn't given.
+def parseTimestamp(value):
+    if not value:
+        return None
+    timestamp = datetime.datetime.fromisoformat(value)
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+#Describe an event for the browser: its metadata and URLs for each size of its image ('image' is the thumbnail). Used by the events API and for new events on the update stream,
+#where the hub sends the timestamp as an ISO 8601 string rather than a datetime.
+def eventSummary(event):
+    event_id = str(event['_id'])
+    timestamp = event['timestamp']
+    return {
+        "id": event_id,
+        "sensor": event['sensor'],
+        "timestamp": timestamp.isoformat() if isinstance(timestamp, datetime.datetime) else timestamp,
+        "notes": event.get('notes'),
+        "image": "/api/event/" + event_id + "/image",
+        "preview": "/api/event/" + event_id + "/image?size=preview",
+        "original": "/api/event/" + event_id + "/image?size=original",
+        "frames": ["/api/event/" + event_id + "/image?frame=" + str(number) for number in range(event.get('burst_frames', 0))]
+    }
+
+#API endpoint to return a page of events for a sensor, newest first, as a JSON object. Images are not included, only URLs for each size ('image' is the thumbnail).
+#Optional query parameters: 'limit' (page size, capped at MAX_PAGE_SIZE), 'cursor' (the 'next' value from the previous page), 'since' and 'until' (ISO 8601 timestamps).
+@app.route("/api/sensor/<sensor_id>/events",methods=['GET'])
+def sensorEvents(sensor_id):
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        since = parseTimestamp(request.args.get('since'))
+        until = parseTimestamp(request.args.get('until'))
+        events, next_cursor = queryEvents(event_collection, sensor_id, limit, cursor=request.args.get('cursor'), since=since, until=until)
+    except ValueError:
+        return jsonify({"error": "Invalid limit, cursor or timestamp"}), 400
+    return jsonify({"events": [eventSummary(event) for event in events], "next": next_cursor})
+
+#API endpoint that relays a sensor's live video (while it is in streaming mode) as an MJPEG stream, which browsers show in an <img> element.
+#Every viewer of a sensor shares one connection to the sensor; a viewer that can't keep up is sent the latest frame whenever it is ready, skipping the rest.
+#The stream ends when the sensor stops streaming, and the connection to the sensor is closed when the last viewer goes.
+@app.route("/api/sensor/<sensor_id>/stream",methods=['GET'])
+def sensorStream(sensor_id):
+    sensor = getSensors().get(sensor_id)
+    if sensor is None:
+        return jsonify({"error": "Unknown sensor " + sensor_id}), 404
+    refused = takeStream()
+    if refused:
+        return refused
+    #The viewer joins the relay once the body is first read, not before, so that a request whose body is never read (e.g. a HEAD request) doesn't leave a viewer behind.
+    def generate():
+        relay = stream_relays.join(sensor_id, SENSOR_STREAM_URL.format(ip=sensor["ip"]))
+        try:
+            for frame in stream_relays.frames(relay):
+                yield b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(frame)).encode() + b'\r\n\r\n'
+                yield frame
+                yield b'\r\n'
+        finally:
+            stream_relays.leave(sensor_id, relay)
+    response = Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame', headers={"Cache-Control": "no-cache, no-store"})
+    response.call_on_close(releaseStream)
+    return response
+
+#API endpoint for a sensor's retention policy (see watchful_retention.py). GET returns the policy and whether it is the default, POST sets any of the 'full_days', 'thumbnail_days' and 'action' query parameters
+#(the rest are kept from the current policy), and DELETE puts the sensor back on the default policy. Works for sensors that are offline too, since their events are still stored.
+@app.route("/api/sensor/<sensor_id>/retention",methods=['GET', 'POST', 'DELETE'])
+def sensorRetention(sensor_id):
+    default = defaultPolicy(config)
+    if request.method == 'POST':
+        policy = sensorPolicy(db, sensor_id, default).asDict()
+        for key in policy:
+            policy[key] = request.args.get(key, policy[key])
+        try:
+            setSensorPolicy(db, sensor_id, RetentionPolicy(**policy))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    elif request.method == 'DELETE':
+        clearSensorPolicy(db, sensor_id)
+    policy = sensorPolicy(db, sensor_id, default)
+    return jsonify({sensor_id: dict(policy.asDict(), default=policy is default)})
+
+#API endpoint that streams live updates to the browser as server-sent events: 'mode' when a sensor changes mode, 'sensor' and 'lost' when the hub finds or loses a sensor,
+#'event' when a new security event has been stored, and 'resync' when updates were missed and the page should reload its state from the API.
+#A comment is sent every STREAM_KEEPALIVE seconds when there is nothing else to send, so connections from browsers that have gone away are noticed and closed.
+@app.route("/api/stream",methods=['GET'])
+def updateStream():
+    refused = takeStream()
+    if refused:
+        return refused
+    #Subscribed once the body is first read, so that a request whose body is never read (e.g. a HEAD request) doesn't leave a client behind.
+    def events():
+        client = broadcaster.subscribe()
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                update = client.next(STREAM_KEEPALIVE)
+                yield update if update is not None else ": keepalive\n\n"
+        finally:
+            broadcaster.unsubscribe(client)
+    response = Response(events(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(releaseStream)
+    return response
 
-#API endpoint to return a JSON object with all sensor devices and their ip addresses and current modes (this is called by an XMLHttpRequest in client-side javascript to populate the dashboard page)
+#API endpoint to return a JSON object with all sensor devices and their ip addresses and current modes (this is fetched by client-side javascript to populate the dashboard page)
 #GET returns the JSON object, POST is used to update mode for all devices (this is done by publishing a message on Redis) and also returns the JSON object
 @app.route("/api/sensor/all", methods=['GET', 'POST'])
 def allSensors():
-    sensors = json.loads(redis_connection.get('sensors'))
     if request.method == 'GET':
         logging.info("Getting all sensors, their IPs, and modes")
-        if len(sensors) == 0:
-            response = "{}"
-        else:
-            response = '{"sensors":{'
-            for sensor_id, ip in sensors.items():
-                response += '"' + sensor_id + '":{"ip":"' + ip + '","mode":"' +  redis_connection.get(sensor_id).decode('UTF-8') + '"},'
-            response = response[:-1] #remove trailing comma for valid JSON
-            response += "}}"
-        return response
+        sensors = getSensors()
     elif request.method == 'POST':
         new_mode = request.args.get('mode')
-        logging.info("Command received: " + new_mode)
-        if len(sensors) == 0:
-            response = "{}"
-        if new_mode not in ['0','1','2']:
-            response = '{"sensors":{'
-            for sensor_id, ip in sensors.items():
-                response += '"' + sensor_id + '":{"ip":"' + ip + '","mode":"' +  new_mode + '"},'
-            response = response[:-1] #remove trailing comma for valid JSON
-            response += "}}"
-        else:
+        logging.info("Command received: " + str(new_mode))
+        sensors = getSensors()
+        if new_mode in ['0','1','2']:
             redis_connection.publish('watchful_commands', 'all' + ':' + new_mode)
-            response = '{"sensors":{'
-            for sensor_id, ip in sensors.items():
-                response += '"' + sensor_id + '":{"ip":"' + ip + '","mode":"' +  new_mode + '"},'
-            response = response[:-1] #remove trailing comma for valid JSON
-            response += "}}"
-        return response
+            invalidateSensors()
+            sensors = {sensor_id: {"ip": sensor["ip"], "mode": new_mode} for sensor_id, sensor in sensors.items()}
+    if len(sensors) == 0:
+        return jsonify({})
+    return jsonify({"sensors": sensors})
 
 #API endpoint to return a JSON object with details for a specific sensor device
 #GET returns the JSON object, POST updates the device mode (this is done by publishing a message on Redis) and also returns the JSON object 
 @app.route("/api/sensor/<sensor_id>",methods=['GET', 'POST'])
 def oneSensor(sensor_id):
-    sensors = json.loads(redis_connection.get('sensors'))
+    sensor = getSensors().get(sensor_id)
+    if sensor is None:
+        return jsonify({"error": "Unknown sensor " + sensor_id}), 404
     if request.method == 'GET':
         logging.info("Getting sensor mode and ip")
-        sensor_ip = sensors[sensor_id]
-        sensor_mode = redis_connection.get(sensor_id).decode('UTF-8')
-        return '{"' + sensor_id + '":{"ip":"' + sensor_ip + '","mode":"' + sensor_mode + '"}}'
     elif request.method == 'POST':
-        sensor_ip = sensors[sensor_id]
-        sensor_mode = redis_connection.get(sensor_id).decode('UTF-8')
         new_mode = request.args.get('mode')
-        logging.info("Command received: " + new_mode)
-        if new_mode not in ['0','1','2']:
-            return '{"' + sensor_id + '":{"ip":"' + sensor_ip + '","mode":"' + sensor_mode + '"}}'
-        else:
+        logging.info("Command received: " + str(new_mode))
+        if new_mode in ['0','1','2']:
             redis_connection.publish('watchful_commands', sensor_id + ':' + new_mode)
-            return '{"' + sensor_id + '":{"ip":"' + sensor_ip + '","mode":"' + new_mode + '"}}'
+            invalidateSensors()
+            sensor = {"ip": sensor["ip"], "mode": new_mode}
+    return jsonify({sensor_id: sensor})
 
+#Serve the interface with waitress. Every browser with a page open holds one of its threads for the update stream, so there should be more threads than open pages.
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    from waitress import serve
+    started = monotonic()
+    startup()
+    logging.info("Interface ready in " + str(int((monotonic() - started) * 1000)) + " ms")
+    profileOnSignal(profiler, signal.SIGUSR2, config.get('profileOutput', 'interface_profile.txt'))
+    #Each viewer of a sensor's video also holds a thread. outbufHighWatermark is how much output waitress buffers for a connection before the thread writing to it waits,
+    #which is what holds a slow video viewer back (so that it skips frames) rather than the interface buffering video for it.
+    serve(app, host='0.0.0.0', port=5000, threads=INTERFACE_THREADS, outbuf_high_watermark=int(config.get("outbufHighWatermark", 1048576)))
\ No newline at end of file
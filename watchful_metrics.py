@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+
+import bisect
+import collections
+import logging
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+
+#Metrics for the hub and the web interface, exported in the Prometheus text format (https://prometheus.io/docs/instrumenting/exposition_formats/).
+#Each process has one registry, REGISTRY. Modules create their metrics on it when they are imported, and the hub and interface serve REGISTRY.render() on /metrics.
+#Recording a value is a dict lookup, a bisect and a couple of additions under a lock (around a microsecond), so timing every stage of every event costs next to nothing.
+
+#Histogram buckets in seconds, from a cache hit (well under a millisecond) to a slow Face API call or SMTP send.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def formatLabels(labelnames, labelvalues, extra=''):
+    labels = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+#Define the Counter class: a value per set of label values that only goes up.
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] += amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return [(self.name, formatLabels(self.labelnames, labels), value) for labels, value in sorted(values.items())]
+
+#Define the Histogram class, which counts observations (e.g. how long something took, in seconds) into buckets, per set of label values.
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelvalues)
+            if series is None:
+                series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    #Time a block of code: with histogram.time('label value'): ...
+    def time(self, *labelvalues):
+        return Timer(self, labelvalues)
+
+    def samples(self):
+        with self.lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self.series.items()}
+        samples = []
+        for labels, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', formatLabels(self.labelnames, labels, 'le="' + formatValue(bound) + '"'), cumulative))
+            samples.append((self.name + '_sum', formatLabels(self.labelnames, labels), total))
+            samples.append((self.name + '_count', formatLabels(self.labelnames, labels), cumulative))
+        return samples
+
+class Timer:
+    __slots__ = ('histogram', 'labelvalues', 'started')
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(perf_counter() - self.started, *self.labelvalues)
+
+#Define the Callback class, for values that something else already keeps track of (queue depths, counts in a stats() dict). The function is only called when the metrics are rendered,
+#and returns either a single value or a dict of label values (a tuple) -> value.
+class Callback:
+    def __init__(self, name, help, type, function, labelnames=()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.function = function
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, formatLabels(self.labelnames, labels), value) for labels, value in sorted(values.items())]
+
+#Define the Registry class, which holds a process's metrics and renders them all for /metrics.
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, function, labelnames=()):
+        return self.register(Callback(name, help, 'gauge', function, labelnames))
+
+    def countedBy(self, name, help, function, labelnames=()):
+        return self.register(Callback(name, help, 'counter', function, labelnames))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception:
+                logging.exception("Could not collect metric " + metric.name)
+                continue
+            lines.append('# HELP ' + metric.name + ' ' + metric.help)
+            lines.append('# TYPE ' + metric.name + ' ' + metric.type)
+            for name, labels, value in samples:
+                lines.append(name + labels + ' ' + formatValue(value))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+#Content type for the Prometheus text format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#Define the SamplingProfiler class: while running, a background thread takes a snapshot of every other thread's stack every 'interval' seconds and counts how often each stack is seen.
+#Nothing is added to the code being profiled, so it can be switched on in a live process (see profileOnSignal) and costs nothing while it is off.
+#render() returns the counts in the "collapsed stack" format that flame graph tools read: one line per stack, frames separated by ';' from the thread's entry point down, then the sample count.
+#Frames are identified by function (name, file and the line the function starts on), so samples taken at different lines of the same function add up.
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.thread:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def render(self, limit=None):
+        return ''.join(stack + ' ' + str(count) + '\n' for stack, count in self.stacks.most_common(limit))
+
+    def _sample(self):
+        names = {}
+        me = threading.get_ident()
+        while not self.stopping.is_set():
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            sleep(self.interval)
+
+#Switch 'profiler' on and off each time the process receives 'signum' (e.g. kill -USR2 <pid>). When it is switched off, the profile is written to 'path'.
+#Must be called from the main thread.
+def profileOnSignal(profiler, signum, path):
+    import signal
+    def toggle(signum, frame):
+        if not profiler.running:
+            logging.info("Sampling profiler started")
+            profiler.start()
+            return
+        profiler.stop()
+        with open(path, 'w') as output:
+            output.write(profiler.render())
+        logging.info("Sampling profiler stopped after " + str(profiler.samples) + " samples, profile written to " + path)
+    signal.signal(signum, toggle)
+
+#Serve /metrics (and, if a profiler is given, /profile with its current collapsed stacks) from a background thread, for processes that don't already have a web server.
+def serveMetrics(port, registry=REGISTRY, profiler=None, host='0.0.0.0'):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = registry.render().encode(), CONTENT_TYPE
+            elif self.path == '/profile' and profiler is not None:
+                body, content_type = profiler.render().encode(), 'text/plain; charset=utf-8'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+import os
+import threading
+from io import BytesIO
+from time import sleep
+
+#Stand-ins for the gpiozero MotionSensor and PiCamera, so the sensor program can run (and be tested and benchmarked) on a normal Linux box without a Raspberry Pi.
+#watchful_sensor.py uses these instead of the real hardware when the WATCHFUL_MOCK_HARDWARE environment variable is set.
+
+#Image returned by MockCamera.capture() -- any JPEG will do, so use the one the stream view already ships with.
+MOCK_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'stream404.jpg')
+
+#Number of different frames MockCamera cycles through when it synthesises its frames (WATCHFUL_MOCK_SYNTHETIC). They are made once per process and shared by every MockCamera.
+SYNTHETIC_FRAMES = 16
+_synthetic = {}
+
+#Make 'count' JPEG frames of a noisy scene with a block moving across it, so that (unlike the fixed image) consecutive frames differ the way frames of someone walking past the camera would,
+#and are about the size of real camera frames. Needs Pillow, which is only imported here so the plain mock still runs without it.
+def syntheticFrames(resolution=(640, 480), count=SYNTHETIC_FRAMES):
+    if resolution in _synthetic:
+        return _synthetic[resolution]
+    from PIL import Image, ImageDraw
+    width, height = resolution
+    background = Image.blend(Image.linear_gradient('L').resize(resolution), Image.effect_noise(resolution, 40), 0.3).convert('RGB')
+    frames = []
+    for number in range(count):
+        im = background.copy()
+        draw = ImageDraw.Draw(im)
+        left = number * (width - width // 4) // max(1, count - 1)
+        draw.rectangle((left, height // 3, left + width // 4, height * 2 // 3), fill=(200, 60, 40))
+        draw.text((10, 10), 'frame ' + str(number), fill=(255, 255, 255))
+        output = BytesIO()
+        im.save(output, format='jpeg', quality=85)
+        frames.append(output.getvalue())
+    _synthetic[resolution] = frames
+    return frames
+
+#Define the MockMotionSensor class, which implements the parts of gpiozero's MotionSensor the sensor program uses.
+#Motion can be triggered by calling trigger(), or automatically every 'interval' seconds (WATCHFUL_MOCK_MOTION_INTERVAL) if that is set. Each motion lasts 'duration' seconds.
+#Like gpiozero, the when_motion and when_no_motion callbacks are called from a background thread.
+class MockMotionSensor:
+    def __init__(self, pin, interval=None, duration=1.0):
+        self.pin = pin
+        self.when_motion = None
+        self.when_no_motion = None
+        self.duration = duration
+        self._motion = threading.Event()
+        self._no_motion = threading.Event()
+        self._no_motion.set()
+        if interval is None and os.environ.get('WATCHFUL_MOCK_MOTION_INTERVAL'):
+            interval = float(os.environ['WATCHFUL_MOCK_MOTION_INTERVAL'])
+        if interval:
+            threading.Thread(target=self._autoTrigger, args=(interval,), name="mock-pir", daemon=True).start()
+
+    @property
+    def motion_detected(self):
+        return self._motion.is_set()
+
+    def wait_for_motion(self, timeout=None):
+        return self._motion.wait(timeout)
+
+    def wait_for_no_motion(self, timeout=None):
+        return self._no_motion.wait(timeout)
+
+    #Simulate one period of motion: fire when_motion, hold the motion state for 'duration' seconds, then fire when_no_motion.
+    def trigger(self, duration=None):
+        threading.Thread(target=self._motionPeriod, args=(self.duration if duration is None else duration,), name="mock-pir-motion", daemon=True).start()
+
+    def _motionPeriod(self, duration):
+        self._no_motion.clear()
+        self._motion.set()
+        if self.when_motion:
+            self.when_motion()
+        sleep(duration)
+        self._motion.clear()
+        self._no_motion.set()
+        if self.when_no_motion:
+            self.when_no_motion()
+
+    def _autoTrigger(self, interval):
+        while True:
+            sleep(interval)
+            self._motionPeriod(self.duration)
+
+#Define the MockCamera class, which implements the parts of picamera's PiCamera the sensor program uses. Every capture is the same JPEG,
+#unless 'synthetic' is true (or WATCHFUL_MOCK_SYNTHETIC is set), in which case the camera cycles through the frames from syntheticFrames().
+#capture_continuous() produces frames at the requested framerate, so it can stand in as a synthetic frame source for the warm camera.
+class MockCamera:
+    def __init__(self, *args, resolution=(640, 480), framerate=30, synthetic=None, **kwargs):
+        self.framerate = framerate
+        self.closed = False
+        if synthetic is None:
+            synthetic = bool(os.environ.get('WATCHFUL_MOCK_SYNTHETIC'))
+        if synthetic:
+            self.frames = syntheticFrames(tuple(resolution))
+        else:
+            with open(MOCK_IMAGE_PATH, 'rb') as image:
+                self.frames = [image.read()]
+        self.frame = 0
+
+    @property
+    def image(self):
+        image = self.frames[self.frame % len(self.frames)]
+        self.frame += 1
+        return image
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def capture(self, output, format='jpeg', **kwargs):
+        output.write(self.image)
+
+    def capture_continuous(self, output, format='jpeg', **kwargs):
+        while not self.closed:
+            sleep(1 / self.framerate)
+            output.write(self.image)
+            yield output
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+
+import threading
+import numpy
+from io import BytesIO
+from PIL import Image
+
+#Vision gate for the sensor. The PIR sensor fires on anything warm that moves, including radiators switching on, sunlight and pets, and every trigger costs an upload, a Face API call, an email and storage on the hub.
+#The gate keeps a model of what the camera normally sees and measures how much of the picture has changed in the frames after a trigger; triggers where too little has changed can be dropped or sent as low priority.
+#Frames are compared as small grayscale images (80x60 by default). JPEG decoders can scale down by up to 8x while decoding, which makes this far cheaper than decoding the full frame.
+
+#Define the MotionGate class. update() is called with every frame the warm camera captures and folds it into a rolling background (an exponentially weighted average of past frames);
+#score() returns the fraction of pixels in a set of frames that differ from the background by more than 'pixel_threshold' grey levels, and passes() compares a score against 'threshold'.
+#Pixels that differ from the background are assumed to be something moving and are blended in far more slowly, so someone walking past doesn't become part of the background,
+#while slower changes (the light through the day, a moved chair) are absorbed after a while.
+class MotionGate:
+    def __init__(self, threshold=0.01, pixel_threshold=25, size=(80, 60), learning_rate=0.05, foreground_rate=0.005):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.size = size
+        self.learning_rate = learning_rate
+        self.foreground_rate = foreground_rate
+        self.background = None
+        self.frames = 0
+        self.lock = threading.Lock()
+
+    def pixels(self, frame):
+        with Image.open(BytesIO(frame)) as im:
+            im.draft('L', self.size)
+            im = im.convert('L')
+            if im.size != self.size:
+                im = im.resize(self.size, Image.BILINEAR)
+            return numpy.asarray(im, dtype=numpy.float32)
+
+    def update(self, frame):
+        pixels = self.pixels(frame)
+        with self.lock:
+            if self.background is None:
+                self.background = pixels.copy()
+            else:
+                difference = pixels - self.background
+                rate = numpy.where(numpy.abs(difference) > self.pixel_threshold, self.foreground_rate, self.learning_rate)
+                self.background += rate * difference
+            self.frames += 1
+
+    #Score a trigger from the frames captured after it (the highest score of any of them). Returns None if there is no background yet to compare against.
+    def score(self, frames):
+        with self.lock:
+            background = None if self.background is None else self.background.copy()
+        if background is None or not frames:
+            return None
+        return max(float(numpy.count_nonzero(numpy.abs(self.pixels(frame) - background) > self.pixel_threshold)) / background.size for frame in frames)
+
+    #An event without a score (the camera hadn't captured anything to build a background from) is always let through.
+    def passes(self, score):
+        return score is None or score >= self.threshold
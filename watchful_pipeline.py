@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+
+import logging
+import queue
+import threading
+from time import monotonic, perf_counter, sleep
+from watchful_metrics import REGISTRY
+
+#Sentinel placed on a stage's queue to tell its workers to exit.
+_STOP = object()
+
+#How long items wait in each stage's queue, and how long the stage's handler takes with them.
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('watchful_stage_queue_wait_seconds', 'Time items waited in a pipeline stage queue before a worker picked them up', ['stage'])
+STAGE_SECONDS = REGISTRY.histogram('watchful_stage_seconds', 'Time a pipeline stage spent processing an item', ['stage'])
+
+#Define the Stage class used to build the hub's event pipeline. Each stage has a bounded input queue drained by its own pool of worker threads.
+#The handler is called with each item; whatever it returns is passed on to the next stage (returning None drops the item).
+#Because the queues are bounded, a slow stage fills its queue and blocks the stage before it. This is the pipeline's backpressure, and the time spent blocked is recorded so it shows up in the stats.
+class Stage:
+    def __init__(self, name, handler, workers=1, maxsize=32):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.queue = queue.Queue(maxsize=max(1, int(maxsize)))
+        self.next_stage = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+        self.blocked_puts = 0
+        self.blocked_seconds = 0.0
+        self.high_water = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=self.name + "-" + str(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    #Add an item to this stage's queue. If the queue is full this blocks until a worker frees a slot, and the wait is counted as backpressure.
+    def put(self, item):
+        item = (perf_counter(), item)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            started = monotonic()
+            self.queue.put(item)
+            with self._lock:
+                self.blocked_puts += 1
+                self.blocked_seconds += monotonic() - started
+        depth = self.queue.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            queued, item = item
+            started = perf_counter()
+            QUEUE_WAIT_SECONDS.observe(started - queued, self.name)
+            with self._lock:
+                self.busy += 1
+            try:
+                result = self.handler(item)
+            except Exception:
+                logging.exception("Stage " + self.name + " failed to process an item")
+                with self._lock:
+                    self.failed += 1
+                result = None
+            else:
+                with self._lock:
+                    self.processed += 1
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                STAGE_SECONDS.observe(perf_counter() - started, self.name)
+            if result is not None and self.next_stage:
+                self.next_stage.put(result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self.queue.qsize(),
+                "capacity": self.queue.maxsize,
+                "high_water": self.high_water,
+                "busy": self.busy,
+                "workers": self.workers,
+                "processed": self.processed,
+                "failed": self.failed,
+                "blocked_puts": self.blocked_puts,
+                "blocked_seconds": round(self.blocked_seconds, 3)
+            }
+
+#Define the Pipeline class, which chains stages together in order so each stage feeds the next one.
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = stages
+        for current, following in zip(stages, stages[1:]):
+            current.next_stage = following
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    #Stop the stages in order, so that anything already queued drains through the later stages before they stop.
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    #Export the stages' queue depths and counts as metrics (they are read from stats() when the metrics are collected, so this adds nothing to the work of the stages).
+    def registerMetrics(self, registry=REGISTRY):
+        def collect(key):
+            return lambda: {(name,): stats[key] for name, stats in self.stats().items()}
+        registry.gauge('watchful_stage_queue_depth', 'Items waiting in a pipeline stage queue', collect('queued'), ['stage'])
+        registry.gauge('watchful_stage_busy_workers', 'Pipeline stage workers currently processing an item', collect('busy'), ['stage'])
+        registry.countedBy('watchful_stage_processed_total', 'Items a pipeline stage has processed', collect('processed'), ['stage'])
+        registry.countedBy('watchful_stage_failed_total', 'Items a pipeline stage failed to process', collect('failed'), ['stage'])
+        registry.countedBy('watchful_stage_blocked_seconds_total', 'Time spent waiting for room in a full pipeline stage queue', collect('blocked_seconds'), ['stage'])
+
+    #Start a background thread that logs the pipeline stats every 'interval' seconds, skipping the log line when nothing has changed.
+    def reportStats(self, interval):
+        def report():
+            previous = None
+            while True:
+                sleep(interval)
+                stats = self.stats()
+                if stats != previous:
+                    logging.info("Pipeline stats: " + str(stats))
+                    previous = stats
+        thread = threading.Thread(target=report, name="pipeline-stats", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+
+import logging
+import socket
+import threading
+from urllib.parse import urlsplit
+
+#Relay for the sensors' live video. In streaming mode a sensor runs mjpg_streamer, which serves MJPEG: a multipart/x-mixed-replace HTTP response with one JPEG per part, for as long as the client stays connected.
+#Rather than every browser connecting to the sensor (each one another full-rate stream over the sensor's Wi-Fi), the hub opens one connection per sensor and passes the frames on to every viewer.
+
+#Longest a part's headers or (without a Content-Length) a whole frame may grow to before the stream is treated as broken, so a bad upstream can't make the hub buffer without limit.
+MAX_FRAME_SIZE = 8 << 20
+
+#Parse an MJPEG stream into frames. 'readinto' fills a buffer with the next bytes of the response body (e.g. a socket's recv_into) and returns how many it read, or 0 at the end of the stream.
+#Data is read into a fixed chunk and appended to a working buffer through memoryview slices, and each frame is cut out of the buffer with a single copy, which is the one copy of the frame every viewer then shares.
+#Parts normally have a Content-Length (mjpg_streamer sends one); if not, the frame runs up to the next boundary.
+def mjpegFrames(readinto, boundary, initial=b'', chunk_size=65536):
+    delimiter = b'--' + boundary
+    buffer = bytearray(initial)
+    chunk = bytearray(chunk_size)
+    view = memoryview(chunk)
+    while True:
+        while True:
+            start = buffer.find(delimiter)
+            if start < 0:
+                #Keep just enough of the end of the buffer to find a delimiter that is split across reads.
+                del buffer[:max(0, len(buffer) - len(delimiter))]
+                break
+            headers_end = buffer.find(b'\r\n\r\n', start)
+            if headers_end < 0:
+                break
+            length = None
+            for line in bytes(buffer[start:headers_end]).split(b'\r\n')[1:]:
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = int(value)
+            body = headers_end + 4
+            if length is not None:
+                if len(buffer) < body + length:
+                    if length > MAX_FRAME_SIZE:
+                        raise ValueError("MJPEG frame of " + str(length) + " bytes is too large")
+                    break
+                end = following = body + length
+            else:
+                following = buffer.find(delimiter, body)
+                if following < 0:
+                    break
+                end = following - 2 if buffer[following - 2:following] == b'\r\n' else following
+            with memoryview(buffer) as frames:
+                frame = bytes(frames[body:end])
+            del buffer[:following]
+            yield frame
+        if len(buffer) > MAX_FRAME_SIZE:
+            raise ValueError("No complete MJPEG frame in " + str(len(buffer)) + " bytes")
+        count = readinto(view)
+        if not count:
+            return
+        buffer += view[:count]
+
+#Define the StreamRelay class: one connection to a sensor's MJPEG stream, shared by all of its viewers.
+#A thread reads the stream and keeps only the latest frame, which viewers pick up from frames(). A viewer that is slower than the stream (a slow network, a busy browser) just gets the newest frame
+#each time it is ready for one and skips the ones in between, so it neither holds up the relay or the other viewers nor builds up a backlog of stale video.
+class StreamRelay:
+    def __init__(self, url, timeout=10.0):
+        self.url = url
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.frame = None
+        self.sequence = 0
+        self.viewers = 0
+        self.finished = False
+        self.socket = None
+        self.received = 0
+        self.thread = threading.Thread(target=self._run, name="relay", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    #Close the upstream connection (when the last viewer has gone). Shutting the socket down wakes the relay thread if it is waiting for data.
+    def close(self):
+        with self.condition:
+            self.finished = True
+            if self.socket:
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.condition.notify_all()
+
+    #Yield frames to one viewer, newest first, for as long as the upstream keeps sending them. Stops if no new frame arrives within the timeout or the upstream has closed.
+    #'skipped' is passed the number of frames the viewer missed each time it falls behind.
+    def frames(self, skipped=None):
+        last = 0
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.sequence != last or self.finished, self.timeout) or self.sequence == last:
+                    return
+                frame = self.frame
+                if skipped and last and self.sequence - last > 1:
+                    skipped(self.sequence - last - 1)
+                last = self.sequence
+            yield frame
+
+    def _connect(self):
+        url = urlsplit(self.url)
+        connection = socket.create_connection((url.hostname, url.port or 80), timeout=self.timeout)
+        with self.condition:
+            self.socket = connection
+            if self.finished:
+                raise ConnectionAbortedError("Relay closed while connecting")
+        path = (url.path or '/') + ('?' + url.query if url.query else '')
+        connection.sendall(('GET ' + path + ' HTTP/1.0\r\nHost: ' + url.netloc + '\r\n\r\n').encode())
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = connection.recv(4096)
+            if not data or len(response) > 65536:
+                raise ConnectionError("No response headers from " + self.url)
+            response += data
+        headers, _, body = response.partition(b'\r\n\r\n')
+        lines = headers.split(b'\r\n')
+        if len(lines[0].split()) < 2 or lines[0].split()[1] != b'200':
+            raise ConnectionError("Unexpected response from " + self.url + ": " + lines[0].decode(errors='replace'))
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-type' and b'boundary=' in value:
+                return connection, value.split(b'boundary=', 1)[1].split(b';')[0].strip().strip(b'"'), body
+        raise ConnectionError("Response from " + self.url + " is not a multipart stream")
+
+    def _run(self):
+        connection = None
+        try:
+            connection, boundary, body = self._connect()
+            logging.info("Relaying " + self.url)
+            for frame in mjpegFrames(connection.recv_into, boundary, body):
+                with self.condition:
+                    if self.finished:
+                        break
+                    self.frame = frame
+                    self.sequence += 1
+                    self.received += 1
+                    self.condition.notify_all()
+        except (OSError, ValueError) as e:
+            if not self.finished:
+                logging.warning("Stream from " + self.url + " failed: " + str(e))
+        finally:
+            if connection:
+                connection.close()
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+            logging.info("Stopped relaying " + self.url + " after " + str(self.received) + " frames")
+
+#Define the StreamRelays class, which keeps one StreamRelay per sensor while it has viewers. join() returns the sensor's relay (starting one if needed) and counts the viewer in;
+#leave() counts the viewer out, and closes the relay once it has no viewers left. A relay whose upstream has ended is replaced by a fresh one for the next viewer.
+class StreamRelays:
+    def __init__(self, timeout=10.0):
+        self.timeout = timeout
+        self.relays = {}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.skipped = 0
+
+    def join(self, sensor, url):
+        with self.lock:
+            relay = self.relays.get(sensor)
+            if relay is None or relay.finished:
+                relay = self.relays[sensor] = StreamRelay(url, timeout=self.timeout)
+                relay.start()
+            relay.viewers += 1
+            return relay
+
+    def leave(self, sensor, relay):
+        with self.lock:
+            relay.viewers -= 1
+            if relay.viewers > 0:
+                return
+            if self.relays.get(sensor) is relay:
+                del self.relays[sensor]
+        relay.close()
+
+    #Yield one viewer's frames from a relay, keeping count of the frames sent and skipped.
+    def frames(self, relay):
+        for frame in relay.frames(skipped=self._skipped):
+            self.sent += 1
+            yield frame
+
+    def _skipped(self, count):
+        self.skipped += count
+
+    def stats(self):
+        with self.lock:
+            relays = list(self.relays.values())
+        return {"upstreams": len(relays), "viewers": sum(relay.viewers for relay in relays), "sent": self.sent, "skipped": self.skipped}
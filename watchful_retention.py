@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+import datetime
+import gzip
+import logging
+import os
+import threading
+from io import BytesIO
+from bson import Binary, json_util
+from bson import encode as encodeBson
+from pymongo import ASCENDING
+from time import sleep, monotonic
+from watchful_storage import IMAGE_BUCKET, imageId, imageStore, loadImage
+from watchful_metrics import REGISTRY
+
+#Retention for stored events, so the database doesn't grow forever. Each sensor's events move through three tiers as they age:
+#  full       -- the event has every image: the original, its derivatives and any burst frames (as stored by the hub).
+#  thumbnail  -- after 'full_days', the images are deleted from GridFS and only the thumbnail is kept, inside the event document itself.
+#  gone       -- after 'thumbnail_days', the event is either deleted or archived: appended (with its thumbnail) to a gzipped JSON lines file and then deleted.
+#Once an event only has its thumbnail, nothing else refers to it, so where the policy is to delete, the event gets an 'expire_at' date and MongoDB's TTL monitor removes it (see createIndexes).
+#Archiving needs the file written first, so archived events are removed by the retention job itself. 'expire_at' is set at compaction, so where the policy is to delete, the job also deletes thumbnail-only events
+#past 'thumbnail_days' itself: those compacted while the sensor's policy was to archive, or before its 'thumbnail_days' was shortened, which have no 'expire_at' or a later one.
+RETENTION_EVENTS = REGISTRY.counter('watchful_retention_events_total', 'Events moved down a retention tier, by what was done to them', ['action'])
+RETENTION_BYTES = REGISTRY.counter('watchful_retention_bytes_reclaimed_total', 'Bytes of images and event documents removed from MongoDB by the retention job')
+
+ACTIONS = ['delete', 'archive']
+
+#Size and JPEG quality of thumbnails made for events that don't have one (events stored before thumbnails were generated at ingest). Matches the hub's 'thumb' derivative.
+THUMBNAIL_SIZE = ((320, 240), 70)
+
+#Define the RetentionPolicy class: how long a sensor's events keep their full images, how long they keep their thumbnail, and what happens to them after that.
+class RetentionPolicy:
+    def __init__(self, full_days=30, thumbnail_days=365, action='archive'):
+        full_days = float(full_days)
+        thumbnail_days = float(thumbnail_days)
+        if full_days < 0 or thumbnail_days < full_days:
+            raise ValueError("Retention periods must satisfy 0 <= full_days <= thumbnail_days")
+        if action not in ACTIONS:
+            raise ValueError("Retention action must be one of " + ", ".join(ACTIONS))
+        self.full_days = full_days
+        self.thumbnail_days = thumbnail_days
+        self.action = action
+
+    def asDict(self):
+        return {"full_days": self.full_days, "thumbnail_days": self.thumbnail_days, "action": self.action}
+
+#Read the default policy from the .env config.
+def defaultPolicy(config):
+    return RetentionPolicy(config.get('retentionFullDays', 30), config.get('retentionThumbnailDays', 365), config.get('retentionAction', 'archive'))
+
+#Policies for individual sensors are kept in the retention_policies collection (one document per sensor, keyed by sensor id), and are set through the web interface's API.
+#Return the policy for a sensor, or 'default' if it doesn't have one.
+def sensorPolicy(db, sensor, default):
+    document = db.retention_policies.find_one({"_id": sensor})
+    if document is None:
+        return default
+    return RetentionPolicy(document['full_days'], document['thumbnail_days'], document['action'])
+
+def setSensorPolicy(db, sensor, policy):
+    db.retention_policies.replace_one({"_id": sensor}, policy.asDict(), upsert=True)
+
+def clearSensorPolicy(db, sensor):
+    db.retention_policies.delete_one({"_id": sensor})
+
+def makeThumbnail(image):
+    from PIL import Image
+    size, quality = THUMBNAIL_SIZE
+    with Image.open(BytesIO(image)) as im:
+        im.draft('RGB', size)
+        im = im.convert('RGB')
+        im.thumbnail(size)
+        output = BytesIO()
+        im.save(output, format="jpeg", quality=quality, optimize=True)
+        return output.getvalue()
+
+#Define the RetentionJob class, which applies each sensor's policy to its events from a background thread, every 'interval' seconds.
+#Work is done in batches of at most 'batch_size' events with a 'pause' between them, so a pass over a large backlog (e.g. the first pass on an old database) is spread out
+#and never holds up the hub's own reads and writes for long. Each batch is found with the (retention, sensor, timestamp) index, so events that are already done aren't scanned again.
+#Bytes reclaimed count the images deleted (less the thumbnail kept), legacy base64 images removed from documents, and the documents of archived and deleted events.
+class RetentionJob:
+    def __init__(self, db, default_policy, archive_directory='archive', batch_size=100, pause=0.5, interval=3600.0):
+        self.db = db
+        self.events = db.security_events
+        self.image_store = imageStore(db)
+        self.files = db[IMAGE_BUCKET + '.files']
+        self.chunks = db[IMAGE_BUCKET + '.chunks']
+        self.default_policy = default_policy
+        self.archive_directory = archive_directory
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.compacted = 0
+        self.archived = 0
+        self.deleted = 0
+        self.expiring = 0
+        self.bytes_reclaimed = 0
+        self.longest_batch = 0.0
+
+    def start(self):
+        threading.Thread(target=self._run, name="retention", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.runPass()
+            except Exception:
+                logging.exception("Retention pass failed")
+            sleep(self.interval)
+
+    #Apply every sensor's policy once. Returns the number of events compacted, archived and deleted and the bytes reclaimed by this pass.
+    def runPass(self, now=None):
+        now = now or datetime.datetime.utcnow()
+        before = (self.compacted, self.archived, self.deleted, self.bytes_reclaimed)
+        for sensor in self.events.distinct("sensor"):
+            policy = sensorPolicy(self.db, sensor, self.default_policy)
+            self._batches(self._compactBatch, sensor, policy, now - datetime.timedelta(days=policy.full_days))
+            if policy.action == 'archive':
+                self._batches(self._archiveBatch, sensor, policy, now - datetime.timedelta(days=policy.thumbnail_days))
+            else:
+                self._batches(self._deleteBatch, sensor, policy, now - datetime.timedelta(days=policy.thumbnail_days))
+        compacted, archived, deleted, reclaimed = self.compacted - before[0], self.archived - before[1], self.deleted - before[2], self.bytes_reclaimed - before[3]
+        if compacted or archived or deleted:
+            logging.info("Retention: " + str(compacted) + " events reduced to thumbnails, " + str(archived) + " archived, " + str(deleted) + " deleted, " + str(reclaimed) + " bytes reclaimed")
+        return {"compacted": compacted, "archived": archived, "deleted": deleted, "bytes_reclaimed": reclaimed}
+
+    def stats(self):
+        return {"compacted": self.compacted, "archived": self.archived, "deleted": self.deleted, "expiring": self.expiring, "bytes_reclaimed": self.bytes_reclaimed, "longest_batch": self.longest_batch}
+
+    def _batches(self, handler, sensor, policy, cutoff):
+        while True:
+            started = monotonic()
+            count = handler(sensor, policy, cutoff)
+            self.longest_batch = max(self.longest_batch, monotonic() - started)
+            if count < self.batch_size:
+                return
+            sleep(self.pause)
+
+    #Reduce a batch of events older than the cutoff to their thumbnail. The thumbnail is written into the event before any image is deleted, so an event is never left with no image.
+    def _compactBatch(self, sensor, policy, cutoff):
+        events = list(self.events.find({"retention": None, "sensor": sensor, "timestamp": {"$lt": cutoff}}, {"timestamp": 1, "burst_frames": 1, "captured_image": 1})
+            .sort([("timestamp", ASCENDING)])
+            .limit(self.batch_size))
+        file_ids = []
+        reclaimed = 0
+        for event in events:
+            event_id = event['_id']
+            thumbnail = self._thumbnail(event_id)
+            update = {"$set": {"retention": "thumbnail"}, "$unset": {"captured_image": "", "burst_frames": ""}}
+            if thumbnail is not None:
+                update["$set"]["thumbnail"] = Binary(thumbnail)
+                reclaimed -= len(thumbnail)
+            if policy.action == 'delete':
+                update["$set"]["expire_at"] = event['timestamp'] + datetime.timedelta(days=policy.thumbnail_days)
+                self.expiring += 1
+            self.events.update_one({"_id": event_id}, update)
+            reclaimed += len(event.get('captured_image') or '')
+            file_ids.extend([imageId(event_id, size) for size in ('original', 'preview', 'thumb')])
+            file_ids.extend([imageId(event_id, 'frame' + str(number)) for number in range(event.get('burst_frames', 0))])
+        if file_ids:
+            reclaimed += sum(file.get('length', 0) for file in self.files.find({"_id": {"$in": file_ids}}, {"length": 1}))
+            self.files.delete_many({"_id": {"$in": file_ids}})
+            self.chunks.delete_many({"files_id": {"$in": file_ids}})
+        self.compacted += len(events)
+        self.bytes_reclaimed += reclaimed
+        RETENTION_EVENTS.inc('compacted', amount=len(events))
+        RETENTION_BYTES.inc(amount=reclaimed)
+        return len(events)
+
+    #Return the event's thumbnail, making one from its original image if it doesn't have one, or None if the event has no image at all.
+    def _thumbnail(self, event_id):
+        image, image_id = loadImage(self.image_store, self.events, event_id, 'thumb')
+        if image is None or image_id == imageId(event_id, 'thumb'):
+            return image
+        return makeThumbnail(image)
+
+    #Archive a batch of thumbnail-only events older than the cutoff, then delete them. Events go into one file per sensor per month (archive/<sensor>/<YYYY-MM>.jsonl.gz),
+    #one JSON document per line (MongoDB extended JSON, so bson.json_util.loads() gives back the original document, thumbnail and all).
+    #Each batch is appended as its own gzip member, which gzip and zcat read as one file. If the hub stops between writing a batch and deleting it, the batch is archived again next time.
+    def _archiveBatch(self, sensor, policy, cutoff):
+        events = list(self.events.find({"retention": "thumbnail", "sensor": sensor, "timestamp": {"$lt": cutoff}})
+            .sort([("timestamp", ASCENDING)])
+            .limit(self.batch_size))
+        if not events:
+            return 0
+        months = {}
+        for event in events:
+            months.setdefault(event['timestamp'].strftime('%Y-%m'), []).append(event)
+        directory = os.path.join(self.archive_directory, sensor)
+        os.makedirs(directory, exist_ok=True)
+        for month, batch in months.items():
+            with gzip.open(os.path.join(directory, month + '.jsonl.gz'), 'at') as archive:
+                for event in batch:
+                    archive.write(json_util.dumps(event) + '\n')
+        self.events.delete_many({"_id": {"$in": [event['_id'] for event in events]}})
+        reclaimed = sum(len(encodeBson(event)) for event in events)
+        self.archived += len(events)
+        self.bytes_reclaimed += reclaimed
+        RETENTION_EVENTS.inc('archived', amount=len(events))
+        RETENTION_BYTES.inc(amount=reclaimed)
+        return len(events)
+
+    #Delete a batch of thumbnail-only events older than the cutoff, for sensors whose policy is to delete. Most of them are removed by the TTL monitor before they get here;
+    #this catches the ones whose 'expire_at' is missing or later than the policy now allows.
+    def _deleteBatch(self, sensor, policy, cutoff):
+        events = list(self.events.find({"retention": "thumbnail", "sensor": sensor, "timestamp": {"$lt": cutoff}})
+            .sort([("timestamp", ASCENDING)])
+            .limit(self.batch_size))
+        if not events:
+            return 0
+        self.events.delete_many({"_id": {"$in": [event['_id'] for event in events]}})
+        reclaimed = sum(len(encodeBson(event)) for event in events)
+        self.deleted += len(events)
+        self.bytes_reclaimed += reclaimed
+        RETENTION_EVENTS.inc('deleted', amount=len(events))
+        RETENTION_BYTES.inc(amount=reclaimed)
+        return len(events)
@@ -1,27 +1,48 @@
 #!/usr/bin/python3
 
+import collections
 import datetime
+import json
 import logging
+import os
 import redis
-import base64
 import socket
 import struct
+import threading
 import subprocess
 from subprocess import DEVNULL
 from bson.objectid import ObjectId
 from io import BytesIO
-from gpiozero import MotionSensor
-from picamera import PiCamera
 from time import sleep
+from watchful_events import encodeEvent
+from watchful_streams import publishEvent
+from watchful_camera import WarmCamera, PiCameraSource
 
-#Define the SecurityEvent class used to log events.
+#Use the real PIR sensor and camera unless WATCHFUL_MOCK_HARDWARE is set, in which case use the stand-ins from watchful_mock.py so the sensor can run on a normal Linux box.
+if os.environ.get('WATCHFUL_MOCK_HARDWARE'):
+    from watchful_mock import MockMotionSensor as MotionSensor, MockCamera as PiCamera
+else:
+    from gpiozero import MotionSensor
+    from picamera import PiCamera
+
+#Define the SecurityEvent class used to log events. encode() returns the event in the binary wire format the hub expects (see watchful_events.py).
+#An event can carry a burst of frames from around the time of the trigger, in which case 'key_frame' is the index of the frame used as the event's main image.
+#'motion_score' is the score the motion gate gave the frames after the trigger, if the gate is on.
 class SecurityEvent:
-    event_data = {}
-    def __init__(self, captured_image):
+    def __init__(self, captured_image, burst=None, key_frame=0, motion_score=None):
+        self.event_data = {}
         self.event_data["_id"] = str(ObjectId())
         self.event_data["sensor"] = str(sensorId)
-        self.event_data["timestamp"] = str(datetime.datetime.utcnow())
+        self.event_data["timestamp"] = datetime.datetime.utcnow()
         self.event_data["captured_image"] = captured_image
+        if burst:
+            self.event_data["burst"] = burst
+            self.event_data["key_frame"] = key_frame
+        if motion_score is not None:
+            self.event_data["motion_score"] = motion_score
+
+    def encode(self):
+        return encodeEvent(self.event_data)
 
 #Enable informational logging.
 logging.basicConfig(level=logging.INFO)
@@ -37,12 +58,53 @@ logging.info("This sensor is identified as " + str(sensorId))
 #Intialise PIR sensor (this prototype has it connected on GPIO 17).
 pirSensor = MotionSensor(17)
 
-#Variable to track whether the system is discoverable, initial state is true.
+#Variable to track whether the system is discoverable, initial state is true. The 'discovered' event is set at the same time it becomes false, so other threads can wait for it.
 discoverable = True
+discovered = threading.Event()
 
 #Variable to track system mode (0=standby, 1=sensing, 2=streaming).
 sensorMode = 0
 
+#The current mode is also stored in Redis on the hub (see setMode()). The key expires after modeTTL seconds unless it is refreshed, so a sensor that dies stops showing a stale mode.
+modeTTL = 30
+
+#After publishing an event, the sensor waits for the motion to stop and then another eventCooldown seconds before it will record the next one.
+#WATCHFUL_EVENT_COOLDOWN overrides it, e.g. so a benchmark can drive mock sensors faster than a real one would fire.
+eventCooldown = float(os.environ.get('WATCHFUL_EVENT_COOLDOWN', 5))
+
+#Set by the PIR sensor's when_motion callback to wake the watching() thread.
+motion = threading.Event()
+
+#While sensing, the camera is kept open and continuously captures frames into an in-memory ring buffer, so an event can include frames from just before and just after the trigger.
+#The buffer holds bufferFrames frames captured at burstFramerate frames per second; each event publishes up to preTriggerFrames frames from before the trigger and postTriggerFrames from after it.
+burstFramerate = 4
+bufferFrames = 16
+preTriggerFrames = 4
+postTriggerFrames = 4
+
+#Optional vision gate (see watchful_motion.py), to cut down on events caused by heat rather than movement. WATCHFUL_MOTION_GATE sets what happens to a trigger where less than
+#WATCHFUL_MOTION_THRESHOLD of the picture changed: 'drop' doesn't publish it, 'flag' publishes it marked as low priority (the hub stores it, but skips face detection and the email alert),
+#and 'off' (the default) doesn't run the gate at all. Needs NumPy and Pillow, which are only imported when the gate is on.
+motionGateMode = os.environ.get('WATCHFUL_MOTION_GATE', 'off')
+if motionGateMode not in ('off', 'flag', 'drop'):
+    raise ValueError("WATCHFUL_MOTION_GATE must be off, flag or drop, not " + motionGateMode)
+motionGate = None
+if motionGateMode != 'off':
+    from watchful_motion import MotionGate
+    motionGate = MotionGate(threshold=float(os.environ.get('WATCHFUL_MOTION_THRESHOLD', 0.01)))
+camera = WarmCamera(lambda: PiCameraSource(PiCamera, resolution=(640, 480), framerate=burstFramerate), buffer_size=bufferFrames, on_frame=motionGate.update if motionGate else None)
+
+#Events wait in the sensor's stream on the hub until the hub has stored them. The stream is capped at roughly this many events, so a long hub outage can't fill the hub's memory (a burst is a few hundred KB).
+streamMaxLength = 50
+
+#Events waiting to be appended to the sensor's stream on the hub. eventPublisher() sends them in order, so if the hub's Redis can't be reached (e.g. while the hub restarts) they wait here,
+#and it tries again after publishRetryInitial seconds, doubling the wait each time up to publishRetryMaximum. Only the newest outboxLength events are kept, so a long outage can't fill the sensor's memory.
+outboxLength = 10
+outbox = collections.deque(maxlen=outboxLength)
+outboxChanged = threading.Condition()
+publishRetryInitial = 0.5
+publishRetryMaximum = 30.0
+
 #Variable that will be used to manage video stream processes (needs to be global so we can terminate these processes when we want to switch back to 'sense' mode).
 videoStream = None
 
@@ -50,30 +112,87 @@ videoStream = None
 SSDP_MCAST_IP = '239.255.255.250'
 SSDP_PORT = 5007
 
-#Define the function that will be used to capture from the camera and return a base64 encoded image. Uses BytesIO to store a file-like stream in memory rather than writing the image to storage.
+#Define the function that will be used to capture from the camera and return the JPEG image bytes. Uses BytesIO to store a file-like stream in memory rather than writing the image to storage.
 def captureImage():
     with BytesIO() as stream:
         with PiCamera() as camera:
             camera.capture(stream, format='jpeg', resize=(640, 480))
-        stream.seek(0)
-        encoded_image = base64.b64encode(stream.read())
-    return encoded_image
+        return stream.getvalue()
 	
-#Define the function to return a SecurityEvent object when an event occurs, calls the captureImage() method to include an image.
+#Define the function to return a SecurityEvent object when an event occurs. Takes a burst of frames from the warm camera if it's running, or calls the captureImage() method to include a single image if not.
+#If the motion gate is on, the frames from the key frame onwards are scored against its background.
 def eventOccurred():
-    event = SecurityEvent(captureImage())
-    return event
+    if camera.running:
+        frames, key_frame = camera.burst(preTriggerFrames, postTriggerFrames)
+        if frames:
+            motion_score = motionGate.score(frames[key_frame:]) if motionGate else None
+            return SecurityEvent(frames[key_frame], burst=frames, key_frame=key_frame, motion_score=motion_score)
+        logging.info("No frames from the camera, capturing a single image instead")
+        camera.stop()
+        event = SecurityEvent(captureImage())
+        camera.start()
+        return event
+    return SecurityEvent(captureImage())
 
-#Define the fuction that will be called from the main loop when the system is set to 'sense'. Will record a security event when motion is detected, then wait until motion has stopped + 5 seconds.
-#The recorded events (including base64 encoded image) are published to a messaging channel with the same name as the sensorId, which the hub will be subscribed to.
+#Define the callback the PIR sensor calls when it detects motion. gpiozero calls it from its own thread, so it just wakes the watching() thread rather than capturing there.
+def motionDetected():
+    if sensorMode == 1:
+        motion.set()
+
+#Define the fuction that waits for motion while the system is set to 'sense'. Will record a security event when motion is detected, then wait until motion has stopped + eventCooldown seconds.
+#The recorded events (including the JPEG images) are queued for eventPublisher(), which appends them to this sensor's event stream in Redis on the hub, where they wait until the hub has stored them.
+#Blocks until the PIR sensor's callback fires, rather than polling the sensor. Events the motion gate scores below its threshold are dropped or marked low priority, depending on motionGateMode.
 def watching():
-    if pirSensor.motion_detected:
+    while True:
+        motion.wait()
+        motion.clear()
+        if sensorMode != 1:
+            continue
         logging.info("Motion has been detected")
         event = eventOccurred()
-        logging.info("Publishing event to " + str(sensorId))
-        redis_connection.publish(str(sensorId), str(event.event_data))
+        motion_score = event.event_data.get("motion_score")
+        if motionGate and not motionGate.passes(motion_score):
+            event.event_data["low_priority"] = True
+        if event.event_data.get("low_priority") and motionGateMode == 'drop':
+            logging.info("Not publishing the event: motion score " + str(motion_score) + " is below the threshold")
+        else:
+            logging.info("Publishing event to the event stream for " + str(sensorId) + ("" if motion_score is None else " (motion score " + str(motion_score) + ")"))
+            queueEvent(event.encode())
         pirSensor.wait_for_no_motion()
-        sleep(5)
+        sleep(eventCooldown)
+
+        #Ignore any motion that was signalled during the cool-down period.
+        motion.clear()
+
+#Define the function that hands an encoded event to eventPublisher(). Never blocks, so watching() carries on watching while the hub can't be reached.
+def queueEvent(data):
+    with outboxChanged:
+        if len(outbox) == outbox.maxlen:
+            logging.warning("Too many events waiting for the hub, dropping the oldest one")
+        outbox.append(data)
+        outboxChanged.notify()
+
+#Define the function that appends the queued events to this sensor's stream on the hub, oldest first. It runs in its own thread, and an event only leaves the queue once Redis has accepted it.
+#An event whose XADD reached Redis but whose reply was lost is sent again; the hub stores each event id once, so that just means an extra message in the stream.
+def eventPublisher():
+    delay = publishRetryInitial
+    while True:
+        with outboxChanged:
+            while not outbox:
+                outboxChanged.wait()
+            data = outbox[0]
+        try:
+            publishEvent(redis_connection, sensorId, data, maxlen=streamMaxLength)
+        except (redis.ConnectionError, redis.TimeoutError):
+            logging.info("Lost connection to the hub, " + str(len(outbox)) + " event(s) waiting, retrying in " + str(delay) + " seconds")
+            sleep(delay)
+            delay = min(delay * 2, publishRetryMaximum)
+            continue
+        delay = publishRetryInitial
+        with outboxChanged:
+            #The event may have been dropped from a full queue while it was being sent.
+            if outbox and outbox[0] is data:
+                outbox.popleft()
 
 #Define the function used to check header values in SSDP requests (this is adapted from week 7 lab 2).
 def headerValue(response, header):
@@ -82,90 +201,128 @@ def headerValue(response, header):
         if line.startswith(header):
             return line[line.find(":")+1:]
 
-#Define the function that will be called from the main loop when the system is discoverable.
+#Define the function that responds to discovery requests. It runs in its own thread for as long as the sensor runs, because the hub keeps sending discovery requests and treats sensors that stop answering as gone.
 #This is adapted from week 7 lab 2 and adds logic to connect to the redis server on the device that sent the SSDP request (since it).
-#Since the IP of the hub device is known once the request is received, we can use this information to connect to redis on the hub, and subscribe to the messaging channel we will use to receive commands.
-#The SSDP request is acknowledged by sending back the identifier of the sensor device and its IP address. Finally, the function sets the 'discoverable' variable to false.
+#Since the IP of the hub device is known once the first request is received, we can use this information to connect to redis on the hub, and subscribe to the messaging channel we will use to receive commands.
+#Every SSDP request is acknowledged by sending back the identifier of the sensor device and its IP address. After the first one, the function sets the 'discoverable' variable to false so the main loop can start.
 def discoveryResponse():
-    global discoverable
-    global redis_connection
-    global redis_pubsub
     ssdpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     ssdpSocket.setsockopt(socket.SOL_SOCKET,  socket.SO_REUSEPORT, 1)
     ssdpSocket.bind((SSDP_MCAST_IP, SSDP_PORT))
     mreq = struct.pack("4sl", socket.inet_aton(SSDP_MCAST_IP), socket.INADDR_ANY)
     ssdpSocket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-    while discoverable:
+    while True:
         data, address = ssdpSocket.recvfrom(4096)
         data = str(data.decode('UTF-8'))
-        logging.info('Received ' + str(len(data)) + ' bytes from ' + str(address))
-        if headerValue(data,"ST") == 'urn:watchful_pi':
+        if headerValue(data,"ST") != 'urn:watchful_pi':
+            continue
+        if discoverable:
+            logging.info('Received ' + str(len(data)) + ' bytes from ' + str(address))
             logging.info("Responding to discovery request and connecting to messaging server")
-            redis_connection = redis.StrictRedis(host=address[0], port=6379, db=0)
-            redis_pubsub = redis_connection.pubsub()
-            logging.info("Subscribing to commands channel")
-            redis_pubsub.subscribe('watchful_commands')
-            sleep(5)
-
-            #Redis sends an initial confirmation message when we subscribe to a channel -- get that message before doing anything else so it doesn't cause any issues.
-            message = redis_pubsub.get_message()    
-            logging.info("Response from channel received: " + str(message))
-            ssdpSocket.sendto(str(sensorId).encode(), address)
-            discoverable = False
-
-#Define the function that will be used to get commands from the redis messaging channel we are using for commands, and respond to them.
-#If the command message includes this device's id or 'all', the device's current mode will be updated.
-def getCommand():
+            connectToHub(address[0])
+        ssdpSocket.sendto(str(sensorId).encode(), address)
+
+#Define the function that connects to the redis server on the hub and subscribes to the messaging channel we will use to receive commands, then marks the sensor as discovered.
+def connectToHub(host, port=6379):
+    global discoverable
+    global redis_connection
     global redis_pubsub
-    global sensorMode
+    redis_connection = redis.StrictRedis(host=host, port=port, db=0)
+    redis_pubsub = redis_connection.pubsub()
+    logging.info("Subscribing to commands channel")
+    redis_pubsub.subscribe('watchful_commands')
+
+    #Redis sends an initial confirmation message when we subscribe to a channel -- wait for that message before doing anything else so it doesn't cause any issues.
+    message = redis_pubsub.get_message(timeout=5)
+    logging.info("Response from channel received: " + str(message))
+    discoverable = False
+    discovered.set()
+
+#Define the function that will be used to respond to commands from the redis messaging channel we are using for commands.
+#If the command message includes this device's id or 'all', the device's current mode will be updated.
+def handleCommand(message):
     global videoStream
-    message = redis_pubsub.get_message()
-
-    #Sometimes the subscribtion confirmation comes in late from Redis for some reason -- return to the main loop without doing anything if this happens.
-    if message:
-        if isinstance(message['data'], int):
-            logging.info("Looks like we got a delayed subscription confirmation message:" + str(message))
-            return None     
-
-        #If we get a command message, split it at ':' to separate the sensor id (or 'all') from the command. We only update the device mode if the command is targeted at this device or 'all'.
-        split_message = message['data'].decode('UTF-8').split(":") 
-        id = split_message[0]
-        command = split_message[1]
-        if id == str(sensorId) or id == 'all':
-            if command == '0' and sensorMode != 0:
-                sensorMode = 0
-                if videoStream:
-                    videoStream.terminate() #Note: when changing mode to 0 or 1, we need to kill the videoStream process if active (so it doesn't block access to the camera, among other reasons). This is why we use a global variable to identify this process.
-                logging.info("Sensor is now in standby mode")
-            if command == '1' and sensorMode != 1:
-                sensorMode = 1
-                if videoStream:
-                    videoStream.terminate()
-                logging.info("Sensor is now in motion sensing mode")
-            if command == '2' and sensorMode != 2:
-                sensorMode = 2
-                logging.info("Sensor is now in streaming mode")
-                
-                #Runs a bash command to start mjpg_streamer, send the output to /dev/null, and use the videoStream variable to track the process. 
-                #Interesting note: we need to use 'exec' to start mjpg_streamer, because if we run mjpg_streamer directly the PID tracked in the variable will be the bash shell used to execute mjpg_streamer, not the mjpg_streamer process itself.
-                videoStream = subprocess.Popen('exec mjpg_streamer -i "input_raspicam.so"', shell=True, stdout=DEVNULL, stderr=DEVNULL)
-
-    #We also use the core key-value storage functionality of redis to store the current sensor mode.
-    #We use the sensorId as the key and the current mode as the value. This is simpler than using the message broker functionality to publish the device mode and track that in a separate variable in the hub program. 
-    redis_connection.set(sensorId, sensorMode)
-        
-
-#Main loop that runs when the program is executed. While the device is discoverable, it will respond to discovery requests. Following discovery, calls getCommand() to get commands and update mode.
-#If in mode 1, calls watching() to detect security events and publish them to a messaging channel with the same name as the sensorId, which the hub will be subscribed to.
-def main():
-    global discoverable
+
+    #Sometimes the subscribtion confirmation comes in late from Redis for some reason -- ignore it if this happens.
+    if message['type'] != 'message':
+        logging.info("Looks like we got a delayed subscription confirmation message:" + str(message))
+        return None
+
+    #If we get a command message, split it at ':' to separate the sensor id (or 'all') from the command. We only update the device mode if the command is targeted at this device or 'all'.
+    split_message = message['data'].decode('UTF-8').split(":")
+    id = split_message[0]
+    command = split_message[1]
+    if id == str(sensorId) or id == 'all':
+        if command == '0' and sensorMode != 0:
+            setMode(0)
+            camera.stop()
+            if videoStream:
+                videoStream.terminate() #Note: when changing mode to 0 or 1, we need to kill the videoStream process if active (so it doesn't block access to the camera, among other reasons). This is why we use a global variable to identify this process.
+            logging.info("Sensor is now in standby mode")
+        if command == '1' and sensorMode != 1:
+            setMode(1)
+            if videoStream:
+                videoStream.terminate()
+                videoStream.wait()
+            camera.start()
+            logging.info("Sensor is now in motion sensing mode")
+        if command == '2' and sensorMode != 2:
+            setMode(2)
+
+            #mjpg_streamer needs the camera, so the warm camera has to let go of it first.
+            camera.stop()
+            logging.info("Sensor is now in streaming mode")
+
+            #Runs a bash command to start mjpg_streamer, send the output to /dev/null, and use the videoStream variable to track the process.
+            #Interesting note: we need to use 'exec' to start mjpg_streamer, because if we run mjpg_streamer directly the PID tracked in the variable will be the bash shell used to execute mjpg_streamer, not the mjpg_streamer process itself.
+            videoStream = subprocess.Popen('exec mjpg_streamer -i "input_raspicam.so"', shell=True, stdout=DEVNULL, stderr=DEVNULL)
+
+#Define the function that listens for commands. It runs in its own thread and blocks on the pubsub connection until a command arrives, rather than polling it.
+def commandListener():
     while True:
-        if discoverable:
-            discoveryResponse()
-        else:
-            getCommand()
-            if sensorMode == 1:
-                watching()
+        try:
+            for message in redis_pubsub.listen():
+                handleCommand(message)
+        except redis.ConnectionError:
+            logging.info("Lost connection to the hub, retrying")
+            sleep(1)
+
+#We also use the core key-value storage functionality of redis to store the current sensor mode.
+#We use the sensorId as the key and the current mode as the value. This is simpler than using the message broker functionality to publish the device mode and track that in a separate variable in the hub program.
+#The mode is only written when it changes, and refreshed by modeHeartbeat() before it expires. Each change is also published on the 'watchful_updates' channel, which the web interface relays to open dashboards.
+def setMode(mode):
+    global sensorMode
+    sensorMode = mode
+    transaction = redis_connection.pipeline()
+    transaction.set(sensorId, sensorMode, ex=modeTTL)
+    transaction.publish('watchful_updates', json.dumps({"type": "mode", "sensor": sensorId, "mode": str(sensorMode)}))
+    transaction.execute()
+
+#Define the function that keeps the mode key in Redis alive: one write every third of modeTTL, instead of a write on every pass of the main loop.
+def modeHeartbeat():
+    while True:
+        sleep(modeTTL / 3)
+        try:
+            redis_connection.set(sensorId, sensorMode, ex=modeTTL)
+        except redis.ConnectionError:
+            logging.info("Lost connection to the hub, retrying")
+
+#Define the function that runs the sensor once it has been discovered. Starts threads to listen for commands, keep the sensor mode fresh in Redis and publish events, and hooks the PIR sensor's motion callback up to watching(),
+#which detects security events and publishes them to this sensor's event stream, which the hub reads from.
+#Everything blocks waiting for something to happen, so an idle sensor uses next to no CPU and sends next to nothing to the hub.
+def run():
+    discovered.wait()
+    setMode(sensorMode)
+    threading.Thread(target=commandListener, name="commands", daemon=True).start()
+    threading.Thread(target=modeHeartbeat, name="heartbeat", daemon=True).start()
+    threading.Thread(target=eventPublisher, name="publisher", daemon=True).start()
+    pirSensor.when_motion = motionDetected
+    watching()
+
+#Main function that runs when the program is executed. Starts the discovery responder thread, then runs the sensor once the hub has found it.
+def main():
+    threading.Thread(target=discoveryResponse, name="discovery", daemon=True).start()
+    run()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
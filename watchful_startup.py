@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+
+import logging
+import pymongo
+import redis
+from pymongo.errors import ConnectionFailure
+from time import sleep, monotonic
+
+#Helpers used by the hub and the web interface while they start up. Instead of sleeping for a fixed time and hoping Redis and MongoDB are up by then,
+#each process probes them until they answer. After a power cut everything boots at the same time, so how long the servers take varies from one start to the next.
+
+#Call 'probe' until it returns without raising one of 'errors', and return what it returned. The first retry comes after 'initial' seconds and the wait doubles after each failed attempt, up to 'maximum',
+#so a server that is nearly ready is noticed within milliseconds and one that takes a while isn't hammered. Gives up after 'timeout' seconds by raising the last error.
+def waitFor(description, probe, errors, timeout=60.0, initial=0.01, maximum=1.0):
+    started = monotonic()
+    delay = initial
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            result = probe()
+        except errors as e:
+            if monotonic() - started + delay > timeout:
+                logging.error(description + " did not answer within " + str(timeout) + " seconds")
+                raise
+            if attempts == 1:
+                logging.info("Waiting for " + description + " (" + type(e).__name__ + ")")
+            sleep(delay)
+            delay = min(delay * 2, maximum)
+            continue
+        logging.info(description + " is ready after " + str(int((monotonic() - started) * 1000)) + " ms (" + str(attempts) + " attempts)")
+        return result
+
+#Wait until a Redis server answers a PING. A server that is still loading its data answers with an error that redis-py raises as a ConnectionError, so that is waited out too.
+def waitForRedis(connection, timeout=60.0):
+    return waitFor("Redis", connection.ping, (redis.ConnectionError, redis.TimeoutError), timeout)
+
+#Connect to MongoDB, waiting until the server answers a ping. Each ping is limited to 'probe_timeout' seconds, rather than the 30 seconds the driver would otherwise spend looking for the server,
+#so a server that comes up while we wait is noticed promptly. The client itself keeps the driver's default timeouts.
+def connectMongo(host, port=27017, timeout=60.0, probe_timeout=1.0):
+    client = pymongo.MongoClient(host, port)
+    def ping():
+        with pymongo.timeout(probe_timeout):
+            return client.admin.command('ping')
+    waitFor("MongoDB", ping, ConnectionFailure, timeout)
+    return client
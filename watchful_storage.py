@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+import base64
+import datetime
+import gridfs
+from pymongo import ASCENDING, DESCENDING
+
+#Event images are kept out of the security_events documents and stored in GridFS instead, keyed by the event id. This keeps the event documents small, so listing events doesn't drag every image along with it.
+IMAGE_BUCKET = 'event_images'
+
+#As well as the original image, the hub stores smaller derivatives of each image. 'thumb' is what the events grid and dashboard show, 'preview' is used for email alerts.
+#Events that came with a burst of frames also have each of the other frames stored as 'frame<n>', where n is the frame's position in the burst.
+IMAGE_SIZES = ['thumb', 'preview', 'original']
+
+#Return the GridFS store used for event images in the given database.
+def imageStore(db):
+    return gridfs.GridFS(db, collection=IMAGE_BUCKET)
+
+#GridFS id for one size of an event's image. The original is stored under the plain event id; derivatives and burst frames get the size name appended (e.g. '<event id>.thumb', '<event id>.frame2').
+def imageId(event_id, size='original'):
+    if size == 'original':
+        return event_id
+    return event_id + '.' + size
+
+#Save the JPEG bytes for an event. Images never change once stored, so if the event has already been saved (e.g. a redelivered message) the existing image is kept.
+def saveImage(fs, event_id, image, size='original'):
+    file_id = imageId(event_id, size)
+    try:
+        fs.put(image, _id=file_id, filename=file_id + '.jpg', content_type='image/jpeg')
+    except gridfs.errors.FileExists:
+        pass
+
+#Load the JPEG bytes for an event, or None if there is no such image. Returns the GridFS id of the image that was found as well, for use as a cache key.
+#Events stored before derivatives were generated only have the original, so fall back to that if the requested size is missing. (The key frame of a burst is stored as the original, so asking for it as a frame falls back the same way.)
+#Events stored before images moved to GridFS still have a base64 'captured_image' field in the document, so fall back to that last.
+#Events the retention job (watchful_retention.py) has reduced to a thumbnail have no images in GridFS, just the thumbnail in the document, which stands in for every size.
+def loadImage(fs, event_collection, event_id, size='original'):
+    for file_id in dict.fromkeys([imageId(event_id, size), event_id]):
+        try:
+            with fs.get(file_id) as grid_out:
+                return grid_out.read(), file_id
+        except gridfs.errors.NoFile:
+            continue
+    event = event_collection.find_one({"_id": event_id}, {"captured_image": 1, "thumbnail": 1})
+    if event and event.get('captured_image'):
+        return base64.b64decode(event['captured_image']), event_id
+    if event and event.get('thumbnail'):
+        return bytes(event['thumbnail']), imageId(event_id, 'thumb')
+    return None, None
+
+#Event listings are always for one sensor, newest first, so a compound index on (sensor, timestamp, _id) serves both the filter and the sort, and lets keyset pagination seek straight to the next page.
+#The retention job finds each sensor's oldest events in a retention tier with the (retention, sensor, timestamp) index, and events with an 'expire_at' date are deleted by MongoDB once it has passed.
+def createIndexes(event_collection):
+    event_collection.create_index([("sensor", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], name="sensor_timestamp_id")
+    event_collection.create_index([("retention", ASCENDING), ("sensor", ASCENDING), ("timestamp", ASCENDING)], name="retention_sensor_timestamp")
+    event_collection.create_index("expire_at", expireAfterSeconds=0, name="expire_at_ttl")
+
+#Events used to be stored with str(datetime) timestamps, which don't sort or range-scan properly alongside BSON dates. Convert any that are left over, a batch at a time.
+#Timestamps that can't be parsed are left alone. Returns the number of events converted.
+def migrateTimestamps(event_collection, batch_size=500):
+    converted = 0
+    last_id = None
+    while True:
+        query = {"timestamp": {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(event_collection.find(query, {"timestamp": 1}).sort("_id", ASCENDING).limit(batch_size))
+        if not batch:
+            return converted
+        for event in batch:
+            try:
+                timestamp = datetime.datetime.fromisoformat(event["timestamp"])
+            except ValueError:
+                continue
+            event_collection.update_one({"_id": event["_id"]}, {"$set": {"timestamp": timestamp}})
+            converted += 1
+        last_id = batch[-1]["_id"]
+
+#Cursors are opaque to API clients: the timestamp and id of the last event on a page, URL-safe base64 encoded.
+def encodeCursor(event):
+    return base64.urlsafe_b64encode((event["timestamp"].isoformat() + "|" + str(event["_id"])).encode()).decode()
+
+def decodeCursor(cursor):
+    timestamp, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+    return datetime.datetime.fromisoformat(timestamp), event_id
+
+#Return one page of events for a sensor, newest first, and the cursor for the next page (None when there are no more events).
+#Pagination is keyset-based: the next page starts strictly after the (timestamp, _id) of the last event returned, so each page is an index seek rather than a skip over everything before it.
+#'since' and 'until' optionally restrict the results to a time range (since inclusive, until exclusive). Image data is never included.
+def queryEvents(event_collection, sensor, limit, cursor=None, since=None, until=None):
+    conditions = [{"sensor": sensor}]
+    if since or until:
+        time_range = {}
+        if since:
+            time_range["$gte"] = since
+        if until:
+            time_range["$lt"] = until
+        conditions.append({"timestamp": time_range})
+    if cursor:
+        timestamp, event_id = decodeCursor(cursor)
+        conditions.append({"$or": [{"timestamp": {"$lt": timestamp}}, {"timestamp": timestamp, "_id": {"$lt": event_id}}]})
+    events = list(event_collection.find({"$and": conditions}, {"captured_image": 0, "thumbnail": 0})
+        .sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+        .limit(limit + 1))
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encodeCursor(events[-1])
+    return events, next_cursor
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+import logging
+import redis
+from time import sleep
+
+#Security events travel from the sensors to the hub on Redis Streams rather than pubsub. Each sensor appends its events to its own stream, 'events:<sensor id>',
+#and the hub reads them as the consumer group 'hub'. An event stays in the stream until a hub process has stored it and acknowledged it, so events published while the hub
+#is busy, restarting or not yet reading are delivered when it gets to them, and the events can be spread across several hub processes (each one a consumer in the group).
+STREAM_PREFIX = 'events:'
+GROUP = 'hub'
+
+def streamKey(sensor_id):
+    return STREAM_PREFIX + sensor_id
+
+#Return the time (in seconds since the Unix epoch, by the Redis server's clock) that a stream entry was added. Entry ids are '<milliseconds>-<sequence number>'.
+def entryTime(entry_id):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('UTF-8')
+    return int(entry_id.split('-', 1)[0]) / 1000.0
+
+#Append an encoded event to a sensor's stream. The stream is trimmed to roughly 'maxlen' entries, which bounds how much a long hub outage can pile up in Redis.
+def publishEvent(connection, sensor_id, data, maxlen=100):
+    return connection.xadd(streamKey(sensor_id), {'event': data}, maxlen=maxlen, approximate=True)
+
+#Define the EventConsumer class, which reads events from the sensors' streams as one named consumer in the 'hub' group.
+#read() returns a list of (stream, entry id, encoded event) tuples. Once an event has been dealt with, ack() acknowledges it and deletes it from the stream, so stored events don't take up memory in Redis.
+#Events are delivered at least once: an event read by a consumer that dies before acknowledging it stays pending, and is picked up again by the same consumer when it restarts
+#(a consumer starts by re-reading its own pending events) or claimed by reclaim() in any consumer once it has been pending for 'claim_idle' seconds.
+#An event that has been delivered 'max_deliveries' times without being acknowledged is assumed to be one that can't be processed, and is dropped.
+#Sensors get a new id every time they boot, so the streams of sensors that have gone are removed once they are empty (see prune()), rather than being read (and checked for pending events) forever.
+#Only uses commands from Redis 5.0 (XPENDING and XCLAIM rather than XAUTOCLAIM), so it works with the redis-server packaged for Raspberry Pi OS.
+class EventConsumer:
+    #Delete a stream if it has no entries left, as one atomic step so that an event a sensor adds in between can't be lost. Deleting the stream deletes its consumer group with it.
+    #Returns 1 if the stream is gone (or was never there), 0 if it still has events.
+    DELETE_IF_EMPTY = "if redis.call('XLEN', KEYS[1]) == 0 then redis.call('DEL', KEYS[1]) return 1 end return 0"
+
+    def __init__(self, connection, name, block=1.0, count=16, claim_idle=300.0, max_deliveries=3):
+        self.connection = connection
+        self.name = name
+        self.block = block
+        self.count = count
+        self.claim_idle = claim_idle
+        self.max_deliveries = max_deliveries
+        #Stream key -> the id to read from next: an entry id while re-reading our own pending events, then '>' for new events.
+        self.streams = {}
+        self.delivered = 0
+        self.acknowledged = 0
+        self.claimed = 0
+        self.dropped = 0
+        self.removed = 0
+        self.delete_if_empty = connection.register_script(self.DELETE_IF_EMPTY)
+
+    #Start reading the streams of the given sensors (streams already being read are left alone). Creates the consumer group if the stream doesn't have it yet;
+    #a new group starts from the beginning of the stream, so events published before any hub was reading are delivered too.
+    def watch(self, sensor_ids):
+        for sensor_id in sensor_ids:
+            key = streamKey(sensor_id)
+            if key in self.streams:
+                continue
+            try:
+                self.connection.xgroup_create(key, GROUP, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+            self.streams[key] = '0'
+            logging.info("Reading events from " + key + " as " + self.name)
+
+    #Return the ids of the sensors that have an event stream in Redis with events in it, including sensors that have gone but still have events waiting. Empty streams are removed.
+    def existingStreams(self):
+        keys = [key.decode('UTF-8') for key in self.connection.scan_iter(match=STREAM_PREFIX + '*')]
+        return [key[len(STREAM_PREFIX):] for key, removed in zip(keys, self._deleteIfEmpty(keys)) if not removed]
+
+    #Stop reading the streams of sensors that aren't in 'sensor_ids' (the sensors the hub currently knows about), once they are empty, and remove the streams.
+    #A stream that still has events (published before its sensor went, or still being processed) is kept until they have been acknowledged.
+    #If the sensor turns out to be alive after all, its next event recreates the stream, and the hub starts reading it again from the beginning when it finds the sensor.
+    def prune(self, sensor_ids):
+        active = set(streamKey(sensor_id) for sensor_id in sensor_ids)
+        gone = [key for key in self.streams if key not in active]
+        for key, removed in zip(gone, self._deleteIfEmpty(gone)):
+            if removed:
+                del self.streams[key]
+                logging.info("Stopped reading events from " + key + " (the sensor has gone and the stream is empty)")
+
+    def _deleteIfEmpty(self, keys):
+        if not keys:
+            return []
+        transaction = self.connection.pipeline(transaction=False)
+        for key in keys:
+            self.delete_if_empty(keys=[key], client=transaction)
+        results = transaction.execute()
+        self.removed += sum(results)
+        return results
+
+    #Another hub process may have removed a stream this one is reading (see prune()), which makes reads of it fail with NOGROUP. Stop reading the streams that no longer exist,
+    #and recreate the group on any that a sensor has recreated since, reading it from the beginning.
+    def _recover(self):
+        keys = list(self.streams)
+        transaction = self.connection.pipeline(transaction=False)
+        for key in keys:
+            transaction.exists(key)
+        for key, exists in zip(keys, transaction.execute()):
+            if not exists:
+                del self.streams[key]
+                logging.info("Stopped reading events from " + key + " (the stream has been removed)")
+                continue
+            try:
+                self.connection.xgroup_create(key, GROUP, id='0')
+                self.streams[key] = '0'
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    #Wait up to 'block' seconds for events and return them.
+    #Reading pending events never blocks, so if the only thing a read found was that there are no pending events left, read again (this time waiting for new events).
+    def read(self):
+        if not self.streams:
+            sleep(self.block)
+            return []
+        while True:
+            try:
+                response = self.connection.xreadgroup(GROUP, self.name, dict(self.streams), count=self.count, block=int(self.block * 1000))
+            except redis.ResponseError as e:
+                if 'NOGROUP' not in str(e):
+                    raise
+                self._recover()
+                return []
+            entries = []
+            caught_up = False
+            for key, messages in response or []:
+                key = key.decode('UTF-8')
+                if self.streams[key] != '>':
+                    #Re-reading our own pending events: carry on after the last one, or switch to new events once there are none left.
+                    self.streams[key] = messages[-1][0] if messages else '>'
+                    caught_up = caught_up or not messages
+                entries.extend(self._entries(key, messages))
+            if entries or not caught_up:
+                break
+        self.delivered += len(entries)
+        return entries
+
+    #Claim events that other consumers (or this one) read but haven't acknowledged within 'claim_idle' seconds, e.g. because the process died, and return them to be processed again.
+    #The pending events of every stream are fetched in one round trip.
+    def reclaim(self):
+        entries = []
+        idle = int(self.claim_idle * 1000)
+        keys = list(self.streams)
+        transaction = self.connection.pipeline(transaction=False)
+        for key in keys:
+            transaction.xpending_range(key, GROUP, min='-', max='+', count=self.count)
+        missing = False
+        for key, pending in zip(keys, transaction.execute(raise_on_error=False)):
+            if isinstance(pending, redis.ResponseError):
+                if 'NOGROUP' not in str(pending):
+                    raise pending
+                missing = True
+                continue
+            stale = [entry for entry in pending if entry['time_since_delivered'] >= idle]
+            for entry in stale:
+                if entry['times_delivered'] >= self.max_deliveries:
+                    logging.warning("Dropping event " + entry['message_id'].decode('UTF-8') + " from " + key + " after " + str(entry['times_delivered']) + " deliveries")
+                    self.ack(key, entry['message_id'])
+                    self.dropped += 1
+            retry = [entry['message_id'] for entry in stale if entry['times_delivered'] < self.max_deliveries]
+            if retry:
+                claimed = self._entries(key, self.connection.xclaim(key, GROUP, self.name, min_idle_time=idle, message_ids=retry))
+                self.claimed += len(claimed)
+                entries.extend(claimed)
+        if missing:
+            self._recover()
+        return entries
+
+    def ack(self, key, entry_id):
+        transaction = self.connection.pipeline()
+        transaction.xack(key, GROUP, entry_id)
+        transaction.xdel(key, entry_id)
+        transaction.execute()
+        self.acknowledged += 1
+
+    def stats(self):
+        return {"streams": len(self.streams), "delivered": self.delivered, "acknowledged": self.acknowledged, "claimed": self.claimed, "dropped": self.dropped, "removed": self.removed}
+
+    #Turn stream entries into (stream, entry id, encoded event) tuples. Entries that were trimmed from the stream before they could be read come back without fields -- there is nothing to process, so they are just acknowledged.
+    def _entries(self, key, messages):
+        entries = []
+        for entry_id, fields in messages:
+            if not fields or b'event' not in fields:
+                self.ack(key, entry_id)
+                continue
+            entries.append((key, entry_id, fields[b'event']))
+        return entries
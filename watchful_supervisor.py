@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+from time import monotonic, sleep
+from dotenv import dotenv_values
+
+#Single entry point for the hub machine: starts the hub and the web interface at the same time, reports when each is ready and how long it took, and restarts either one if it exits.
+#Neither program needs the other to have finished starting: each one waits for Redis and MongoDB by probing them (see watchful_startup.py), so nothing here sleeps for a fixed time either.
+#Both run in their own process group, so stopping the supervisor (Ctrl-C, or SIGTERM from e.g. systemd) also stops the hub's redis-server.
+
+#Load config/environmental variables from .env file (the hub and the interface read the same file).
+config = dotenv_values('.env')
+
+#Enable informational logging.
+logging.basicConfig(level=logging.INFO)
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+#How often a starting program is checked for readiness: every few milliseconds at first, backing off to 'PROBE_MAXIMUM' seconds.
+PROBE_INITIAL = 0.01
+PROBE_MAXIMUM = 0.5
+
+#A program that exits is restarted after RESTART_INITIAL seconds, doubling each time it exits again without having become ready, up to RESTART_MAXIMUM.
+RESTART_INITIAL = 1.0
+RESTART_MAXIMUM = 60.0
+
+#Return a readiness check that asks for 'path' on a local port and is satisfied when the response is 200 and contains 'marker'.
+#A plain HTTP/1.0 request over a socket, which is all this needs, so the supervisor doesn't spend its own start up importing http.client.
+def httpReady(port, path, marker=b''):
+    def ready():
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as connection:
+                connection.sendall(b'GET ' + path.encode() + b' HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n')
+                response = b''
+                while True:
+                    data = connection.recv(65536)
+                    if not data:
+                        break
+                    response += data
+        except OSError:
+            return False
+        status = response.split(b'\r\n', 1)[0].split()
+        return len(status) > 1 and status[1] == b'200' and marker in response
+    return ready
+
+#Define the Program class: one program run by the supervisor, with the check that tells when it's ready and when its next readiness probe or restart is due.
+class Program:
+    def __init__(self, name, command, ready):
+        self.name = name
+        self.command = command
+        self.ready = ready
+        self.process = None
+        self.started = None
+        self.ready_after = None
+        self.probe_delay = PROBE_INITIAL
+        self.next_probe = 0.0
+        self.restart_delay = RESTART_INITIAL
+        self.restart_at = None
+        self.groups = []
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, start_new_session=True)
+        self.groups.append(self.process.pid)
+        self.started = monotonic()
+        self.ready_after = None
+        self.probe_delay = PROBE_INITIAL
+        self.next_probe = self.started
+        self.restart_at = None
+        logging.info("Started the " + self.name + " (pid " + str(self.process.pid) + ")")
+
+    #Check on the program: restart it if it has exited (once the restart delay is up), otherwise probe it for readiness if it isn't ready yet and a probe is due.
+    def check(self, now):
+        if self.restart_at is not None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is not None:
+            if self.ready_after is not None:
+                self.restart_delay = RESTART_INITIAL
+            logging.warning("The " + self.name + " exited with code " + str(code) + ", restarting it in " + str(self.restart_delay) + " seconds")
+            self.restart_at = now + self.restart_delay
+            self.restart_delay = min(self.restart_delay * 2, RESTART_MAXIMUM)
+            return
+        if self.ready_after is None and now >= self.next_probe:
+            if self.ready():
+                self.ready_after = monotonic() - self.started
+                logging.info("The " + self.name + " is ready, " + str(int(self.ready_after * 1000)) + " ms after starting")
+            else:
+                self.next_probe = monotonic() + self.probe_delay
+                self.probe_delay = min(self.probe_delay * 2, PROBE_MAXIMUM)
+
+    #Ask the program's process groups to stop, and kill the program if it hasn't within 'timeout' seconds. A group left by an earlier run of the program can still be running
+    #(a hub that exits leaves its redis-server behind, and the restarted hub carries on using it, so the events waiting in its streams aren't lost).
+    def stop(self, timeout=10.0):
+        for group in self.groups:
+            try:
+                os.killpg(group, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        if self.process is None or self.process.poll() is not None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        except ProcessLookupError:
+            pass
+
+stopping = False
+
+def stop(signum, frame):
+    global stopping
+    stopping = True
+
+#The line of the hub's /metrics with its start up time. Matched from the start of the line, so that it's the sample itself that counts and not the '# HELP' and '# TYPE' lines,
+#which are there as soon as /metrics is served, before the hub has finished starting.
+HUB_READY_SAMPLE = b'\nwatchful_hub_startup_seconds '
+
+#Start both programs, then keep checking on them until the supervisor is told to stop.
+#The hub is ready once its /metrics reports how long it took to start (it does that once it's reading the sensor streams), and the interface once it answers on port 5000.
+def main():
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    hubMetricsPort = int(config.get('metricsPort', 9101))
+    programs = [
+        Program("hub", [sys.executable, os.path.join(DIRECTORY, 'watchful_hub.py')], httpReady(hubMetricsPort, '/metrics', HUB_READY_SAMPLE)),
+        Program("interface", [sys.executable, os.path.join(DIRECTORY, 'watchful_interface.py')], httpReady(5000, '/metrics'))
+    ]
+    started = monotonic()
+    for program in programs:
+        program.start()
+    everything_ready = False
+    while not stopping:
+        now = monotonic()
+        for program in programs:
+            program.check(now)
+        if not everything_ready and all(program.ready_after is not None for program in programs):
+            everything_ready = True
+            logging.info("Hub and interface ready in " + str(int((monotonic() - started) * 1000)) + " ms")
+        sleep(PROBE_INITIAL if any(program.ready_after is None for program in programs) else 0.5)
+    logging.info("Stopping")
+    for program in programs:
+        program.stop()
+
+if __name__ == "__main__":
+    main()